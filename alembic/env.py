@@ -77,9 +77,13 @@ def run_migrations_online():
                 poolclass=pool.NullPool)
 
     connection = engine.connect()
+    # each revision commits on its own, so that the ones copying a table
+    # online (a9c4e7b2d158, 5b7e0d2c9a64) start with the ones before them
+    # committed, and can do it on a connection of their own
     context.configure(
                 connection=connection,
-                target_metadata=target_metadata
+                target_metadata=target_metadata,
+                transaction_per_migration=True
                 )
 
     try:
@@ -0,0 +1,66 @@
+"""Keep the parsed query string of stored payloads
+
+Revision ID: 2d6f8a1c4e93
+Revises: 5b7e0d2c9a64
+Create Date: 2026-10-19 00:12:26.730518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d6f8a1c4e93'
+down_revision = '5b7e0d2c9a64'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+import json
+import logging
+import sys
+import urllib.parse as urlparse
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    # nullable, so no table rewrite; readers parse the payload themselves
+    # until their row has been backfilled
+    op.add_column('query_payloads', sa.Column('params', JSONB(), nullable=True))
+
+    # parsed here rather than in SQL, so that the result is exactly what
+    # urlparse.parse_qs() gives the service; read in batches, but all in
+    # alembic's transaction so that a failure leaves no half done column
+    conn = op.get_bind()
+    select = sa.text("""
+        SELECT id, query FROM query_payloads
+        WHERE id > :last AND params IS NULL
+        ORDER BY id LIMIT :batch
+        """)
+    update = sa.text('UPDATE query_payloads SET params = CAST(:params AS jsonb) WHERE id = :id')
+
+    last = 0
+    done = 0
+    while True:
+        rows = conn.execute(select, last=last, batch=BATCH_SIZE).fetchall()
+        if not rows:
+            break
+        values = []
+        for payload_id, query in rows:
+            last = payload_id
+            try:
+                payload = json.loads(bytes(query).decode('utf8')) if query else {}
+            except ValueError:
+                logger.warning('Payload {0} is not valid JSON, left as is'.format(payload_id))
+                continue
+            values.append({'id': payload_id, 'params': json.dumps(urlparse.parse_qs(payload.get('query') or ''))})
+        if values:
+            conn.execute(update, values)
+        done += len(values)
+        logger.info('Parsed {0} payloads (last id: {1})'.format(done, last))
+
+
+def downgrade():
+    op.drop_column('query_payloads', 'params')
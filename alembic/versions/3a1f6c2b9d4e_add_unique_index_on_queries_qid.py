@@ -0,0 +1,51 @@
+"""Add unique index on queries.qid
+
+Revision ID: 3a1f6c2b9d4e
+Revises: 717c2970ff42
+Create Date: 2026-10-18 09:12:44.120931
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1f6c2b9d4e'
+down_revision = '717c2970ff42'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # the original queries_qid_key constraint was dropped in 4c05e8316b26, so
+    # duplicates may have crept in (two identical submissions racing on
+    # insert); fold them onto the oldest row before making qid unique
+    op.execute("""
+        UPDATE myads SET query_id = d.keep_id
+        FROM (
+            SELECT id, min(id) OVER (PARTITION BY qid) AS keep_id
+            FROM queries
+            WHERE qid IS NOT NULL
+        ) AS d
+        WHERE myads.query_id = d.id AND d.id <> d.keep_id
+        """)
+    op.execute("""
+        DELETE FROM queries q
+        USING queries k
+        WHERE q.qid = k.qid AND q.id > k.id
+        """)
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block, and
+    # alembic 0.8 has no autocommit_block(): commit the clean up, build the
+    # index on its own (the table stays writable meanwhile) and open a new
+    # transaction for the rest of the run. A build that failed half way
+    # leaves an invalid index behind, dropped when the revision is re-run
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_queries_qid')
+    op.create_index('ix_queries_qid', 'queries', ['qid'], unique=True,
+                    postgresql_concurrently=True)
+    op.execute('BEGIN')
+
+
+def downgrade():
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_queries_qid')
+    op.execute('BEGIN')
@@ -0,0 +1,219 @@
+"""Store qids as the 16 bytes of their digest
+
+Revision ID: 5b7e0d2c9a64
+Revises: a9c4e7b2d158
+Create Date: 2026-10-18 23:05:48.316920
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b7e0d2c9a64'
+down_revision = 'a9c4e7b2d158'
+
+from alembic import op
+from contextlib import closing
+import sqlalchemy as sa
+import logging
+import sys
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+BATCH_SIZE = 10000
+
+# the same conversions as vault_service.models.qid_key() and key_qid()
+TO_KEY = """(CASE WHEN {0} ~ '^[0-9a-fA-F]{{32}}$' THEN decode({0}, 'hex')
+                  WHEN octet_length({0}) = 16 THEN convert_to({0}, 'UTF8') || '\\x00'::bytea
+                  ELSE convert_to({0}, 'UTF8') END)"""
+TO_TEXT = """(CASE WHEN octet_length({0}) = 16 THEN encode({0}, 'hex')
+                   WHEN octet_length({0}) = 17 AND get_byte({0}, 16) = 0
+                       THEN convert_from(substring({0} from 1 for 16), 'UTF8')
+                   ELSE convert_from({0}, 'UTF8') END)"""
+
+# the tables copied online, with the column the copy goes by and their
+# indexes (ix_<table>_<name>: unique, columns)
+TABLES = [
+    ('queries', 'id', [('qid', True, 'qid'), ('numfound_updated', False, 'numfound_updated NULLS FIRST, id')]),
+    ('queries_archive', 'id', [('qid', True, 'qid')]),
+    ('query_access', 'qid', [('last_access', False, 'last_access')]),
+]
+FOREIGN_KEYS = {'payload_id': 'query_payloads', 'bigquery_id': 'query_bigqueries'}
+
+# as format_type() names them
+TYPE_NAMES = {'bytea': 'bytea', 'varchar(32)': 'character varying(32)'}
+
+# mirrors every change made to the table while it is being copied; the copy
+# locks the rows it reads (FOR SHARE), so it cannot overwrite a newer version
+SYNC_FUNCTION = """
+    CREATE OR REPLACE FUNCTION {0}_qid_sync() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM {1} WHERE {2};
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.qid IS NOT NULL THEN
+            INSERT INTO {1} ({3}) VALUES ({4}) ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """
+
+
+def online_connection():
+    """A connection of its own, outside alembic's transaction (env.py commits
+    every revision on its own, so the ones before this one are in): the copy
+    commits batch by batch, and holds neither locks nor a snapshot for
+    longer than one batch"""
+    return closing(op.get_bind().engine.connect())
+
+
+def indexes_size(conn, table):
+    # a partitioned table has no storage of its own, its partitions have
+    return conn.execute(sa.text("""
+        SELECT CAST(sum(pg_indexes_size(oid)) AS bigint) FROM (
+            SELECT CAST(:table AS regclass) AS oid
+            UNION ALL
+            SELECT inhrelid FROM pg_inherits WHERE inhparent = CAST(:table AS regclass)) AS parts
+        """), table=table).scalar()
+
+
+def stop_sync(conn, table):
+    conn.execute('DROP TRIGGER IF EXISTS {0}_qid_sync ON {0}'.format(table))
+    conn.execute('DROP FUNCTION IF EXISTS {0}_qid_sync()'.format(table))
+
+
+def copy_rows(conn, table, new, columns, key, convert):
+    """Copies table into new by batches of BATCH_SIZE rows in `key` order,
+    each batch in its own transaction; rows written meanwhile are the
+    trigger's"""
+    values = ', '.join(convert.format(c) if c == 'qid' else c for c in columns)
+    last, copied = None, 0
+    while True:
+        after = '{0} > :last'.format(key) if last is not None else 'TRUE'
+        with conn.begin():
+            upto = conn.execute(sa.text(
+                'SELECT max({0}) FROM (SELECT {0} FROM {1} WHERE {2} ORDER BY {0} LIMIT :n) AS batch'.format(
+                    key, table, after)), last=last, n=BATCH_SIZE).scalar()
+            if upto is None:
+                break
+            copied += conn.execute(sa.text("""
+                INSERT INTO {0} ({1})
+                SELECT {2} FROM {3} WHERE {4} AND {5} <= :upto AND qid IS NOT NULL
+                FOR SHARE
+                ON CONFLICT DO NOTHING
+                """.format(new, ', '.join(columns), values, table, after, key)), last=last, upto=upto).rowcount
+        last = upto
+        logger.info('Copied {0} rows from {1} to {2}'.format(copied, table, new))
+
+
+def rebuild(conn, table, key, indexes, qid_type, convert, old):
+    """Copies table into one with a qid of `qid_type`, partitioned like it
+    is, and swaps the two; the old table is kept as `old`. Writes go on
+    during the copy, the trigger mirrors them; only the swap locks them out"""
+    new = table + '_new'
+    with conn.begin():
+        if conn.execute(sa.text("""
+                SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = CAST(:table AS regclass) AND attname = 'qid'
+                """), table=table).scalar() == TYPE_NAMES[qid_type]:
+            # a run that failed after this table was swapped
+            logger.info('{0}.qid is {1} already'.format(table, qid_type))
+            return
+        columns = [r.column_name for r in conn.execute(sa.text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = :table ORDER BY ordinal_position
+            """), table=table)]
+        partitions = conn.execute(sa.text(
+            'SELECT count(*) FROM pg_inherits WHERE inhparent = CAST(:table AS regclass)'), table=table).scalar()
+        sequence = conn.execute(sa.text("SELECT pg_get_serial_sequence(:table, 'id')"), table=table).scalar() \
+            if 'id' in columns else None
+        foreign_key = table == 'queries' and conn.execute(
+            "SELECT count(*) FROM pg_constraint WHERE conname = 'myads_query_id_fkey'").scalar()
+        before = indexes_size(conn, table)
+
+        # leftovers of a failed run; `old` is one of an earlier upgrade or
+        # downgrade, stale since the rows were copied back
+        stop_sync(conn, table)
+        conn.execute('DROP TABLE IF EXISTS {0}_template, {0}, {1}'.format(new, old))
+
+        # a partition key cannot change type, not even on an empty table: the
+        # new layout is taken from a plain template
+        conn.execute('CREATE TABLE {0}_template (LIKE {1} INCLUDING DEFAULTS)'.format(new, table))
+        conn.execute('ALTER TABLE {0}_template ALTER COLUMN qid TYPE {1} USING {2}'.format(
+            new, qid_type, convert.format('qid')))
+        if partitions:
+            conn.execute('CREATE TABLE {0} (LIKE {0}_template INCLUDING DEFAULTS) PARTITION BY HASH (qid)'.format(new))
+            for i in range(partitions):
+                conn.execute('CREATE TABLE {0}_p{1} PARTITION OF {0} '
+                             'FOR VALUES WITH (MODULUS {2}, REMAINDER {1})'.format(new, i, partitions))
+        else:
+            conn.execute('CREATE TABLE {0} (LIKE {0}_template INCLUDING DEFAULTS)'.format(new))
+        conn.execute('DROP TABLE {0}_template'.format(new))
+
+        # the keys are needed from the start, by the ON CONFLICT of the
+        # copy and of the trigger
+        conn.execute('ALTER TABLE {0} ADD CONSTRAINT {0}_pkey PRIMARY KEY ({1})'.format(
+            new, key + ', qid' if partitions and key != 'qid' else key))
+        for column, target in sorted(FOREIGN_KEYS.items()):
+            if column in columns:
+                conn.execute('ALTER TABLE {0} ADD CONSTRAINT {1}_{2}_fkey FOREIGN KEY ({2}) '
+                             'REFERENCES {3} (id)'.format(new, table, column, target))
+        for name, unique, on in indexes:
+            conn.execute('CREATE {0}INDEX ix_{1}_{2} ON {1} ({3})'.format(
+                'UNIQUE ' if unique else '', new, name, on))
+
+        match = ['qid = ' + convert.format('OLD.qid')]
+        if key != 'qid':
+            match.insert(0, '{0} = OLD.{0}'.format(key))
+        conn.execute(SYNC_FUNCTION.format(
+            table, new, ' AND '.join(match), ', '.join(columns),
+            ', '.join(convert.format('NEW.qid') if c == 'qid' else 'NEW.' + c for c in columns)))
+        conn.execute('CREATE TRIGGER {0}_qid_sync AFTER INSERT OR UPDATE OR DELETE ON {0} '
+                     'FOR EACH ROW EXECUTE PROCEDURE {0}_qid_sync()'.format(table))
+
+    copy_rows(conn, table, new, columns, key, convert)
+
+    # the swap itself is quick; writers wait for it behind the lock
+    with conn.begin():
+        conn.execute('LOCK TABLE {0} IN ACCESS EXCLUSIVE MODE'.format(table))
+        stop_sync(conn, table)
+        if table == 'queries':
+            conn.execute('ALTER TABLE myads DROP CONSTRAINT IF EXISTS myads_query_id_fkey')
+        for source, target in ((table, old), (new, table)):
+            conn.execute('ALTER TABLE {0} RENAME TO {1}'.format(source, target))
+            conn.execute('ALTER TABLE {1} RENAME CONSTRAINT {0}_pkey TO {1}_pkey'.format(source, target))
+            for name, unique, on in indexes:
+                conn.execute('ALTER INDEX IF EXISTS ix_{0}_{2} RENAME TO ix_{1}_{2}'.format(source, target, name))
+            for i in range(partitions):
+                conn.execute('ALTER TABLE {0}_p{2} RENAME TO {1}_p{2}'.format(source, target, i))
+        if sequence:
+            conn.execute('ALTER SEQUENCE {0} OWNED BY {1}.id'.format(sequence, table))
+        if foreign_key and not partitions:
+            conn.execute('ALTER TABLE myads ADD CONSTRAINT myads_query_id_fkey '
+                         'FOREIGN KEY (query_id) REFERENCES queries (id)')
+    with conn.begin():
+        conn.execute('ANALYZE {0}'.format(table))
+        after = indexes_size(conn, table)
+
+    logger.info('Size of the indexes of {0}: {1} bytes before, {2} bytes after'.format(table, before, after))
+    logger.info('The previous {0} table is kept as {1}; DROP TABLE {1} once happy'.format(table, old))
+
+
+def convert_qids(qid_type, convert, suffix):
+    with online_connection() as conn:
+        for table, key, indexes in TABLES:
+            rebuild(conn, table, key, indexes, qid_type, convert, '{0}_{1}'.format(table, suffix))
+
+    # myADS notifications are few: rewritten in place, in alembic's
+    # transaction (after the copies, which could not wait for its locks)
+    op.execute('ALTER TABLE myads ALTER COLUMN query_qid TYPE {0} USING {1}'.format(
+        qid_type, convert.format('query_qid')))
+
+
+def upgrade():
+    convert_qids('bytea', TO_KEY, 'hex_qids')
+
+
+def downgrade():
+    convert_qids('varchar(32)', TO_TEXT, 'binary_qids')
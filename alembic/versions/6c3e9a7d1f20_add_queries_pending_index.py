@@ -0,0 +1,53 @@
+"""Index the pending queries for the refresher
+
+Revision ID: 6c3e9a7d1f20
+Revises: 2d6f8a1c4e93
+Create Date: 2026-10-19 10:14:52.648213
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6c3e9a7d1f20'
+down_revision = '2d6f8a1c4e93'
+
+from alembic import op
+
+COLUMNS = "(numfound_updated NULLS FIRST, id) WHERE status = 'pending'"
+
+
+def partitions(conn):
+    return [r[0] for r in conn.execute(
+        "SELECT CAST(CAST(inhrelid AS regclass) AS text) FROM pg_inherits "
+        "WHERE inhparent = CAST('queries' AS regclass) ORDER BY 1")]
+
+
+def upgrade():
+    # the refresher takes the pending queries first, with a query of their
+    # own: a partial index keeps it from scanning the table, which
+    # ix_queries_numfound_updated would otherwise do for each batch.
+    # Built concurrently, outside of alembic's transaction (see 3a1f6c2b9d4e);
+    # a partitioned table cannot be, so its partitions are, one by one, and
+    # attached to an index created on the table alone
+    parts = partitions(op.get_bind())
+    op.execute('COMMIT')
+    if parts:
+        op.execute('DROP INDEX IF EXISTS ix_queries_pending')
+        op.execute('CREATE INDEX ix_queries_pending ON ONLY queries {0}'.format(COLUMNS))
+        for part in parts:
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_{0}_pending'.format(part))
+            op.execute('CREATE INDEX CONCURRENTLY ix_{0}_pending ON {0} {1}'.format(part, COLUMNS))
+            op.execute('ALTER INDEX ix_queries_pending ATTACH PARTITION ix_{0}_pending'.format(part))
+    else:
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_queries_pending')
+        op.execute('CREATE INDEX CONCURRENTLY ix_queries_pending ON queries {0}'.format(COLUMNS))
+    op.execute('BEGIN')
+
+
+def downgrade():
+    if partitions(op.get_bind()):
+        # the index of a partitioned table goes with the ones of its partitions
+        op.execute('DROP INDEX IF EXISTS ix_queries_pending')
+    else:
+        op.execute('COMMIT')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_queries_pending')
+        op.execute('BEGIN')
@@ -0,0 +1,95 @@
+"""Move bigqueries out of line into compressed query_bigqueries
+
+Revision ID: 8e2d4b7a1c95
+Revises: 3a1f6c2b9d4e
+Create Date: 2026-10-18 11:40:02.551307
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e2d4b7a1c95'
+down_revision = '3a1f6c2b9d4e'
+
+from alembic import op
+import sqlalchemy as sa
+import json
+import logging
+import sys
+import zlib
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+BATCH_SIZE = 500
+
+
+def upgrade():
+    op.create_table('query_bigqueries',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('codec', sa.String(length=16), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=True),
+    sa.Column('data', sa.LargeBinary(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.add_column('queries', sa.Column('bigquery_id', sa.Integer(), sa.ForeignKey('query_bigqueries.id'), nullable=True))
+
+    # rows without a bigquery end with '"bigquery": ""}'; only the others
+    # are read back, BATCH_SIZE at a time so memory stays bounded
+    conn = op.get_bind()
+    select = sa.text("""
+        SELECT id, query FROM queries
+        WHERE id > :last AND query NOT LIKE '%"bigquery": ""}'::bytea
+        ORDER BY id LIMIT :batch
+        """)
+    insert = sa.text("INSERT INTO query_bigqueries (codec, size, data) VALUES ('zlib', :size, :data) RETURNING id")
+    update = sa.text("UPDATE queries SET query = :query, bigquery_id = :bigquery_id WHERE id = :id")
+
+    last = 0
+    converted = 0
+    while True:
+        rows = conn.execute(select, last=last, batch=BATCH_SIZE).fetchall()
+        if not rows:
+            break
+        for query_id, query in rows:
+            last = query_id
+            try:
+                payload = json.loads(bytes(query).decode('utf8'))
+            except ValueError:
+                logger.warning('Query {0} is not valid JSON, left as is'.format(query_id))
+                continue
+            if not payload.get('bigquery'):
+                continue
+            data = payload['bigquery'].encode('utf8')
+            bigquery_id = conn.execute(insert, size=len(data), data=zlib.compress(data, 6)).scalar()
+            payload['bigquery'] = ''
+            conn.execute(update, query=json.dumps(payload).encode('utf8'), bigquery_id=bigquery_id, id=query_id)
+            converted += 1
+        logger.info('Moved {0} bigqueries out of line (last id: {1})'.format(converted, last))
+
+
+def downgrade():
+    conn = op.get_bind()
+    select = sa.text("""
+        SELECT q.id, q.query, b.codec, b.data FROM queries q
+        JOIN query_bigqueries b ON b.id = q.bigquery_id
+        WHERE q.id > :last ORDER BY q.id LIMIT :batch
+        """)
+    update = sa.text("UPDATE queries SET query = :query WHERE id = :id")
+
+    last = 0
+    while True:
+        rows = conn.execute(select, last=last, batch=BATCH_SIZE).fetchall()
+        if not rows:
+            break
+        for query_id, query, codec, data in rows:
+            last = query_id
+            data = bytes(data)
+            if codec == 'zlib':
+                data = zlib.decompress(data)
+            payload = json.loads(bytes(query).decode('utf8'))
+            payload['bigquery'] = data.decode('utf8')
+            conn.execute(update, query=json.dumps(payload).encode('utf8'), id=query_id)
+
+    op.drop_column('queries', 'bigquery_id')
+    op.drop_table('query_bigqueries')
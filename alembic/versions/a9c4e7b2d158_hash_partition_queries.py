@@ -0,0 +1,213 @@
+"""Hash partition queries on the qid
+
+Revision ID: a9c4e7b2d158
+Revises: f1c8b5a3d297
+Create Date: 2026-10-18 21:52:37.120664
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a9c4e7b2d158'
+down_revision = 'f1c8b5a3d297'
+
+from alembic import context, op
+from contextlib import closing
+import sqlalchemy as sa
+import logging
+import os
+import sys
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+BATCH_SIZE = 10000
+
+# the number of partitions can be given as `alembic -x partitions=32 upgrade head`
+# (or VAULT_QUERIES_PARTITIONS); 0 leaves queries as it is
+DEFAULT_PARTITIONS = 16
+
+COLUMNS = 'id, uid, qid, created, updated, numfound, numfound_updated, status, category, payload_id, query, bigquery_id'
+
+# mirrors every change made to queries into {0} while it is being copied;
+# the copy locks the rows it reads (FOR SHARE), so it cannot overwrite a
+# newer version
+SYNC_FUNCTION = """
+    CREATE OR REPLACE FUNCTION queries_copy_sync() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM {{0}} WHERE id = OLD.id AND qid = OLD.qid;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.qid IS NOT NULL THEN
+            INSERT INTO {{0}} ({0}) VALUES ({1}) ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """.format(COLUMNS, ', '.join('NEW.' + c.strip() for c in COLUMNS.split(',')))
+
+
+def partitions():
+    value = context.get_x_argument(as_dictionary=True).get('partitions') \
+        or os.environ.get('VAULT_QUERIES_PARTITIONS', DEFAULT_PARTITIONS)
+    return int(value)
+
+
+def is_partitioned(conn):
+    return conn.execute("SELECT relkind = 'p' FROM pg_class WHERE relname = 'queries'").scalar()
+
+
+def online_connection():
+    """A connection of its own, outside alembic's transaction (env.py commits
+    every revision on its own, so the ones before this one are in): the copy
+    commits batch by batch, and holds neither locks nor a snapshot for
+    longer than one batch"""
+    return closing(op.get_bind().engine.connect())
+
+
+def start_sync(conn, target):
+    conn.execute(SYNC_FUNCTION.format(target))
+    conn.execute('CREATE TRIGGER queries_copy_sync AFTER INSERT OR UPDATE OR DELETE ON queries '
+                 'FOR EACH ROW EXECUTE PROCEDURE queries_copy_sync()')
+
+
+def stop_sync(conn):
+    conn.execute('DROP TRIGGER IF EXISTS queries_copy_sync ON queries')
+    conn.execute('DROP FUNCTION IF EXISTS queries_copy_sync()')
+
+
+def copy_rows(conn, source, target, where=''):
+    """Copies source into target by ranges of ids, each range in its own
+    transaction; rows inserted after max(id) was read are the trigger's"""
+    with conn.begin():
+        low, high = conn.execute('SELECT min(id), max(id) FROM {0}'.format(source)).first()
+    if low is None:
+        return
+    insert = sa.text("""
+        INSERT INTO {0} ({2})
+        SELECT {2} FROM {1} WHERE id >= :low AND id < :high {3}
+        FOR SHARE
+        ON CONFLICT DO NOTHING
+        """.format(target, source, COLUMNS, where))
+    copied = 0
+    for start in range(low, high + 1, BATCH_SIZE):
+        with conn.begin():
+            copied += conn.execute(insert, low=start, high=start + BATCH_SIZE).rowcount
+        logger.info('Copied {0} rows from {1} to {2} (last id: {3})'.format(
+            copied, source, target, min(start + BATCH_SIZE - 1, high)))
+
+
+def partition(conn, count):
+    with conn.begin():
+        # leftovers of a failed run, or of a downgrade (which copied the
+        # rows back, so the old table is stale)
+        stop_sync(conn)
+        conn.execute('DROP TABLE IF EXISTS queries_partitioned')
+        conn.execute('DROP TABLE IF EXISTS queries_unpartitioned')
+
+        # a partitioned table cannot be referenced by a foreign key on id alone
+        # (every unique key has to include the qid), so myads.query_id loses its
+        conn.execute('ALTER TABLE myads DROP CONSTRAINT IF EXISTS myads_query_id_fkey')
+
+        conn.execute('CREATE TABLE queries_partitioned (LIKE queries INCLUDING DEFAULTS) PARTITION BY HASH (qid)')
+        for i in range(count):
+            conn.execute('CREATE TABLE queries_p{0} PARTITION OF queries_partitioned '
+                         'FOR VALUES WITH (MODULUS {1}, REMAINDER {0})'.format(i, count))
+        # the keys are needed from the start, by the ON CONFLICT of the
+        # copy and of the trigger
+        conn.execute('ALTER TABLE queries_partitioned ADD CONSTRAINT queries_partitioned_pkey PRIMARY KEY (id, qid)')
+        conn.execute('ALTER TABLE queries_partitioned ADD FOREIGN KEY (payload_id) REFERENCES query_payloads (id)')
+        conn.execute('ALTER TABLE queries_partitioned ADD FOREIGN KEY (bigquery_id) REFERENCES query_bigqueries (id)')
+        conn.execute('CREATE UNIQUE INDEX ix_queries_partitioned_qid ON queries_partitioned (qid)')
+        conn.execute('CREATE INDEX ix_queries_partitioned_numfound_updated '
+                     'ON queries_partitioned (numfound_updated NULLS FIRST, id)')
+        start_sync(conn, 'queries_partitioned')
+
+    with conn.begin():
+        skipped = conn.execute('SELECT count(*) FROM queries WHERE qid IS NULL').scalar()
+    if skipped:
+        logger.warning('{0} queries without a qid are left behind in queries_unpartitioned'.format(skipped))
+    copy_rows(conn, 'queries', 'queries_partitioned', where='AND qid IS NOT NULL')
+
+    # the swap itself is quick; writers wait for it behind the lock
+    with conn.begin():
+        conn.execute('LOCK TABLE queries IN ACCESS EXCLUSIVE MODE')
+        stop_sync(conn)
+        conn.execute('ALTER TABLE queries RENAME TO queries_unpartitioned')
+        conn.execute('ALTER TABLE queries_unpartitioned RENAME CONSTRAINT queries_pkey TO queries_unpartitioned_pkey')
+        conn.execute('ALTER INDEX ix_queries_qid RENAME TO ix_queries_unpartitioned_qid')
+        conn.execute('ALTER INDEX IF EXISTS ix_queries_numfound_updated '
+                     'RENAME TO ix_queries_unpartitioned_numfound_updated')
+        conn.execute('ALTER TABLE queries_partitioned RENAME TO queries')
+        conn.execute('ALTER TABLE queries RENAME CONSTRAINT queries_partitioned_pkey TO queries_pkey')
+        conn.execute('ALTER INDEX ix_queries_partitioned_qid RENAME TO ix_queries_qid')
+        conn.execute('ALTER INDEX ix_queries_partitioned_numfound_updated RENAME TO ix_queries_numfound_updated')
+        conn.execute('ALTER SEQUENCE queries_id_seq OWNED BY queries.id')
+    with conn.begin():
+        conn.execute('ANALYZE queries')
+
+    # kept for a manual rollback; DROP TABLE queries_unpartitioned once happy
+    logger.info('queries is now hash partitioned in {0}; the old table is queries_unpartitioned'.format(count))
+
+
+def unpartition(conn):
+    with conn.begin():
+        stop_sync(conn)
+        conn.execute('DROP TABLE IF EXISTS queries_plain')
+        conn.execute('CREATE TABLE queries_plain (LIKE queries INCLUDING DEFAULTS)')
+        conn.execute('ALTER TABLE queries_plain ADD CONSTRAINT queries_plain_pkey PRIMARY KEY (id)')
+        conn.execute('ALTER TABLE queries_plain ADD FOREIGN KEY (payload_id) REFERENCES query_payloads (id)')
+        conn.execute('ALTER TABLE queries_plain ADD FOREIGN KEY (bigquery_id) REFERENCES query_bigqueries (id)')
+        conn.execute('CREATE UNIQUE INDEX ix_queries_plain_qid ON queries_plain (qid)')
+        conn.execute('CREATE INDEX ix_queries_plain_numfound_updated ON queries_plain (numfound_updated NULLS FIRST, id)')
+        start_sync(conn, 'queries_plain')
+
+    copy_rows(conn, 'queries', 'queries_plain')
+
+    with conn.begin():
+        conn.execute('LOCK TABLE queries IN ACCESS EXCLUSIVE MODE')
+        stop_sync(conn)
+        conn.execute('ALTER SEQUENCE queries_id_seq OWNED BY NONE')
+        conn.execute('DROP TABLE queries')
+        conn.execute('ALTER TABLE queries_plain RENAME TO queries')
+        conn.execute('ALTER TABLE queries RENAME CONSTRAINT queries_plain_pkey TO queries_pkey')
+        conn.execute('ALTER INDEX ix_queries_plain_qid RENAME TO ix_queries_qid')
+        conn.execute('ALTER INDEX ix_queries_plain_numfound_updated RENAME TO ix_queries_numfound_updated')
+        conn.execute('ALTER SEQUENCE queries_id_seq OWNED BY queries.id')
+        conn.execute('ALTER TABLE myads ADD CONSTRAINT myads_query_id_fkey '
+                     'FOREIGN KEY (query_id) REFERENCES queries (id)')
+        # the table the upgrade kept is older than the rows just copied back
+        conn.execute('DROP TABLE IF EXISTS queries_unpartitioned')
+    with conn.begin():
+        conn.execute('ANALYZE queries')
+
+
+def upgrade():
+    count = partitions()
+    if count < 2:
+        logger.info('Not partitioning queries ({0} partitions)'.format(count))
+    elif int(op.get_bind().execute('SHOW server_version_num').scalar()) < 110000:
+        # declarative hash partitioning (and ON CONFLICT on a partitioned
+        # table) needs Postgres 11; upgrade the server and re-run this
+        # revision (downgrade -1, upgrade) to partition
+        logger.warning('Postgres 11 or later is needed to hash partition queries, left as is')
+    elif is_partitioned(op.get_bind()):
+        # a run that failed after the swap
+        logger.info('queries is hash partitioned already')
+    else:
+        # writes go on during the copy: the trigger mirrors them
+        with online_connection() as conn:
+            partition(conn, count)
+
+    # myADS notifications also keep the qid of their query: unlike the id,
+    # a lookup by qid only touches one partition. In alembic's transaction,
+    # which keeps its locks until the revision is done, so after the copy
+    op.add_column('myads', sa.Column('query_qid', sa.String(length=32), nullable=True))
+    op.execute('UPDATE myads SET query_qid = q.qid FROM queries q WHERE q.id = myads.query_id')
+
+
+def downgrade():
+    if is_partitioned(op.get_bind()):
+        with online_connection() as conn:
+            unpartition(conn)
+    op.drop_column('myads', 'query_qid')
@@ -0,0 +1,40 @@
+"""Track when queries.numfound was last refreshed
+
+Revision ID: b3d9e1f7c2a8
+Revises: e5b8d3f0a6c1
+Create Date: 2026-10-18 17:40:21.559102
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b3d9e1f7c2a8'
+down_revision = 'e5b8d3f0a6c1'
+
+from alembic import op
+import sqlalchemy as sa
+from adsmutils import UTCDateTime
+
+
+def upgrade():
+    # nullable and without a default, so no table rewrite; existing rows
+    # stay NULL and are the first ones picked up by the refresher. It is
+    # there already when re-running after a failed index build
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('queries')]
+    if 'numfound_updated' not in columns:
+        op.add_column('queries', sa.Column('numfound_updated', UTCDateTime, nullable=True))
+
+    # the refresher walks the table oldest first (NULLS FIRST); the index is
+    # built without blocking writes, which only works outside of alembic's
+    # transaction (see 3a1f6c2b9d4e) - the new column is committed first
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_queries_numfound_updated')
+    op.execute('CREATE INDEX CONCURRENTLY ix_queries_numfound_updated '
+               'ON queries (numfound_updated NULLS FIRST, id)')
+    op.execute('BEGIN')
+
+
+def downgrade():
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_queries_numfound_updated')
+    op.execute('BEGIN')
+    op.drop_column('queries', 'numfound_updated')
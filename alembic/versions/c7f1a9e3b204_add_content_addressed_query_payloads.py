@@ -0,0 +1,43 @@
+"""Add content addressed query_payloads
+
+Revision ID: c7f1a9e3b204
+Revises: 8e2d4b7a1c95
+Create Date: 2026-10-18 14:05:31.882140
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c7f1a9e3b204'
+down_revision = '8e2d4b7a1c95'
+
+from alembic import op
+import sqlalchemy as sa
+from adsmutils import UTCDateTime
+
+
+def upgrade():
+    # existing rows keep their inline payload until scripts/fold_query_payloads.py
+    # folds them into query_payloads; reads handle both layouts
+    op.create_table('query_payloads',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('digest', sa.String(length=64), nullable=True),
+    sa.Column('query', sa.LargeBinary(), nullable=True),
+    sa.Column('bigquery_id', sa.Integer(), nullable=True),
+    sa.Column('created', UTCDateTime, nullable=True),
+    sa.ForeignKeyConstraint(['bigquery_id'], ['query_bigqueries.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_query_payloads_digest', 'query_payloads', ['digest'], unique=True)
+    op.add_column('queries', sa.Column('payload_id', sa.Integer(), sa.ForeignKey('query_payloads.id'), nullable=True))
+
+
+def downgrade():
+    # put the payloads back inline before dropping them
+    op.execute("""
+        UPDATE queries SET query = p.query, bigquery_id = p.bigquery_id
+        FROM query_payloads p
+        WHERE queries.payload_id = p.id
+        """)
+    op.drop_column('queries', 'payload_id')
+    op.drop_index('ix_query_payloads_digest', table_name='query_payloads')
+    op.drop_table('query_payloads')
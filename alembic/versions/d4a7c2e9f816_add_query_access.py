@@ -0,0 +1,31 @@
+"""Add query_access for tracking reads of stored queries
+
+Revision ID: d4a7c2e9f816
+Revises: b3d9e1f7c2a8
+Create Date: 2026-10-18 19:02:47.316604
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7c2e9f816'
+down_revision = 'b3d9e1f7c2a8'
+
+from alembic import op
+import sqlalchemy as sa
+from adsmutils import UTCDateTime
+
+
+def upgrade():
+    op.create_table('query_access',
+    sa.Column('qid', sa.String(length=32), nullable=False),
+    sa.Column('hits', sa.BigInteger(), nullable=False),
+    sa.Column('first_access', UTCDateTime, nullable=True),
+    sa.Column('last_access', UTCDateTime, nullable=True),
+    sa.PrimaryKeyConstraint('qid')
+    )
+    op.create_index('ix_query_access_last_access', 'query_access', ['last_access'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_query_access_last_access', table_name='query_access')
+    op.drop_table('query_access')
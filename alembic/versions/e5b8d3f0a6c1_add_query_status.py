@@ -0,0 +1,29 @@
+"""Add query status for deferred validation
+
+Revision ID: e5b8d3f0a6c1
+Revises: c7f1a9e3b204
+Create Date: 2026-10-18 15:12:07.413350
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8d3f0a6c1'
+down_revision = 'c7f1a9e3b204'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ENUM
+
+query_status = ENUM('pending', 'valid', 'invalid', name='query_status')
+
+
+def upgrade():
+    query_status.create(op.get_bind(), checkfirst=True)
+    # nullable and without a server default, so the column is added without
+    # rewriting the table; NULL is read as 'valid'
+    op.add_column('queries', sa.Column('status', query_status, nullable=True))
+
+
+def downgrade():
+    op.drop_column('queries', 'status')
+    query_status.drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,54 @@
+"""Add queries_archive for cold stored queries
+
+Revision ID: f1c8b5a3d297
+Revises: d4a7c2e9f816
+Create Date: 2026-10-18 20:31:09.804417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f1c8b5a3d297'
+down_revision = 'd4a7c2e9f816'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ENUM
+from adsmutils import UTCDateTime
+
+query_status = ENUM('pending', 'valid', 'invalid', name='query_status', create_type=False)
+
+
+def upgrade():
+    op.create_table('queries_archive',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('uid', sa.Integer(), nullable=True),
+    sa.Column('qid', sa.String(length=32), nullable=True),
+    sa.Column('created', UTCDateTime, nullable=True),
+    sa.Column('updated', UTCDateTime, nullable=True),
+    sa.Column('numfound', sa.Integer(), nullable=True),
+    sa.Column('numfound_updated', UTCDateTime, nullable=True),
+    sa.Column('status', query_status, nullable=True),
+    sa.Column('category', sa.String(length=255), nullable=True),
+    sa.Column('payload_id', sa.Integer(), nullable=True),
+    sa.Column('query', sa.LargeBinary(), nullable=True),
+    sa.Column('bigquery_id', sa.Integer(), nullable=True),
+    sa.Column('archived', UTCDateTime, nullable=True),
+    sa.ForeignKeyConstraint(['payload_id'], ['query_payloads.id'], ),
+    sa.ForeignKeyConstraint(['bigquery_id'], ['query_bigqueries.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_queries_archive_qid', 'queries_archive', ['qid'], unique=True)
+
+
+def downgrade():
+    # put the archived queries back first
+    op.execute("""
+        INSERT INTO queries (id, uid, qid, created, updated, numfound, numfound_updated, status,
+                             category, payload_id, query, bigquery_id)
+        SELECT id, uid, qid, created, updated, numfound, numfound_updated, status,
+               category, payload_id, query, bigquery_id
+        FROM queries_archive
+        ON CONFLICT (qid) DO NOTHING
+        """)
+    op.drop_index('ix_queries_archive_qid', table_name='queries_archive')
+    op.drop_table('queries_archive')
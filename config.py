@@ -17,6 +17,145 @@ VAULT_SOLR_BIGQUERY_ENDPOINT = API_ENDPOINT + '/v1/search/bigquery'
 
 USER_EMAIL_ADSWS_API_URL = API_ENDPOINT + '/v1/user/%s'
 
+# in-process cache of stored queries (per worker); payloads bigger than
+# MAX_ITEM_BYTES (i.e. huge bigqueries) are never cached locally
+VAULT_QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+VAULT_QUERY_CACHE_MAX_ITEM_BYTES = 4 * 1024 * 1024
+# optional shared tier, 'module:Class' implementing vault_service.cache.CacheBackend
+# e.g. 'vault_service.cache:RedisBackend' with {'url': 'redis://localhost:6379/0'}
+VAULT_QUERY_CACHE_BACKEND = None
+VAULT_QUERY_CACHE_BACKEND_OPTIONS = {}
+VAULT_QUERY_CACHE_SHARED_TTL = 7 * 24 * 3600 # seconds
+# numfound/status are changed by other processes (refresher, validator):
+# cached records older than this re-read them from the db
+VAULT_QUERY_CACHE_NUMFOUND_TTL = 300 # seconds
+
+# bigqueries are stored out of line, compressed with this codec ('zlib' or 'identity')
+VAULT_BIGQUERY_CODEC = 'zlib'
+# /execute_query passes the solr response on as it arrives (instead of
+# buffering it); bigger responses are refused/cut off
+VAULT_STREAM_SOLR_RESPONSES = True
+VAULT_SOLR_RESPONSE_CHUNK_BYTES = 64 * 1024
+VAULT_MAX_SOLR_RESPONSE_BYTES = 256 * 1024 * 1024
+# deep paging with cursorMark: the sort is completed with this unique key
+# tiebreaker; with Accept: application/x-ndjson all the results are streamed,
+# fetched this many rows at a time
+VAULT_SOLR_CURSOR_TIEBREAKER = 'id asc'
+VAULT_SOLR_CURSOR_ROWS = 1000
+
+# Cache-Control max-age of GET /query/<qid> (numfound may be refreshed) and
+# of GET /query/<qid>/payload (never changes)
+VAULT_QUERY_MAX_AGE = 300
+VAULT_QUERY_PAYLOAD_MAX_AGE = 365 * 24 * 3600
+
+# /execute_query responses are cached for this many seconds (0 = disabled),
+# per qid, parameters and credentials; they come with an ETag
+VAULT_RESULT_CACHE_TTL = 0
+VAULT_RESULT_CACHE_MAX_BYTES = 128 * 1024 * 1024
+VAULT_RESULT_CACHE_MAX_ITEM_BYTES = 8 * 1024 * 1024
+
+# rendered query2svg badges: fresh for TTL seconds, then served stale for up
+# to STALE_TTL more while re-rendered; unknown qids are remembered for
+# NEGATIVE_TTL seconds (TTL 0 disables the cache)
+VAULT_BADGE_TTL = 3600
+VAULT_BADGE_STALE_TTL = 24 * 3600
+VAULT_BADGE_NEGATIVE_TTL = 60
+VAULT_BADGE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# rules that bring a query into the canonical form its qid is computed from
+# (see vault_service/views/canonical.py; 0 = the original cleanup only); sorting
+# and deduplicating the bigquery lines is opt-in
+VAULT_CANONICAL_VERSION = 1
+VAULT_CANONICAL_SORT_BIGQUERY = False
+
+# POST /query bodies above this size are refused (413); a bigquery can also
+# be streamed as the raw body (content type big-query/csv)
+VAULT_MAX_QUERY_BYTES = 64 * 1024 * 1024
+
+# when True, POST /query hands out the qid right away (status 'pending') and
+# solr validates the query in the background; numFound is filled in later
+VAULT_DEFERRED_VALIDATION = False
+VAULT_VALIDATION_WORKERS = 4
+VAULT_VALIDATION_RETRIES = 3
+VAULT_VALIDATION_BACKOFF = 1.0 # seconds, doubled on every retry
+VAULT_VALIDATION_QUEUE_SIZE = 1000 # per worker; beyond it queries wait for the refresher
+
+# reads of stored queries are counted per qid (query_access, for
+# scripts/hot_queries.py and the archival); the counts are kept in the worker
+# and written out every FLUSH_INTERVAL seconds, or once MAX_PENDING qids wait
+VAULT_ACCESS_TRACKING = True
+VAULT_ACCESS_FLUSH_INTERVAL = 60.0
+VAULT_ACCESS_MAX_PENDING = 10000
+
+# bloom filter of the stored qids, so that GET /query/<qid> and /query2svg
+# answer 404 for unknown ones without a database lookup. Each worker builds
+# its own (about 1.8 bytes per qid at a 0.001 error rate) and rebuilds it every
+# REBUILD_INTERVAL seconds; it picks up the qids stored by other workers every
+# SYNC_INTERVAL seconds, and reports them missing until then
+VAULT_QID_FILTER = False
+VAULT_QID_FILTER_ERROR_RATE = 0.001
+VAULT_QID_FILTER_REBUILD_INTERVAL = 86400.0
+VAULT_QID_FILTER_SYNC_INTERVAL = 1.0
+
+# POST /queries: max number of queries per request, and of concurrent solr
+# validations per request
+VAULT_BATCH_MAX_QUERIES = 100
+VAULT_BATCH_VALIDATION_WORKERS = 8
+# GET /queries: max number of qids resolved per request
+VAULT_BATCH_MAX_QIDS = 500
+
+# scripts/refresh_numfound.py: queries per batch (and UPDATE), concurrent
+# solr requests, the max rate of solr requests (per second), and how old
+# numfound has to be before it is refreshed (seconds)
+VAULT_REFRESH_BATCH_SIZE = 500
+VAULT_REFRESH_WORKERS = 8
+VAULT_REFRESH_RATE = 50.0
+VAULT_REFRESH_MAX_AGE = 7 * 24 * 3600
+VAULT_REFRESH_PENDING_AGE = 300 # pending queries older than this are validated first
+
+# outgoing http requests (app.client, see vault_service/client.py); every
+# upstream has its own connection pool, mounted on the urls of its endpoints
+# (config names), and falls back to VAULT_HTTP_DEFAULTS for what it does not
+# set. Timeouts are in seconds; only idempotent requests are retried (on
+# connection errors and the retry_statuses)
+VAULT_HTTP_DEFAULTS = {
+    'pool_connections': 10,
+    'pool_maxsize': 10,
+    'pool_timeout': 5.0,
+    'connect_timeout': 3.05,
+    'read_timeout': 60.0,
+    'keepalive': True,
+    'retries': 2,
+    'backoff': 0.2,
+    'jitter': 0.5,
+    'retry_statuses': (502, 503, 504),
+}
+VAULT_HTTP_UPSTREAMS = {
+    'solr': {'endpoints': ['VAULT_SOLR_QUERY_ENDPOINT', 'VAULT_SOLR_BIGQUERY_ENDPOINT'],
+             'pool_maxsize': 32, 'read_timeout': 120.0},
+    'harbour': {'endpoints': ['HARBOUR_MYADS_IMPORT_ENDPOINT'],
+                'pool_maxsize': 4, 'read_timeout': 300.0},
+}
+
+# solr circuit breaker: after this many consecutive failures (5xx, timeouts,
+# connection errors; 0 disables it) solr is not asked for RESET seconds, then
+# PROBES requests test the water. In the meantime POST /query (and /queries)
+# store new queries as 'pending' for the background validator ('defer'), or
+# refuse them ('fail'); everything else that needs solr gets a 503
+VAULT_SOLR_BREAKER_FAILURES = 5
+VAULT_SOLR_BREAKER_RESET = 30.0
+VAULT_SOLR_BREAKER_PROBES = 1
+VAULT_SOLR_BREAKER_FALLBACK = 'defer'
+
+# hedged validations: when solr has not answered a validation within the
+# PERCENTILE of the recent latencies (clamped to MIN/MAX_DELAY seconds), the
+# same request is sent again and the first answer wins
+VAULT_SOLR_HEDGE = False
+VAULT_SOLR_HEDGE_PERCENTILE = 95
+VAULT_SOLR_HEDGE_MIN_DELAY = 0.05
+VAULT_SOLR_HEDGE_MAX_DELAY = 5.0
+VAULT_SOLR_HEDGE_WORKERS = 16
+
 # alembic will
 use_flask_db_url = True
 
@@ -0,0 +1,122 @@
+"""
+Moves cold stored queries out of `queries` into `queries_archive`: the ones
+not read for the given number of days (see query_access) and not used by any
+myADS notification. Reads of an archived qid move it back transparently.
+
+    python scripts/archive_queries.py -d 365 [-b 1000] [--vacuum] [--dry-run]
+
+The size of the queries table and of its indexes, and the latency of qid
+lookups, are measured before and after. Deleted rows only give their space
+back after a VACUUM (--vacuum); the indexes shrink once they are rebuilt
+(REINDEX, or pg_repack). Reads are only counted since query_access exists,
+so the script refuses to archive anything before it has been collecting
+for the given number of days (unless --force).
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from adsmutils import get_date
+from flask import current_app
+from sqlalchemy import text
+from vault_service import app
+from vault_service.views.utils import archive_queries
+
+# a partitioned queries (see alembic revision a9c4e7b2d158) has no storage
+# of its own; its size is that of its partitions
+SIZES_SQL = text("""
+    WITH parts AS (
+        SELECT CAST('queries' AS regclass) AS oid
+        UNION ALL
+        SELECT inhrelid FROM pg_inherits WHERE inhparent = CAST('queries' AS regclass)
+    )
+    SELECT (SELECT CAST(sum(pg_relation_size(oid)) AS bigint) FROM parts) AS queries,
+           (SELECT CAST(sum(pg_indexes_size(oid)) AS bigint) FROM parts) AS queries_indexes,
+           pg_total_relation_size('queries_archive') AS archive,
+           (SELECT count(*) FROM queries) AS rows
+    """)
+
+
+def measure(lookups=1000):
+    """Table/index sizes and the latency of qid lookups, over a sample of
+    the queries still in the table"""
+    with current_app.session_scope() as session:
+        sizes = dict(session.execute(SIZES_SQL).first().items())
+        qids = [r.qid for r in session.execute(text('SELECT qid FROM queries TABLESAMPLE SYSTEM (1) LIMIT :n'),
+                                               {'n': lookups})]
+        if len(qids) < lookups:
+            qids = [r.qid for r in session.execute(text('SELECT qid FROM queries ORDER BY random() LIMIT :n'),
+                                                   {'n': lookups})]
+        timings = []
+        for qid in random.sample(qids, len(qids)):
+            start = time.perf_counter()
+            session.execute(text('SELECT id, numfound FROM queries WHERE qid = :qid'), {'qid': qid}).first()
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    sizes['lookup_p50_ms'] = timings[len(timings) // 2] * 1000 if timings else 0.
+    sizes['lookup_p95_ms'] = timings[int(len(timings) * 0.95)] * 1000 if timings else 0.
+    return sizes
+
+
+def vacuum():
+    with current_app.db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute('VACUUM ANALYZE queries')
+        conn.execute('VACUUM ANALYZE queries_archive')
+
+
+def archive(days, batch=1000, dry_run=False, force=False, do_vacuum=False):
+    cutoff = get_date() - datetime.timedelta(days=days)
+    with current_app.session_scope() as session:
+        since = session.execute(text('SELECT min(first_access) FROM query_access')).scalar()
+    if not force and (since is None or since > cutoff):
+        print('Reads have only been tracked since {0}; nothing is archived before {1} (use --force)'.format(
+            since, since + datetime.timedelta(days=days) if since else 'they are'))
+        return 0
+
+    before = measure()
+    moved = 0
+    last = 0
+    while last is not None:
+        with current_app.session_scope() as session:
+            rows = archive_queries(session, cutoff, batch=batch, after=last)
+            if dry_run:
+                session.rollback()
+            else:
+                session.commit()
+        last = max(r.id for r in rows) if rows else None
+        moved += len(rows)
+        current_app.logger.info('Progress: {0} queries archived{1}'.format(moved, ' [dry run]' if dry_run else ''))
+
+    if do_vacuum and not dry_run:
+        vacuum()
+    after = measure()
+
+    print('Queries archived: {0}{1}'.format(moved, ' [dry run]' if dry_run else ''))
+    for k in ('rows', 'queries', 'queries_indexes', 'archive', 'lookup_p50_ms', 'lookup_p95_ms'):
+        print('{0:>16}: {1:>14} -> {2:>14}'.format(k, round(before[k], 3), round(after[k], 3)))
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Archive stored queries nobody reads anymore.')
+    parser.add_argument('-d', '--days', dest='days', type=int, required=True,
+                        help='Archive queries not read for this many days')
+    parser.add_argument('-b', '--batch', dest='batch', type=int, default=1000,
+                        help='Number of queries moved per transaction')
+    parser.add_argument('--vacuum', dest='vacuum', action='store_true', default=False,
+                        help='VACUUM ANALYZE the tables afterwards')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                        help='Only report what would be archived')
+    parser.add_argument('--force', dest='force', action='store_true', default=False,
+                        help='Archive even if reads have not been tracked for long enough')
+
+    args = parser.parse_args()
+    with app.create_app().app_context():
+        archive(args.days, batch=args.batch, dry_run=args.dry_run, force=args.force, do_vacuum=args.vacuum)
@@ -0,0 +1,91 @@
+"""
+Compares the peak memory (and time) of reading a bigquery upload through the
+json path of POST /query (request.json, cleanup_payload, json.dumps for the
+qid and digest, compression) with the streaming path (raw big-query/csv
+body read by BigqueryIngest).
+
+Only the ingestion is measured - no solr, no database:
+
+    python scripts/bigquery_ingest_benchmark.py -s 1,10,50
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from vault_service import app
+from vault_service.views.utils import cleanup_payload, query_qid, payload_digest, compress_bigquery, \
+    BigqueryIngest
+
+HEADERS = {'X-Api-Uid': '1'}
+
+
+def bibcodes(megabytes):
+    lines = ['bibcode']
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        line = '{0}ApJ...{1:03d}..{2:03d}A'.format(random.randint(1900, 2020), random.randint(1, 999), random.randint(1, 999))
+        lines.append(line)
+        size += len(line) + 1
+    return '\n'.join(lines)
+
+
+def json_path(application, body):
+    with application.test_request_context('/query', method='POST', data=body, content_type='application/json'):
+        from flask import request
+        payload = cleanup_payload(request.json)
+        qid = query_qid(payload, HEADERS)
+        digest = payload_digest(json.dumps(payload).encode('utf8'))
+        blob = compress_bigquery(payload['bigquery'])
+        return qid, digest, len(blob['data'])
+
+
+def streaming_path(application, body):
+    with application.test_request_context('/query', method='POST', query_string={'q': '*:*', 'fq': '{!bitset}'},
+                                          data=body, content_type='big-query/csv'):
+        from flask import request
+        payload = cleanup_payload(request.args.to_dict(flat=False))
+        ingest = BigqueryIngest(payload, HEADERS['X-Api-Uid']).read_from(request.stream)
+        return ingest.qid, ingest.digest, len(ingest.blob['data'])
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, elapsed
+
+
+def run(sizes):
+    application = app.create_app()
+    print('{0:>8} {1:>10} {2:>14} {3:>10}'.format('MB', 'path', 'peak(MB)', 'time(s)'))
+    for size in sizes:
+        bigquery = bibcodes(size)
+        # the request bodies are built up front, they are not part of what is measured
+        bodies = {'json': json.dumps({'q': '*:*', 'fq': '{!bitset}', 'bigquery': bigquery}).encode('utf8'),
+                  'streaming': bigquery.encode('utf8')}
+        results = {}
+        for name, fn in (('json', json_path), ('streaming', streaming_path)):
+            result, peak, elapsed = measure(fn, application, bodies[name])
+            results[name] = result
+            print('{0:>8} {1:>10} {2:>14.1f} {3:>10.3f}'.format(size, name, peak / 1048576., elapsed))
+        assert results['json'][:2] == results['streaming'][:2], 'qid/digest mismatch'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark peak memory of bigquery ingestion.')
+    parser.add_argument('-s', '--sizes', dest='sizes', default='1,10,50',
+                        help='Comma separated bigquery sizes, in MB')
+
+    args = parser.parse_args()
+    run([int(x) for x in args.sizes.split(',')])
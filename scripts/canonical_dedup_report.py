@@ -0,0 +1,71 @@
+"""
+Reports how many more stored queries would share a payload (and so a qid,
+for the same user) under the canonicalization rules, on a random sample of
+the `queries` table:
+
+    python scripts/canonical_dedup_report.py [-n 100000] [-v 1] [--sort-bigquery]
+
+Nothing is written to the database.
+"""
+import argparse
+import json
+import os
+import sys
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from flask import current_app
+from sqlalchemy import func
+from vault_service import app
+from vault_service.views.canonical import canonicalize, CANONICAL_VERSION
+from vault_service.models import Query, QueryPayload
+from vault_service.views.utils import query_record, stored_query_json, payload_digest
+
+
+def report(sample=100000, version=CANONICAL_VERSION, sort_bigquery=False):
+    stats = {'rows': 0, 'skipped': 0, 'changed': 0}
+    before = set()
+    after = set()
+    with current_app.session_scope() as session:
+        rows = session.query(Query, QueryPayload) \
+            .outerjoin(QueryPayload, Query.payload_id == QueryPayload.id) \
+            .order_by(func.random()).limit(sample)
+        for row in rows:
+            stats['rows'] += 1
+            record = query_record(*row)
+            try:
+                payload = json.loads(stored_query_json(record))
+                canonical = canonicalize(payload, version=version, sort_bigquery=sort_bigquery)
+            except Exception:
+                stats['skipped'] += 1
+                continue
+            stored = payload_digest(json.dumps(payload).encode('utf8'))
+            digest = payload_digest(json.dumps(canonical).encode('utf8'))
+            before.add(stored)
+            after.add(digest)
+            stats['changed'] += stored != digest
+
+    examined = stats['rows'] - stats['skipped']
+    print('Rows sampled: {0}, skipped: {1}'.format(stats['rows'], stats['skipped']))
+    print('Payloads changed by canonicalization (v{0}): {1}'.format(version, stats['changed']))
+    print('Distinct payloads: {0} -> {1}'.format(len(before), len(after)))
+    if examined:
+        print('Duplicate rate: {0:.2%} -> {1:.2%}'.format(1 - len(before) / float(examined),
+                                                         1 - len(after) / float(examined)))
+    return stats, len(before), len(after)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the dedup gain of query canonicalization.')
+    parser.add_argument('-n', '--sample', dest='sample', type=int, default=100000,
+                        help='Number of random queries rows to look at')
+    parser.add_argument('-v', '--version', dest='version', type=int, default=CANONICAL_VERSION,
+                        help='Canonicalization version to evaluate')
+    parser.add_argument('--sort-bigquery', dest='sort_bigquery', action='store_true', default=False,
+                        help='Also sort and deduplicate the bigquery lines')
+
+    args = parser.parse_args()
+    with app.create_app().app_context():
+        report(sample=args.sample, version=args.version, sort_bigquery=args.sort_bigquery)
@@ -0,0 +1,113 @@
+"""
+Compares /execute_query with the solr response buffered (the old r.text
+path) and streamed through (VAULT_STREAM_SOLR_RESPONSES): time to first
+byte, total time and the peak RSS of the worker.
+
+A fake solr serving a response of the requested size is started locally,
+and each mode runs in its own process so the peak RSS numbers do not mix.
+Point it at a scratch database (all tables are dropped and recreated):
+
+    python scripts/execute_query_benchmark.py -d postgresql://postgres@localhost/vault_bench -s 10,50,200
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+from werkzeug.serving import make_server
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+
+def fake_solr(megabytes):
+    doc = json.dumps({'bibcode': '2005JGRC..110.4002G', 'title': ['x' * 200]})
+    count = megabytes * 1024 * 1024 // (len(doc) + 1)
+    head = b'{"responseHeader": {"status": 0}, "response": {"numFound": %d, "start": 0, "docs": [' % count
+    tail = b']}}'
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(head) + count * (len(doc) + 1) - 1 + len(tail)))
+            self.end_headers()
+            self.wfile.write(head)
+            chunk = (doc + ',').encode('utf8')
+            for i in range(count):
+                self.wfile.write(chunk if i < count - 1 else chunk[:-1])
+            self.wfile.write(tail)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def child(db_uri, mode, megabytes):
+    """Runs one mode and prints ttfb, total time and peak RSS as json"""
+    from vault_service import app
+    from vault_service.models import Base, Query
+
+    solr = fake_solr(megabytes)
+    application = app.create_app(SQLALCHEMY_DATABASE_URI=db_uri,
+                                 VAULT_SOLR_QUERY_ENDPOINT='http://127.0.0.1:%d/solr' % solr.server_port,
+                                 VAULT_STREAM_SOLR_RESPONSES=(mode == 'streamed'),
+                                 VAULT_MAX_SOLR_RESPONSE_BYTES=None)
+    Base.metadata.drop_all(application.db.engine)
+    Base.metadata.create_all(application.db.engine)
+    with application.session_scope() as session:
+        session.add(Query(qid='BENCH', query=json.dumps({'query': 'q=*:*', 'bigquery': ''}).encode('utf8'), numfound=1))
+        session.commit()
+
+    server = make_server('127.0.0.1', 0, application, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    start = time.perf_counter()
+    r = requests.get('http://127.0.0.1:%d/execute_query/BENCH' % server.server_port,
+                     headers={'Authorization': 'secret'}, stream=True)
+    ttfb = None
+    size = 0
+    for chunk in r.iter_content(64 * 1024):
+        if ttfb is None:
+            ttfb = time.perf_counter() - start
+        size += len(chunk)
+    total = time.perf_counter() - start
+    Base.metadata.drop_all(application.db.engine)
+    print(json.dumps({'ttfb': ttfb, 'total': total, 'bytes': size,
+                      'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def run(db_uri, sizes):
+    print('{0:>6} {1:>10} {2:>10} {3:>10} {4:>14}'.format('MB', 'mode', 'ttfb(s)', 'total(s)', 'peak RSS(MB)'))
+    for size in sizes:
+        for mode in ('buffered', 'streamed'):
+            out = subprocess.check_output([sys.executable, __file__, '-d', db_uri, '--child', mode, str(size)])
+            result = json.loads(out.decode('utf8').strip().splitlines()[-1])
+            print('{0:>6} {1:>10} {2:>10.3f} {3:>10.3f} {4:>14.1f}'.format(
+                size, mode, result['ttfb'], result['total'], result['maxrss_kb'] / 1024.))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark buffered vs streamed /execute_query responses.')
+    parser.add_argument('-d', '--db', dest='db_uri', required=True,
+                        help='SQLAlchemy URI of a scratch database (all tables are dropped and recreated)')
+    parser.add_argument('-s', '--sizes', dest='sizes', default='10,50,200',
+                        help='Comma separated solr response sizes, in MB')
+    parser.add_argument('--child', dest='child', nargs=2, metavar=('MODE', 'MB'),
+                        help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.child:
+        child(args.db_uri, args.child[0], int(args.child[1]))
+    else:
+        run(args.db_uri, [int(x) for x in args.sizes.split(',')])
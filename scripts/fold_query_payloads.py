@@ -0,0 +1,141 @@
+"""
+Folds the payloads still stored inline in `queries` into the content
+addressed `query_payloads` table, so a query (or bibcode set) saved by many
+users is stored once. qids are left untouched and keep resolving.
+
+    python scripts/fold_query_payloads.py [-b 1000] [--dry-run]
+
+The script only looks at rows without a payload_id, so it can be stopped and
+re-run at any time. It reports how much payload data was folded away; the
+space itself goes back to the OS after a VACUUM FULL (or pg_repack).
+"""
+import argparse
+import json
+import os
+import sys
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from flask import current_app
+from sqlalchemy import text
+from vault_service import app
+from vault_service.models import Query, QueryPayload, QueryBigquery
+from vault_service.views.utils import payload_digest, store_payload, BigqueryReader
+
+TABLES = ('queries', 'query_payloads', 'query_bigqueries')
+
+
+# partitioned tables have no storage of their own, their partitions do
+RELATION_SIZE = text("""
+    SELECT CAST(sum(pg_total_relation_size(oid)) AS bigint) FROM (
+        SELECT CAST(:t AS regclass) AS oid
+        UNION ALL
+        SELECT inhrelid FROM pg_inherits WHERE inhparent = CAST(:t AS regclass)
+    ) AS parts
+    """)
+
+
+def relation_sizes(session):
+    return {t: session.execute(RELATION_SIZE, {'t': t}).scalar() for t in TABLES}
+
+
+def fold_batch(session, last, batch, stats):
+    """Folds the next batch of rows after id `last`; returns the last id
+    seen or None when there is nothing left"""
+    rows = session.query(Query, QueryBigquery) \
+        .outerjoin(QueryBigquery, Query.bigquery_id == QueryBigquery.id) \
+        .filter(Query.payload_id == None, Query.id > last) \
+        .order_by(Query.id).limit(batch).all()
+    if not rows:
+        return None
+
+    for q, bq in rows:
+        last = q.id
+        stats['rows'] += 1
+        try:
+            payload = json.loads(q.query.decode('utf8'))
+        except (AttributeError, ValueError):
+            current_app.logger.warning('Query {0} has no valid payload, left as is'.format(q.id))
+            stats['skipped'] += 1
+            continue
+
+        # the digest is taken over the payload as it was submitted
+        submitted = payload
+        if bq is not None:
+            submitted = dict(payload, bigquery=BigqueryReader(bq.codec, bq.size, bq.data).read().decode('utf8'))
+        digest = payload_digest(json.dumps(submitted).encode('utf8'))
+
+        payload_id = session.query(QueryPayload.id).filter_by(digest=digest).scalar()
+        orphan = None
+        if payload_id is None:
+            if bq is not None:
+                # first copy: it becomes the shared payload, the blob moves along
+                p = QueryPayload(digest=digest, query=q.query, bigquery_id=bq.id)
+                session.add(p)
+                session.flush()
+                payload_id = p.id
+            else:
+                payload_id = store_payload(session, submitted, digest)
+            stats['payloads'] += 1
+        else:
+            stats['folded'] += 1
+            stats['reclaimed_bytes'] += len(q.query) + (len(bq.data) if bq is not None else 0)
+            orphan = bq
+
+        q.payload_id = payload_id
+        q.query = None
+        q.bigquery_id = None
+        if orphan is not None:
+            session.flush()
+            session.delete(orphan)
+
+    session.flush()
+    return last
+
+
+def fold(batch=1000, dry_run=False):
+    stats = {'rows': 0, 'payloads': 0, 'folded': 0, 'skipped': 0, 'reclaimed_bytes': 0}
+    with current_app.session_scope() as session:
+        before = relation_sizes(session)
+
+    last = 0
+    if dry_run:
+        # one transaction, so duplicates are found across batches; rolled back at the end
+        with current_app.session_scope() as session:
+            while last is not None:
+                last = fold_batch(session, last, batch, stats)
+                current_app.logger.info('Progress: {0}'.format(stats))
+            session.rollback()
+    else:
+        while last is not None:
+            with current_app.session_scope() as session:
+                last = fold_batch(session, last, batch, stats)
+                session.commit()
+            current_app.logger.info('Progress: {0}'.format(stats))
+
+    with current_app.session_scope() as session:
+        after = relation_sizes(session)
+
+    print('Rows examined: {0}, skipped: {1}'.format(stats['rows'], stats['skipped']))
+    print('Distinct payloads created: {0}'.format(stats['payloads']))
+    print('Duplicate payloads folded: {0}'.format(stats['folded']))
+    print('Payload bytes reclaimed: {0} ({1:.1f} MB){2}'.format(stats['reclaimed_bytes'],
+                                                              stats['reclaimed_bytes'] / 1048576.,
+                                                              ' [dry run]' if dry_run else ''))
+    for t in TABLES:
+        print('{0:>20}: {1:>14} -> {2:>14} bytes on disk'.format(t, before[t], after[t]))
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fold duplicate query payloads into query_payloads.')
+    parser.add_argument('-b', '--batch', dest='batch', type=int, default=1000,
+                        help='Number of queries rows per transaction')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                        help='Only report what would be reclaimed')
+
+    args = parser.parse_args()
+    with app.create_app().app_context():
+        fold(batch=args.batch, dry_run=args.dry_run)
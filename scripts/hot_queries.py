@@ -0,0 +1,72 @@
+"""
+Reports how the stored queries are used, from the read counts collected in
+query_access (see VAULT_ACCESS_TRACKING): the most read qids, and how many
+queries were last read within each age bracket - the ones never read since
+tracking started, and not used by any myADS notification, are candidates
+for archival.
+
+    python scripts/hot_queries.py [-n 20] [-a 7,30,90,365]
+"""
+import argparse
+import os
+import sys
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from flask import current_app
+from sqlalchemy import text
+from vault_service import app
+from vault_service.models import QidKey
+
+HOT_SQL = text("""
+    SELECT a.qid, a.hits, a.last_access, q.numfound,
+           EXISTS (SELECT 1 FROM myads m WHERE m.query_id = q.id) AS myads
+    FROM query_access a
+    LEFT JOIN queries q ON q.qid = a.qid
+    ORDER BY a.hits DESC
+    LIMIT :limit
+    """).columns(qid=QidKey)
+
+AGE_SQL = text("""
+    SELECT count(*) AS queries,
+           count(*) FILTER (WHERE m.query_id IS NOT NULL) AS myads
+    FROM queries q
+    LEFT JOIN query_access a ON a.qid = q.qid
+    LEFT JOIN (SELECT DISTINCT query_id FROM myads) m ON m.query_id = q.id
+    WHERE (CAST(:newer AS integer) IS NULL OR a.last_access >= now() - make_interval(days => CAST(:newer AS integer)))
+      AND (CAST(:older AS integer) IS NULL OR a.last_access < now() - make_interval(days => CAST(:older AS integer)))
+      AND (CAST(:never AS boolean) = (a.qid IS NULL))
+    """)
+
+
+def report(limit=20, ages=(7, 30, 90, 365)):
+    with current_app.session_scope() as session:
+        print('{0:>34} {1:>12} {2:>26} {3:>12} {4:>6}'.format('qid', 'hits', 'last access', 'numfound', 'myads'))
+        for row in session.execute(HOT_SQL, {'limit': limit}):
+            print('{0:>34} {1:>12} {2:>26} {3:>12} {4:>6}'.format(
+                row.qid, row.hits, str(row.last_access), str(row.numfound), 'yes' if row.myads else ''))
+
+        print('')
+        print('{0:>20} {1:>14} {2:>14}'.format('last read', 'queries', 'with myads'))
+        brackets = [(None, ages[0], '< {0} days'.format(ages[0]))]
+        brackets += [(a, b, '{0}-{1} days'.format(a, b)) for a, b in zip(ages, ages[1:])]
+        brackets += [(ages[-1], None, '> {0} days'.format(ages[-1]))]
+        for older, newer, label in brackets:
+            row = session.execute(AGE_SQL, {'older': older, 'newer': newer, 'never': False}).first()
+            print('{0:>20} {1:>14} {2:>14}'.format(label, row.queries, row.myads))
+        row = session.execute(AGE_SQL, {'older': None, 'newer': None, 'never': True}).first()
+        print('{0:>20} {1:>14} {2:>14}'.format('never', row.queries, row.myads))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the most read and the unused stored queries.')
+    parser.add_argument('-n', '--top', dest='top', type=int, default=20,
+                        help='Number of most read qids to list')
+    parser.add_argument('-a', '--ages', dest='ages', default='7,30,90,365',
+                        help='Comma separated age brackets, in days')
+
+    args = parser.parse_args()
+    with app.create_app().app_context():
+        report(limit=args.top, ages=sorted(int(x) for x in args.ages.split(',')))
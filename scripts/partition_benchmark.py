@@ -0,0 +1,134 @@
+"""
+Compares concurrent inserts and qid lookups on a plain queries table and on
+one hash partitioned on the qid (see alembic revision a9c4e7b2d158).
+
+Point it at a scratch database (it creates, fills and drops `queries`):
+
+    python scripts/partition_benchmark.py -d postgresql://postgres@localhost/vault_bench \
+        [-r 1000000] [-p 8,16,32] [-t 16] [-s 30]
+
+Each thread stores new queries (the upsert of POST /query) a third of the
+time and looks an existing qid up otherwise. Needs Postgres 11 or later.
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+
+from sqlalchemy import bindparam, create_engine, text
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from vault_service.models import Base, Query, QueryPayload, QueryBigquery, QidKey
+
+FILL_SQL = text("""
+    INSERT INTO queries (uid, qid, numfound, category, query, created, updated)
+    SELECT i % 1000, decode(md5(i::text), 'hex'), i % 5000, '',
+           convert_to('{"query": "q=synthetic+' || i || '", "bigquery": ""}', 'UTF8'),
+           now(), now()
+    FROM generate_series(:start, :stop - 1) AS i
+    """)
+
+INSERT_SQL = text("""
+    INSERT INTO queries (uid, qid, numfound, category, query, created, updated)
+    VALUES (0, :qid, 0, '', :query, now(), now())
+    ON CONFLICT (qid) DO NOTHING
+    """).bindparams(bindparam('qid', type_=QidKey))
+
+LOOKUP_SQL = text('SELECT id, numfound, query FROM queries WHERE qid = :qid').bindparams(bindparam('qid', type_=QidKey))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.
+
+
+def create(engine, partitions):
+    Base.metadata.create_all(engine, tables=[QueryPayload.__table__, QueryBigquery.__table__])
+    Query.__table__.create(engine)
+    if not partitions:
+        return
+    # same layout as the migration: the plain table is only a template
+    engine.execute('ALTER TABLE queries RENAME TO queries_template')
+    engine.execute('ALTER INDEX ix_queries_qid RENAME TO ix_queries_template_qid')
+    engine.execute('CREATE TABLE queries (LIKE queries_template INCLUDING DEFAULTS) PARTITION BY HASH (qid)')
+    for i in range(partitions):
+        engine.execute('CREATE TABLE queries_p{0} PARTITION OF queries '
+                       'FOR VALUES WITH (MODULUS {1}, REMAINDER {0})'.format(i, partitions))
+    engine.execute('ALTER TABLE queries ADD PRIMARY KEY (id, qid)')
+    engine.execute('CREATE UNIQUE INDEX ix_queries_qid ON queries (qid)')
+
+
+def drop(engine):
+    engine.execute('DROP TABLE IF EXISTS queries')
+    engine.execute('DROP TABLE IF EXISTS queries_template')
+
+
+def worker(engine, rows, seconds, offset, results):
+    inserts, lookups = [], []
+    rnd = random.Random(offset)
+    next_id = rows + offset * 10000000
+    deadline = time.time() + seconds
+    with engine.connect() as conn:
+        while time.time() < deadline:
+            if rnd.random() < 1. / 3:
+                qid = hashlib.md5(str(next_id).encode('utf8')).hexdigest()
+                next_id += 1
+                start = time.perf_counter()
+                conn.execute(INSERT_SQL, qid=qid, query=b'{"query": "q=new", "bigquery": ""}')
+                inserts.append((time.perf_counter() - start) * 1000.)
+            else:
+                qid = hashlib.md5(str(rnd.randrange(rows)).encode('utf8')).hexdigest()
+                start = time.perf_counter()
+                conn.execute(LOOKUP_SQL, qid=qid).fetchone()
+                lookups.append((time.perf_counter() - start) * 1000.)
+    results.append((inserts, lookups))
+
+
+def run(db_uri, rows, partitions, threads=16, seconds=30):
+    engine = create_engine(db_uri, pool_size=threads, max_overflow=0)
+    print('{0:>12} {1:>8} {2:>12} {3:>10} {4:>10} {5:>12} {6:>10} {7:>10}'.format(
+        'partitions', 'threads', 'inserts/s', 'p50(ms)', 'p95(ms)', 'lookups/s', 'p50(ms)', 'p95(ms)'))
+    for count in [0] + partitions:
+        drop(engine)
+        create(engine, count)
+        for start in range(0, rows, 100000):
+            engine.execute(FILL_SQL, start=start, stop=min(rows, start + 100000))
+        engine.execute('ANALYZE queries')
+
+        results = []
+        pool = [threading.Thread(target=worker, args=(engine, rows, seconds, i, results)) for i in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        inserts = [x for r in results for x in r[0]]
+        lookups = [x for r in results for x in r[1]]
+        print('{0:>12} {1:>8} {2:>12.0f} {3:>10.3f} {4:>10.3f} {5:>12.0f} {6:>10.3f} {7:>10.3f}'.format(
+            count or 'none', threads,
+            len(inserts) / float(seconds), percentile(inserts, 0.5), percentile(inserts, 0.95),
+            len(lookups) / float(seconds), percentile(lookups, 0.5), percentile(lookups, 0.95)))
+    drop(engine)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark a plain against a hash partitioned queries table.')
+    parser.add_argument('-d', '--db', dest='db_uri', required=True,
+                        help='SQLAlchemy URI of a scratch database (the queries table is dropped and recreated)')
+    parser.add_argument('-r', '--rows', dest='rows', type=int, default=1000000,
+                        help='Number of queries the table is filled with first')
+    parser.add_argument('-p', '--partitions', dest='partitions', default='8,16,32',
+                        help='Comma separated partition counts to compare with the plain table')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=16,
+                        help='Number of concurrent clients')
+    parser.add_argument('-s', '--seconds', dest='seconds', type=int, default=30,
+                        help='How long each configuration is run for')
+
+    args = parser.parse_args()
+    run(args.db_uri, args.rows, [int(x) for x in args.partitions.split(',')],
+        threads=args.threads, seconds=args.seconds)
@@ -0,0 +1,75 @@
+"""
+Compares qids stored as 32 character hex strings with qids stored as the 16
+bytes of the digest (see alembic revision 5b7e0d2c9a64): the size of the
+table and of the unique qid index, and the latency of lookups by qid.
+
+Point it at a scratch database (it creates and drops two tables):
+
+    python scripts/qid_key_benchmark.py -d postgresql://postgres@localhost/vault_bench [-s 100000,1000000]
+"""
+import argparse
+import hashlib
+import random
+import time
+
+from sqlalchemy import create_engine, text
+
+LAYOUTS = {
+    'hex': ('varchar(32)', 'md5(i::text)', lambda qid: qid),
+    'binary': ('bytea', "decode(md5(i::text), 'hex')", bytes.fromhex),
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(db_uri, sizes, lookups=1000):
+    engine = create_engine(db_uri)
+    for name, (qid_type, _, _) in LAYOUTS.items():
+        engine.execute('DROP TABLE IF EXISTS qids_{0}'.format(name))
+        engine.execute('CREATE TABLE qids_{0} (id serial PRIMARY KEY, qid {1} NOT NULL, numfound integer)'.format(
+            name, qid_type))
+        engine.execute('CREATE UNIQUE INDEX ix_qids_{0}_qid ON qids_{0} (qid)'.format(name))
+
+    print('{0:>10} {1:>8} {2:>14} {3:>14} {4:>10} {5:>10}'.format(
+        'rows', 'qids', 'table(bytes)', 'index(bytes)', 'p50(ms)', 'p95(ms)'))
+    current = 0
+    for size in sizes:
+        for name, (qid_type, fill, convert) in LAYOUTS.items():
+            engine.execute(text("""
+                INSERT INTO qids_{0} (qid, numfound)
+                SELECT {1}, i % 5000 FROM generate_series(:start, :stop - 1) AS i
+                """.format(name, fill)), start=current, stop=size)
+            engine.execute('ANALYZE qids_{0}'.format(name))
+
+            with engine.connect() as conn:
+                table, index = conn.execute(
+                    "SELECT pg_relation_size('qids_{0}'), pg_relation_size('ix_qids_{0}_qid')".format(name)).first()
+                stmt = text('SELECT numfound FROM qids_{0} WHERE qid = :qid'.format(name))
+                timings = []
+                for _ in range(lookups):
+                    qid = convert(hashlib.md5(str(random.randrange(size)).encode('utf8')).hexdigest())
+                    start = time.perf_counter()
+                    conn.execute(stmt, qid=qid).fetchone()
+                    timings.append((time.perf_counter() - start) * 1000.)
+            print('{0:>10} {1:>8} {2:>14} {3:>14} {4:>10.3f} {5:>10.3f}'.format(
+                size, name, table, index, percentile(timings, 0.5), percentile(timings, 0.95)))
+        current = size
+
+    for name in LAYOUTS:
+        engine.execute('DROP TABLE qids_{0}'.format(name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark hex against binary qid keys.')
+    parser.add_argument('-d', '--db', dest='db_uri', required=True,
+                        help='SQLAlchemy URI of a scratch database')
+    parser.add_argument('-s', '--sizes', dest='sizes', default='100000,1000000,10000000',
+                        help='Comma separated table sizes to measure at')
+    parser.add_argument('-n', '--lookups', dest='lookups', type=int, default=1000,
+                        help='Number of random lookups per size')
+
+    args = parser.parse_args()
+    run(args.db_uri, [int(x) for x in args.sizes.split(',')], lookups=args.lookups)
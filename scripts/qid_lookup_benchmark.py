@@ -0,0 +1,87 @@
+"""
+Measures qid lookup latency as the queries table grows.
+
+Point it at a scratch database (it creates and fills the `queries` table):
+
+    python scripts/qid_lookup_benchmark.py -d postgresql://postgres@localhost/vault_bench
+
+Use --no-index to get the sequential scan numbers for comparison.
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import bindparam, create_engine, text
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from vault_service.models import Query, QidKey
+
+FILL_SQL = text("""
+    INSERT INTO queries (uid, qid, numfound, category, query, created, updated)
+    SELECT i % 1000, decode(md5(i::text), 'hex'), i % 5000, '',
+           convert_to('{"query": "q=synthetic+' || i || '", "bigquery": ""}', 'UTF8'),
+           now(), now()
+    FROM generate_series(:start, :stop - 1) AS i
+    """)
+
+LOOKUPS = {
+    'numfound': text('SELECT numfound FROM queries WHERE qid = :qid').bindparams(bindparam('qid', type_=QidKey)),
+    'row': text('SELECT * FROM queries WHERE qid = :qid').bindparams(bindparam('qid', type_=QidKey)),
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(db_uri, sizes, lookups=1000, index=True):
+    engine = create_engine(db_uri)
+    Query.__table__.drop(engine, checkfirst=True)
+    Query.__table__.create(engine)
+    if not index:
+        engine.execute('DROP INDEX ix_queries_qid')
+
+    print('{0:>10} {1:>10} {2:>10} {3:>10} {4:>10}  {5}'.format('rows', 'lookup', 'mean(ms)', 'p50(ms)', 'p95(ms)', 'plan'))
+    current = 0
+    for size in sizes:
+        engine.execute(FILL_SQL, start=current, stop=size)
+        current = size
+        engine.execute('ANALYZE queries')
+
+        with engine.connect() as conn:
+            probe = hashlib.md5(str(random.randrange(size)).encode('utf8')).hexdigest()
+            plan = conn.execute(text('EXPLAIN ' + str(LOOKUPS['numfound'])), qid=probe).fetchone()[0]
+            for name, stmt in LOOKUPS.items():
+                timings = []
+                for _ in range(lookups):
+                    qid = hashlib.md5(str(random.randrange(size)).encode('utf8')).hexdigest()
+                    start = time.perf_counter()
+                    conn.execute(stmt, qid=qid).fetchone()
+                    timings.append((time.perf_counter() - start) * 1000.)
+                print('{0:>10} {1:>10} {2:>10.3f} {3:>10.3f} {4:>10.3f}  {5}'.format(
+                    size, name, sum(timings) / len(timings), percentile(timings, 0.5), percentile(timings, 0.95),
+                    plan.split('(')[0].strip()))
+
+    Query.__table__.drop(engine)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark qid lookups against a growing queries table.')
+    parser.add_argument('-d', '--db', dest='db_uri', required=True,
+                        help='SQLAlchemy URI of a scratch database (the queries table is dropped and recreated)')
+    parser.add_argument('-s', '--sizes', dest='sizes', default='10000,100000,1000000,10000000',
+                        help='Comma separated table sizes to measure at')
+    parser.add_argument('-n', '--lookups', dest='lookups', type=int, default=1000,
+                        help='Number of random lookups per size')
+    parser.add_argument('--no-index', dest='index', action='store_false', default=True,
+                        help='Drop ix_queries_qid to measure the sequential scan')
+
+    args = parser.parse_args()
+    run(args.db_uri, [int(x) for x in args.sizes.split(',')], lookups=args.lookups, index=args.index)
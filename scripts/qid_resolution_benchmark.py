@@ -0,0 +1,88 @@
+"""
+Compares resolving a list of qids one GET /query/<qid> at a time with a
+single GET /queries?qid=... request, through the flask test client (so the
+numbers include the view and serialization, but no network).
+
+Point it at a scratch database (all tables are dropped and recreated):
+
+    python scripts/qid_resolution_benchmark.py -d postgresql://postgres@localhost/vault_bench
+
+The query cache is cleared before every round, so both paths hit the db.
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import text
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from vault_service import app
+from vault_service.models import Base
+
+FILL_SQL = text("""
+    INSERT INTO queries (uid, qid, numfound, category, query, created, updated)
+    SELECT i % 1000, decode(md5(i::text), 'hex'), i % 5000, '',
+           convert_to('{"query": "q=synthetic+' || i || '", "bigquery": ""}', 'UTF8'),
+           now(), now()
+    FROM generate_series(0, :rows - 1) AS i
+    """)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(db_uri, rows, batch_sizes, rounds=50):
+    application = app.create_app(SQLALCHEMY_DATABASE_URI=db_uri)
+    engine = application.db.engine
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    engine.execute(FILL_SQL, rows=rows)
+    engine.execute('ANALYZE queries')
+
+    client = application.test_client()
+    headers = {'Authorization': 'secret'}
+    print('{0:>8} {1:>10} {2:>10} {3:>10} {4:>10}'.format('batch', 'path', 'mean(ms)', 'p50(ms)', 'p95(ms)'))
+    for size in batch_sizes:
+        timings = {'single': [], 'batch': []}
+        for _ in range(rounds):
+            qids = [hashlib.md5(str(random.randrange(rows)).encode('utf8')).hexdigest() for _ in range(size)]
+
+            application.query_cache.clear()
+            start = time.perf_counter()
+            for qid in qids:
+                assert client.get('/query/' + qid, headers=headers).status_code == 200
+            timings['single'].append((time.perf_counter() - start) * 1000.)
+
+            application.query_cache.clear()
+            start = time.perf_counter()
+            assert client.get('/queries', query_string={'qid': ','.join(qids)}, headers=headers).status_code == 200
+            timings['batch'].append((time.perf_counter() - start) * 1000.)
+
+        for name, values in timings.items():
+            print('{0:>8} {1:>10} {2:>10.3f} {3:>10.3f} {4:>10.3f}'.format(
+                size, name, sum(values) / len(values), percentile(values, 0.5), percentile(values, 0.95)))
+
+    Base.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark batch qid resolution against the single item endpoint.')
+    parser.add_argument('-d', '--db', dest='db_uri', required=True,
+                        help='SQLAlchemy URI of a scratch database (all tables are dropped and recreated)')
+    parser.add_argument('-r', '--rows', dest='rows', type=int, default=100000,
+                        help='Number of stored queries')
+    parser.add_argument('-s', '--sizes', dest='sizes', default='1,10,50,100,500',
+                        help='Comma separated numbers of qids per request')
+    parser.add_argument('-n', '--rounds', dest='rounds', type=int, default=50,
+                        help='Number of rounds per batch size')
+
+    args = parser.parse_args()
+    run(args.db_uri, args.rows, [int(x) for x in args.sizes.split(',')], rounds=args.rounds)
@@ -0,0 +1,74 @@
+"""
+Measures query2svg throughput (requests/sec, through the flask test client)
+with the badge cache disabled and enabled, over a set of stored qids with a
+share of unknown ones.
+
+Point it at a scratch database (all tables are dropped and recreated):
+
+    python scripts/query2svg_benchmark.py -d postgresql://postgres@localhost/vault_bench
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import text
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from vault_service import app
+from vault_service.models import Base
+
+FILL_SQL = text("""
+    INSERT INTO queries (uid, qid, numfound, category, query, created, updated)
+    SELECT i % 1000, decode(md5(i::text), 'hex'), i % 5000, '',
+           convert_to('{"query": "q=synthetic+' || i || '", "bigquery": ""}', 'UTF8'),
+           now(), now()
+    FROM generate_series(0, :rows - 1) AS i
+    """)
+
+
+def run(db_uri, rows, qids, requests, unknown):
+    print('{0:>10} {1:>12} {2:>10}'.format('cache', 'req/s', 'hit ratio'))
+    for ttl in (0, 3600):
+        application = app.create_app(SQLALCHEMY_DATABASE_URI=db_uri, VAULT_BADGE_TTL=ttl)
+        engine = application.db.engine
+        if ttl == 0:
+            Base.metadata.drop_all(engine)
+            Base.metadata.create_all(engine)
+            engine.execute(FILL_SQL, rows=rows)
+            engine.execute('ANALYZE queries')
+
+        # a hot set of badges, as embedded in popular pages
+        hot = [hashlib.md5(str(random.randrange(rows)).encode('utf8')).hexdigest() for _ in range(qids)]
+        hot += ['unknown%d' % i for i in range(int(qids * unknown))]
+        client = application.test_client()
+        start = time.perf_counter()
+        for _ in range(requests):
+            client.get('/query2svg/' + random.choice(hot))
+        elapsed = time.perf_counter() - start
+        print('{0:>10} {1:>12.1f} {2:>10.2f}'.format('on' if ttl else 'off', requests / elapsed,
+                                                     application.badge_cache.stats()['hit_ratio']))
+
+    Base.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark query2svg with and without the badge cache.')
+    parser.add_argument('-d', '--db', dest='db_uri', required=True,
+                        help='SQLAlchemy URI of a scratch database (all tables are dropped and recreated)')
+    parser.add_argument('-r', '--rows', dest='rows', type=int, default=100000,
+                        help='Number of stored queries')
+    parser.add_argument('-q', '--qids', dest='qids', type=int, default=1000,
+                        help='Number of distinct badges requested')
+    parser.add_argument('-n', '--requests', dest='requests', type=int, default=20000,
+                        help='Number of requests per run')
+    parser.add_argument('-u', '--unknown', dest='unknown', type=float, default=0.1,
+                        help='Share of unknown qids among the requested ones')
+
+    args = parser.parse_args()
+    run(args.db_uri, args.rows, args.qids, args.requests, args.unknown)
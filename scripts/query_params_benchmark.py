@@ -0,0 +1,64 @@
+"""
+Measures what keeping the parsed query string of stored payloads
+(query_payloads.params) saves per request, against parsing it every time:
+
+ * cached record (execute_query, myADS): urlparse.parse_qs() of the query
+   string against copying the already parsed dict
+ * cache miss: decoding the payload JSON and parsing the query string
+   against decoding the payload and the params JSON (what psycopg2 does
+   with a JSONB column)
+
+    python scripts/query_params_benchmark.py [-n 100000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import urllib.parse as urlparse
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from vault_service.views.utils import serialize_dict
+
+QUERIES = {
+    'simple': {'q': ['star'], 'sort': ['date desc']},
+    'myads': {'q': ['author:"Accomazzi, A." year:2015-2020 property:refereed'],
+              'fq': ['{!type=aqp v=$fq_database}'], 'fq_database': ['(database:astronomy OR database:physics)'],
+              'sort': ['citation_count desc, bibcode desc']},
+    'bigquery': {'q': ['*:*'], 'fq': ['{!bitset}', 'year:[2000 TO 2020]', 'property:refereed'],
+                 'sort': ['date desc, bibcode desc']},
+}
+
+
+def run(number):
+    print('{0:>10} {1:>22} {2:>12} {3:>12} {4:>8}'.format('query', 'path', 'before(us)', 'after(us)', 'saved'))
+    for name, params in QUERIES.items():
+        query = serialize_dict(params)
+        stored = json.dumps({'query': query, 'bigquery': ''})
+        parsed = urlparse.parse_qs(query)
+        column = json.dumps(parsed)
+        payload = json.loads(stored)
+
+        cases = {
+            'cached record': (lambda: urlparse.parse_qs(payload['query']),
+                              lambda: {k: list(v) for k, v in parsed.items()}),
+            'cache miss': (lambda: urlparse.parse_qs(json.loads(stored)['query']),
+                           lambda: (json.loads(stored), json.loads(column))),
+        }
+        for path, (before, after) in cases.items():
+            t0 = timeit.timeit(before, number=number) / number * 1e6
+            t1 = timeit.timeit(after, number=number) / number * 1e6
+            print('{0:>10} {1:>22} {2:>12.2f} {3:>12.2f} {4:>7.0f}%'.format(
+                name, path, t0, t1, 100. * (t0 - t1) / t0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark parsing stored query strings against pre-parsed params.')
+    parser.add_argument('-n', '--number', dest='number', type=int, default=100000,
+                        help='Iterations per measurement')
+
+    args = parser.parse_args()
+    run(args.number)
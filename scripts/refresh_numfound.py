@@ -0,0 +1,57 @@
+"""
+Refreshes the numFound of the stored queries, least recently refreshed
+first, so query2svg badges and GET /query responses do not go stale.
+Queries are re-run through solr in batches (VAULT_REFRESH_* in config.py)
+and each batch is written back with a single UPDATE.
+
+    python scripts/refresh_numfound.py [-b 500] [-w 8] [-r 50] [-a 604800] [-p 300] [-n 10]
+
+Meant to run from cron; a run stops once no query older than the max age
+(VAULT_REFRESH_MAX_AGE) is left, so it can be interrupted and re-run at any
+time. Queries left pending by the deferred validation (for longer than
+VAULT_REFRESH_PENDING_AGE) are validated first.
+"""
+import argparse
+import os
+import sys
+
+opath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if opath not in sys.path:
+    sys.path.insert(0, opath)
+
+from vault_service import app
+from vault_service.refresher import NumfoundRefresher
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh numFound of the stored queries.')
+    parser.add_argument('-b', '--batch', dest='batch', type=int, default=None,
+                        help='Number of queries per batch (VAULT_REFRESH_BATCH_SIZE)')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=None,
+                        help='Number of concurrent solr requests (VAULT_REFRESH_WORKERS)')
+    parser.add_argument('-r', '--rate', dest='rate', type=float, default=None,
+                        help='Max solr requests per second, 0 for no limit (VAULT_REFRESH_RATE)')
+    parser.add_argument('-a', '--max-age', dest='max_age', type=int, default=None,
+                        help='Only refresh numFound older than this, in seconds (VAULT_REFRESH_MAX_AGE)')
+    parser.add_argument('-p', '--pending-age', dest='pending_age', type=int, default=None,
+                        help='Validate queries pending for longer than this, in seconds (VAULT_REFRESH_PENDING_AGE)')
+    parser.add_argument('-n', '--max-batches', dest='max_batches', type=int, default=None,
+                        help='Stop after this many batches')
+
+    args = parser.parse_args()
+    application = app.create_app()
+    config = application.config
+    refresher = NumfoundRefresher(
+        application,
+        batch_size=args.batch or config.get('VAULT_REFRESH_BATCH_SIZE', 500),
+        workers=args.workers or config.get('VAULT_REFRESH_WORKERS', 8),
+        rate=args.rate if args.rate is not None else config.get('VAULT_REFRESH_RATE', 50.0),
+        max_age=args.max_age if args.max_age is not None else config.get('VAULT_REFRESH_MAX_AGE', 604800),
+        pending_age=args.pending_age if args.pending_age is not None else config.get('VAULT_REFRESH_PENDING_AGE', 300))
+    stats = refresher.run(max_batches=args.max_batches)
+
+    print('Batches: {0}'.format(stats['batches']))
+    print('Queries refreshed: {0} ({1} with a new numFound)'.format(stats['refreshed'], stats['changed']))
+    print('Queries found invalid: {0}'.format(stats['invalid']))
+    print('Validations failed: {0}'.format(stats['failed']))
+    print('Throughput: {0:.1f} queries/s'.format(stats['throughput']))
@@ -0,0 +1,134 @@
+"""
+    vault_service.access
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Counts the reads of stored queries (GET /query, /execute_query,
+    /query2svg, ...) without writing to the database on every read: hits
+    and the time of the last one are accumulated per qid in the worker and
+    written out every `interval` seconds (or once `max_pending` qids are
+    waiting) with a single upsert into query_access.
+
+    scripts/hot_queries.py reports on what has been collected.
+"""
+import atexit
+import os
+import threading
+
+from adsmutils import get_date
+from sqlalchemy import exc, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+
+class AccessTracker(object):
+
+    def __init__(self, app, enabled=True, interval=60.0, max_pending=10000):
+        self.app = app
+        self.enabled = enabled
+        self.interval = interval
+        self.max_pending = max_pending
+        self.recorded = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.errors = 0
+        self.dropped = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def record(self, qid):
+        if not self.enabled or not qid:
+            return
+        now = get_date()
+        with self._lock:
+            entry = self._pending.get(qid)
+            if entry is None:
+                self._pending[qid] = [1, now, now]
+            else:
+                entry[0] += 1
+                entry[2] = now
+            self.recorded += 1
+            full = len(self._pending) >= self.max_pending
+        self._start()
+        if full:
+            self._wakeup.set()
+
+    def _start(self):
+        # the flusher is started in the worker, after the fork
+        if self.interval and (self._thread is None or self._pid != os.getpid()):
+            with self._lock:
+                if self._thread is not None and self._pid == os.getpid():
+                    return
+                if self._pid is not None:
+                    # forked; the parent writes out what it counted itself
+                    self._pending = {}
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name='vault-access-flusher')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes the pending counts with one upsert; returns the number of
+        qids written. On failure the counts are kept for the next flush"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        from .models import QueryAccess
+        table = QueryAccess.__table__
+        # in qid order, so concurrent flushes of other workers cannot deadlock
+        values = [{'qid': qid, 'hits': hits, 'first_access': first, 'last_access': last}
+                  for qid, (hits, first, last) in sorted(pending.items())]
+        stmt = pg_insert(table).values(values)
+        stmt = stmt.on_conflict_do_update(index_elements=['qid'], set_={
+            'hits': table.c.hits + stmt.excluded.hits,
+            'last_access': func.greatest(table.c.last_access, stmt.excluded.last_access)})
+        try:
+            with self.app.app_context():
+                with self.app.session_scope() as session:
+                    try:
+                        session.execute(stmt)
+                        session.commit()
+                    except exc.SQLAlchemyError:
+                        session.rollback()
+                        raise
+        except Exception as e:
+            self.errors += 1
+            self.app.logger.error('Could not write the access counts of {0} queries: {1}'.format(len(pending), e))
+            self._merge(pending)
+            return 0
+
+        self.flushes += 1
+        self.flushed += len(pending)
+        return len(pending)
+
+    def _merge(self, pending):
+        with self._lock:
+            for qid, (hits, first, last) in pending.items():
+                entry = self._pending.get(qid)
+                if entry is not None:
+                    entry[0] += hits
+                    entry[1] = first
+                elif len(self._pending) < self.max_pending * 2:
+                    self._pending[qid] = [hits, first, last]
+                else:
+                    # the database has been away for a while; don't grow without bounds
+                    self.dropped += hits
+
+    def stats(self):
+        return {'enabled': self.enabled,
+                'recorded': self.recorded,
+                'pending': len(self._pending),
+                'flushes': self.flushes,
+                'flushed': self.flushed,
+                'errors': self.errors,
+                'dropped': self.dropped}
@@ -1,4 +1,6 @@
 import logging.config
+import json
+import math
 
 from werkzeug.serving import run_simple
 import os, sys, inspect
@@ -41,6 +43,70 @@ def create_app(**config):
             conn.execute("BEGIN")
 
 
+    # pooled, per upstream, client for solr and harbour (VAULT_HTTP_*)
+    from .client import make_client
+    app.client = make_client(app.config)
+
+    # stored queries never change once written; keep the hot ones around
+    from .cache import make_query_cache, make_result_cache, make_badge_cache
+    app.query_cache = make_query_cache(app.config)
+    # and, if enabled, the solr responses to /execute_query for a little while
+    app.result_cache = make_result_cache(app.config)
+    # and the rendered query2svg badges
+    app.badge_cache = make_badge_cache(app.config)
+
+    # identical solr validations running at the same time share one request
+    from .singleflight import SingleFlight
+    app.solr_flight = SingleFlight()
+
+    # stops sending requests to a failing solr for a while, and re-sends
+    # slow validations (VAULT_SOLR_BREAKER_*, VAULT_SOLR_HEDGE_*)
+    from .breaker import CircuitBreaker, CircuitOpenError, Hedger
+    app.solr_breaker = CircuitBreaker('solr',
+                                      failures=app.config.get('VAULT_SOLR_BREAKER_FAILURES', 5),
+                                      reset_timeout=app.config.get('VAULT_SOLR_BREAKER_RESET', 30.0),
+                                      probes=app.config.get('VAULT_SOLR_BREAKER_PROBES', 1))
+    app.solr_hedger = Hedger(enabled=app.config.get('VAULT_SOLR_HEDGE', False),
+                             percentile=app.config.get('VAULT_SOLR_HEDGE_PERCENTILE', 95),
+                             min_delay=app.config.get('VAULT_SOLR_HEDGE_MIN_DELAY', 0.05),
+                             max_delay=app.config.get('VAULT_SOLR_HEDGE_MAX_DELAY', 5.0),
+                             workers=app.config.get('VAULT_SOLR_HEDGE_WORKERS', 16))
+
+    @app.errorhandler(CircuitOpenError)
+    def circuit_open(e):
+        return json.dumps({'msg': str(e)}), 503, {'Retry-After': str(int(math.ceil(e.retry_after)))}
+
+    # so is an upstream whose connections all stayed busy (VAULT_HTTP_*)
+    from .client import PoolSaturated
+
+    @app.errorhandler(PoolSaturated)
+    def pool_saturated(e):
+        return json.dumps({'msg': str(e)}), 503, {'Retry-After': str(int(math.ceil(e.retry_after)))}
+
+    # counts reads of stored queries, written out in batches (VAULT_ACCESS_*)
+    from .access import AccessTracker
+    app.access_tracker = AccessTracker(app,
+                                       enabled=app.config.get('VAULT_ACCESS_TRACKING', True),
+                                       interval=app.config.get('VAULT_ACCESS_FLUSH_INTERVAL', 60.0),
+                                       max_pending=app.config.get('VAULT_ACCESS_MAX_PENDING', 10000))
+
+    # answers 404 for qids that were never stored without a database
+    # round trip (VAULT_QID_FILTER*)
+    from .qid_filter import QidFilter
+    app.qid_filter = QidFilter(app,
+                               enabled=app.config.get('VAULT_QID_FILTER', False),
+                               error_rate=app.config.get('VAULT_QID_FILTER_ERROR_RATE', 0.001),
+                               rebuild_interval=app.config.get('VAULT_QID_FILTER_REBUILD_INTERVAL', 86400.0),
+                               sync_interval=app.config.get('VAULT_QID_FILTER_SYNC_INTERVAL', 1.0))
+
+    # validates queries stored in deferred mode (VAULT_DEFERRED_VALIDATION)
+    from .validation import QueryValidator
+    app.query_validator = QueryValidator(app,
+                                         workers=app.config.get('VAULT_VALIDATION_WORKERS', 4),
+                                         retries=app.config.get('VAULT_VALIDATION_RETRIES', 3),
+                                         backoff=app.config.get('VAULT_VALIDATION_BACKOFF', 1.0),
+                                         queue_size=app.config.get('VAULT_VALIDATION_QUEUE_SIZE', 1000))
+
     # Note about imports being here rather than at the top level
     # I want to enclose the import into the scope of the create_app()
     # and not advertise any of the views; and yes, i'm importing
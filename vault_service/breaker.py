@@ -0,0 +1,185 @@
+"""
+    vault_service.breaker
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Keeps the workers from waiting on an upstream that is down. After
+    `failures` consecutive failed calls the circuit opens and calls are
+    refused right away (CircuitOpenError); once `reset_timeout` seconds have
+    passed, up to `probes` calls are let through (half-open) - if they
+    succeed the circuit closes again, if one fails it opens for another
+    `reset_timeout`.
+
+    Hedger sends a second copy of a slow (idempotent) call once the first
+    has taken longer than the given percentile of the recent latencies;
+    whichever answers first wins.
+"""
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, name, retry_after):
+        super(CircuitOpenError, self).__init__('{0} is unavailable (circuit open)'.format(name))
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, failures=5, reset_timeout=30.0, probes=1):
+        self.name = name
+        self.threshold = failures
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self.total_failures = 0
+        self._opened_at = 0.
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.threshold)
+
+    def before(self):
+        """To be called before every call; raises CircuitOpenError when the
+        call must not be made. Every call let through has to be followed
+        by success(), failure() or cancel()"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == OPEN:
+                wait = self._opened_at + self.reset_timeout - time.time()
+                if wait > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, wait)
+                self.state = HALF_OPEN
+                self._probing = 0
+            if self.state == HALF_OPEN:
+                if self._probing >= self.probes:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.reset_timeout)
+                self._probing += 1
+
+    def success(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures = 0
+            if self.state == HALF_OPEN:
+                self._probing -= 1
+                if self._probing <= 0:
+                    self.state = CLOSED
+
+    def cancel(self):
+        """The call never reached the service (e.g. it was refused locally);
+        it counts neither way, but frees its probe when half open"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == HALF_OPEN and self._probing > 0:
+                self._probing -= 1
+
+    def failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self._opened_at = time.time()
+
+    def stats(self):
+        return {'enabled': self.enabled,
+                'state': self.state,
+                'failures': self.failures,
+                'total_failures': self.total_failures,
+                'opened': self.opened,
+                'rejected': self.rejected}
+
+
+class Hedger(object):
+
+    def __init__(self, enabled=False, percentile=95, min_delay=0.05, max_delay=5.0,
+                 min_samples=20, window=500, workers=16):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers) if enabled else None
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self):
+        """How long to wait for the first attempt before sending the second
+        one; None while there are too few latencies to tell"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        p = latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.))]
+        return min(max(p, self.min_delay), self.max_delay)
+
+    def do(self, fn, args, retry_args=None):
+        """Calls fn(*args) - and fn(*retry_args), if the first call is slow
+        (retry_args default to args; pass fresh copies of anything that can
+        only be consumed once). Returns the first result, or raises the
+        error if both calls failed"""
+        if not self.enabled:
+            return fn(*args)
+        self.calls += 1
+
+        def timed(*a):
+            start = time.time()
+            result = fn(*a)
+            self.record(time.time() - start)
+            return result
+
+        first = self._executor.submit(timed, *args)
+        delay = self.delay()
+        if delay is None:
+            return first.result()
+        try:
+            return first.result(timeout=delay)
+        except futures.TimeoutError:
+            pass
+
+        self.hedged += 1
+        second = self._executor.submit(timed, *(retry_args if retry_args is not None else args))
+        pending = set([first, second])
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            ok = [f for f in done if f.exception() is None]
+            if ok:
+                f = first if first in ok else second
+                if f is second:
+                    self.hedge_wins += 1
+                return f.result()
+        return first.result()
+
+    def stats(self):
+        return {'enabled': self.enabled,
+                'calls': self.calls,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'delay': self.delay()}
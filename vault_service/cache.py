@@ -0,0 +1,402 @@
+"""
+    vault_service.cache
+    ~~~~~~~~~~~~~~~~~~~
+
+    Caches for the (immutable) stored queries. There is a bounded,
+    in-process LRU in front of an optional shared tier; the shared tier is
+    anything implementing `CacheBackend` (`RedisBackend` is provided).
+
+    The results of executed queries are cached (for a short while) by the
+    `ResultCache`, and the rendered query2svg badges by the `BadgeCache`;
+    both are in-process LRUs as well.
+"""
+import json
+import threading
+import time
+import zlib
+from hashlib import sha256
+from collections import OrderedDict
+from importlib import import_module
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class CacheBackend(object):
+    """Interface of the shared (cross-worker) cache tier; values are bytes."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class RedisBackend(CacheBackend):
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='vault:'):
+        if redis is None:
+            raise Exception('RedisBackend needs the redis package to be installed')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class LRUCache(object):
+    """Thread-safe LRU bounded by the total (estimated) size of its values
+    in bytes; values larger than max_item_bytes are never stored."""
+
+    def __init__(self, max_bytes, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes or max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_item_bytes:
+            return False
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self._data),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes}
+
+
+def record_size(record):
+    """Rough memory footprint of a stored query record: the raw query
+    string plus its decoded and parsed copies dominate everything else"""
+    return 3 * len(record['query']) + 256
+
+
+class QueryCache(object):
+    """Read-through cache of stored query records, addressable both by qid
+    and by the integer id. The record lives under its qid only; the id entry
+    just points at the qid so large payloads are not accounted twice.
+
+    A record is a dict: {'id', 'qid', 'numfound', 'query', 'payload',
+    'params', 'bigquery_id'}, with 'query' the stored JSON string, 'payload'
+    its decoded form and 'params' the parsed query string. Compressed
+    bigquery blobs are cached separately.
+
+    Only the payload is immutable: numfound and status are changed by the
+    refresher and the validator, which run in other processes. A record
+    read from the database more than `numfound_ttl` seconds ago is not
+    returned anymore, unless asked for with stale=True (see load_query(),
+    which then just re-reads those two columns).
+    """
+
+    def __init__(self, local, shared=None, shared_ttl=None, numfound_ttl=None):
+        self.local = local
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self.numfound_ttl = numfound_ttl
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.expired = 0
+
+    def get(self, qid=None, query_id=None, stale=False):
+        entry = self._get(qid=qid, query_id=query_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        record, loaded = entry
+        if not stale and self.numfound_ttl and time.time() - loaded > self.numfound_ttl:
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return record
+
+    def _get(self, qid=None, query_id=None):
+        if qid is None:
+            qid = self.local.get('id:%s' % query_id)
+            if qid is None and self.shared is not None:
+                qid = self.shared.get('id:%s' % query_id)
+                qid = qid.decode('utf8') if qid is not None else None
+            if qid is None:
+                return None
+
+        entry = self.local.get('qid:%s' % qid)
+        if entry is None and self.shared is not None:
+            value = self.shared.get('qid:%s' % qid)
+            if value is None:
+                return None
+            self.shared_hits += 1
+            record = json.loads(value.decode('utf8'))
+            # as old as the database read that filled the shared tier
+            loaded = record.pop('loaded', 0)
+            record['payload'] = json.loads(record['query'])
+            entry = self._set_local(record, loaded)
+        return entry
+
+    def _set_local(self, record, loaded):
+        entry = (record, loaded)
+        self.local.set('qid:%s' % record['qid'], entry, record_size(record))
+        self.local.set('id:%s' % record['id'], record['qid'], 64)
+        return entry
+
+    def set(self, record):
+        """Keeps a record just read from the database"""
+        loaded = time.time()
+        self._set_local(record, loaded)
+        if self.shared is not None:
+            value = {k: v for k, v in record.items() if k != 'payload'}
+            value['loaded'] = loaded
+            self.shared.set('qid:%s' % record['qid'], json.dumps(value).encode('utf8'), ttl=self.shared_ttl)
+            self.shared.set('id:%s' % record['id'], record['qid'].encode('utf8'), ttl=self.shared_ttl)
+
+    def get_bigquery(self, bigquery_id):
+        return self.local.get('bq:%s' % bigquery_id)
+
+    def set_bigquery(self, bigquery_id, blob):
+        """Keeps a (codec, size, data) bigquery blob, still compressed;
+        this one is not shared between workers"""
+        self.local.set('bq:%s' % bigquery_id, blob, len(blob[2]) + 64)
+
+    def invalidate(self, qid=None, query_id=None):
+        for key in (qid is not None and 'qid:%s' % qid, query_id is not None and 'id:%s' % query_id):
+            if key:
+                self.local.delete(key)
+                if self.shared is not None:
+                    self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        local = self.local.stats()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'expired': self.expired,
+                'evictions': local['evictions'],
+                'items': local['items'],
+                'bytes': local['bytes'],
+                'max_bytes': local['max_bytes']}
+
+
+class ResultCache(object):
+    """Short lived cache of solr responses to /execute_query, keyed on the
+    qid, the final solr parameters and the credentials they were fetched
+    with (so nobody gets a response made for someone else). Entries expire
+    after `ttl` seconds; a ttl of 0 disables the cache.
+
+    Each entry carries an ETag, handed out when the response is first sent
+    so clients can revalidate with If-None-Match."""
+
+    def __init__(self, local, ttl=0):
+        self.local = local
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @property
+    def enabled(self):
+        return bool(self.ttl)
+
+    def key(self, qid, params, scope):
+        return sha256('\x00'.join((qid, params, scope)).encode('utf8')).hexdigest()
+
+    def etag(self, key):
+        return '{0}-{1:x}'.format(key[:16], int(time.time() * 1000))
+
+    def get(self, key):
+        """Returns (etag, content_type, body) or None"""
+        entry = self.local.get(key)
+        if entry is not None and entry[3] < time.time():
+            self.local.delete(key)
+            self.expired += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[:3]
+
+    def set(self, key, etag, content_type, body):
+        return self.local.set(key, (etag, content_type, body, time.time() + self.ttl), len(body) + 256)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        local = self.local.stats()
+        lookups = self.hits + self.misses
+        return {'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.,
+                'evictions': local['evictions'],
+                'items': local['items'],
+                'bytes': local['bytes'],
+                'max_bytes': local['max_bytes']}
+
+
+class BadgeCache(object):
+    """Rendered query2svg badges by qid. An entry is fresh for `ttl`
+    seconds, then served stale for up to `stale_ttl` more while it is
+    re-rendered in the background; unknown qids are remembered (as 404s)
+    for `negative_ttl` seconds. A ttl of 0 disables the cache."""
+
+    def __init__(self, local, ttl=0, stale_ttl=0, negative_ttl=0):
+        self.local = local
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.ttl)
+
+    def get(self, qid):
+        """Returns (entry, fresh) - entry being a dict with the 'status',
+        'etag' and 'body' of the badge - or (None, False)"""
+        entry = self.local.get(qid)
+        now = time.time()
+        if entry is None or entry['stale_until'] < now:
+            self.misses += 1
+            return None, False
+        if entry['fresh_until'] < now:
+            self.stale_hits += 1
+            return entry, False
+        self.hits += 1
+        return entry, True
+
+    def set(self, qid, status, body):
+        entry = {'status': status,
+                 'etag': '{0}-{1:08x}'.format(qid, zlib.crc32(body)),
+                 'body': body}
+        if self.enabled:
+            ttl = self.ttl if status == 200 else self.negative_ttl
+            entry['fresh_until'] = time.time() + ttl
+            entry['stale_until'] = entry['fresh_until'] + (self.stale_ttl if status == 200 else 0)
+            self.local.set(qid, entry, len(body) + len(qid) + 128)
+        return entry
+
+    def begin_refresh(self, qid):
+        """True if the caller should re-render the badge, i.e. nobody else
+        is doing it already; it has to call end_refresh() when done"""
+        with self._lock:
+            if qid in self._refreshing:
+                return False
+            self._refreshing.add(qid)
+            self.refreshes += 1
+            return True
+
+    def end_refresh(self, qid):
+        with self._lock:
+            self._refreshing.discard(qid)
+
+    def invalidate(self, qid):
+        self.local.delete(qid)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        local = self.local.stats()
+        lookups = self.hits + self.stale_hits + self.misses
+        return {'enabled': self.enabled,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'hit_ratio': float(self.hits + self.stale_hits) / lookups if lookups else 0.,
+                'evictions': local['evictions'],
+                'items': local['items'],
+                'bytes': local['bytes'],
+                'max_bytes': local['max_bytes']}
+
+
+def load_backend(path, **options):
+    """Instantiates a shared backend given as 'package.module:ClassName'"""
+    module, name = path.split(':')
+    return getattr(import_module(module), name)(**options)
+
+
+def make_query_cache(config):
+    shared = None
+    if config.get('VAULT_QUERY_CACHE_BACKEND'):
+        shared = load_backend(config['VAULT_QUERY_CACHE_BACKEND'],
+                              **config.get('VAULT_QUERY_CACHE_BACKEND_OPTIONS', {}))
+    local = LRUCache(config.get('VAULT_QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+                     max_item_bytes=config.get('VAULT_QUERY_CACHE_MAX_ITEM_BYTES'))
+    return QueryCache(local, shared=shared, shared_ttl=config.get('VAULT_QUERY_CACHE_SHARED_TTL'),
+                      numfound_ttl=config.get('VAULT_QUERY_CACHE_NUMFOUND_TTL'))
+
+
+def make_result_cache(config):
+    local = LRUCache(config.get('VAULT_RESULT_CACHE_MAX_BYTES', 128 * 1024 * 1024),
+                     max_item_bytes=config.get('VAULT_RESULT_CACHE_MAX_ITEM_BYTES'))
+    return ResultCache(local, ttl=config.get('VAULT_RESULT_CACHE_TTL', 0))
+
+
+def make_badge_cache(config):
+    local = LRUCache(config.get('VAULT_BADGE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+    return BadgeCache(local,
+                      ttl=config.get('VAULT_BADGE_TTL', 0),
+                      stale_ttl=config.get('VAULT_BADGE_STALE_TTL', 0),
+                      negative_ttl=config.get('VAULT_BADGE_NEGATIVE_TTL', 0))
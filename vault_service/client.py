@@ -0,0 +1,218 @@
+"""
+    vault_service.client
+    ~~~~~~~~~~~~~~~~~~~~
+
+    The HTTP client the service talks to its upstreams (solr, harbour)
+    with; it replaces the session adsmutils sets up as `app.client`.
+
+    Every upstream gets its own connection pool (see VAULT_HTTP_UPSTREAMS):
+    at most `pool_maxsize` requests are sent at a time, and connections are
+    kept alive in between - callers wait for their turn up to `pool_timeout`
+    seconds rather than piling onto the upstream. Requests get connect and read timeouts unless
+    the caller passes its own, and idempotent requests are retried a bounded
+    number of times, with jittered exponential backoff.
+"""
+import random
+import socket
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+
+DEFAULTS = {'pool_connections': 10,
+            'pool_maxsize': 10,
+            'pool_timeout': 5.0,
+            'connect_timeout': 3.05,
+            'read_timeout': 60.0,
+            'keepalive': True,
+            'retries': 2,
+            'backoff': 0.2,
+            'jitter': 0.5,
+            'retry_statuses': (502, 503, 504)}
+
+
+class PoolSaturated(requests.exceptions.ConnectionError):
+    """No connection of the pool became free within pool_timeout"""
+
+    def __init__(self, *args, **kwargs):
+        # seconds worth waiting before trying again
+        self.retry_after = kwargs.pop('retry_after', 1.0)
+        super(PoolSaturated, self).__init__(*args, **kwargs)
+
+
+class JitteredRetry(Retry):
+    """Exponential backoff, with each wait randomly scaled by up to
+    +/- jitter so that retrying workers do not hit the upstream in step"""
+
+    def __init__(self, *args, **kwargs):
+        self.jitter = kwargs.pop('jitter', 0.5)
+        self.on_retry = kwargs.pop('on_retry', None)
+        super(JitteredRetry, self).__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        kwargs.setdefault('jitter', self.jitter)
+        kwargs.setdefault('on_retry', self.on_retry)
+        return super(JitteredRetry, self).new(**kwargs)
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return backoff * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def increment(self, *args, **kwargs):
+        if self.on_retry is not None:
+            self.on_retry()
+        return super(JitteredRetry, self).increment(*args, **kwargs)
+
+
+def make_retry(retries, backoff, jitter, statuses, on_retry=None):
+    kwargs = {'total': retries, 'backoff_factor': backoff, 'status_forcelist': statuses,
+              'raise_on_status': False, 'respect_retry_after_header': True,
+              'jitter': jitter, 'on_retry': on_retry}
+    # only GET (and the like) is retried once the request has been sent;
+    # connection errors are retried for any method
+    methods = frozenset(['GET', 'HEAD', 'OPTIONS'])
+    try:
+        return JitteredRetry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return JitteredRetry(method_whitelist=methods, **kwargs)
+
+
+class UpstreamAdapter(HTTPAdapter):
+    """HTTPAdapter with a bounded number of requests in flight, default
+    timeouts and counters"""
+
+    def __init__(self, name, pool_connections=10, pool_maxsize=10, pool_timeout=5.0,
+                 connect_timeout=3.05, read_timeout=60.0, keepalive=True,
+                 retries=2, backoff=0.2, jitter=0.5, retry_statuses=(502, 503, 504)):
+        self.name = name
+        self.pool_timeout = pool_timeout
+        self.timeout = (connect_timeout, read_timeout)
+        self.keepalive = keepalive
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.waited = 0
+        self.wait_time = 0.
+        self.saturated = 0
+        self.retries = 0
+        self.errors = 0
+        self._slots = threading.BoundedSemaphore(pool_maxsize)
+        self._lock = threading.Lock()
+        # the requests themselves are bounded by _slots, which a streamed
+        # response holds (like its connection) until it is read or closed;
+        # so the pool always has a connection free and need not block
+        super(UpstreamAdapter, self).__init__(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=False,
+            max_retries=make_retry(retries, backoff, jitter, retry_statuses, on_retry=self._count_retry))
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + \
+                [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super(UpstreamAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            start = time.time()
+            acquired = self._slots.acquire(timeout=self.pool_timeout)
+            with self._lock:
+                self.waited += 1
+                self.wait_time += time.time() - start
+                if not acquired:
+                    self.saturated += 1
+            if not acquired:
+                raise PoolSaturated('All {0} connections to {1} are busy'.format(self._pool_maxsize, self.name),
+                                    request=request, retry_after=self.pool_timeout)
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        release = self._release_once()
+        try:
+            r = super(UpstreamAdapter, self).send(request, timeout=timeout or self.timeout, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            release()
+            raise
+        if not kwargs.get('stream') or r.raw is None:
+            release()
+            return r
+
+        # urllib3 hands the connection back once the body has been read,
+        # and Response.close() does too
+        release_conn = r.raw.release_conn
+
+        def release_with_conn():
+            try:
+                release_conn()
+            finally:
+                release()
+        r.raw.release_conn = release_with_conn
+        # a response that is dropped without being closed
+        weakref.finalize(r, release)
+        return r
+
+    def _release_once(self):
+        done = []
+
+        def release():
+            with self._lock:
+                if done:
+                    return
+                done.append(True)
+                self.in_flight -= 1
+            self._slots.release()
+        return release
+
+    def _count_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def stats(self):
+        return {'pool_maxsize': self._pool_maxsize,
+                'requests': self.requests,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'waited': self.waited,
+                'wait_time': self.wait_time,
+                'saturated': self.saturated,
+                'retries': self.retries,
+                'errors': self.errors}
+
+
+class Client(requests.Session):
+    """requests.Session with an UpstreamAdapter mounted per upstream"""
+
+    def __init__(self):
+        super(Client, self).__init__()
+        self.upstreams = {}
+
+    def add_upstream(self, name, prefixes, **options):
+        adapter = UpstreamAdapter(name, **options)
+        for prefix in prefixes:
+            self.mount(prefix, adapter)
+        self.upstreams[name] = adapter
+        return adapter
+
+    def stats(self):
+        return dict((name, adapter.stats()) for name, adapter in self.upstreams.items())
+
+
+def make_client(config):
+    """Builds the client out of VAULT_HTTP_DEFAULTS and VAULT_HTTP_UPSTREAMS;
+    an upstream is mounted on the (static part of the) urls of the
+    endpoints it lists, anything else goes through the 'default' upstream"""
+    defaults = dict(DEFAULTS, **config.get('VAULT_HTTP_DEFAULTS', {}))
+    client = Client()
+    client.add_upstream('default', ['http://', 'https://'], **defaults)
+    for name, upstream in config.get('VAULT_HTTP_UPSTREAMS', {}).items():
+        upstream = dict(upstream)
+        prefixes = [config[e].split('%')[0] for e in upstream.pop('endpoints', []) if config.get(e)]
+        client.add_upstream(name, prefixes, **dict(defaults, **upstream))
+    return client
@@ -5,6 +5,8 @@
 
     Models for the users (users) of AdsWS
 """
+import re
+
 from sqlalchemy import Column, Integer, String, LargeBinary, ForeignKey, Boolean, Text
 from sqlalchemy.dialects.postgresql import JSONB, ENUM, ARRAY
 from sqlalchemy.ext.declarative import declarative_base
@@ -18,6 +20,47 @@ Base = declarative_base()
 myads_type = ENUM('template', 'query', name='myads_type')
 myads_template = ENUM('arxiv', 'citations', 'authors', 'keyword', name='myads_template')
 myads_frequency = ENUM('daily', 'weekly', name='myads_frequency')
+query_status = ENUM('pending', 'valid', 'invalid', name='query_status')
+
+QID_RE = re.compile('^[0-9a-fA-F]{32}$')
+
+
+def qid_key(qid):
+    """The bytes a qid is stored as: the 16 bytes of the md5 digest it is
+    the hex form of. Anything else (hand made qids) is kept as its utf8
+    bytes, with a trailing NUL if that would make it 16 bytes long too"""
+    if qid is None:
+        return None
+    if QID_RE.match(qid):
+        return bytes.fromhex(qid)
+    key = qid.encode('utf8')
+    return key + b'\x00' if len(key) == 16 else key
+
+
+def key_qid(key):
+    """The qid stored as `key`, see qid_key()"""
+    if key is None:
+        return None
+    key = bytes(key)
+    if len(key) == 16:
+        return key.hex()
+    if len(key) == 17 and key.endswith(b'\x00'):
+        key = key[:-1]
+    return key.decode('utf8')
+
+
+class QidKey(sa.types.TypeDecorator):
+    """qids are hex strings everywhere in the code and the API, and stored
+    as bytea, at half the size in the table and in every index on them
+    (alembic revision 5b7e0d2c9a64)"""
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        return qid_key(value)
+
+    def process_result_value(self, value, dialect):
+        return key_qid(value)
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -33,14 +76,86 @@ class User(Base):
 class Query(Base):
     __tablename__ = 'queries'
 
+    # the table may be hash partitioned on the qid (alembic revision
+    # a9c4e7b2d158), in which case the primary key is (id, qid) and only
+    # lookups by qid are pruned to a single partition
     id = Column(Integer, primary_key=True)
     uid = Column(Integer, default=0)
-    qid = Column(String(32))
+    # every hot read path looks the query up by its qid; see alembic
+    # revision 3a1f6c2b9d4e for the (concurrently built) unique index
+    qid = Column(QidKey, index=True, unique=True)
     created = Column(UTCDateTime, default=get_date)
     updated = Column(UTCDateTime, default=get_date, onupdate=get_date)
     numfound = Column(Integer, default=0)
+    # when numfound was last (re)computed by solr; NULL for rows that predate
+    # scripts/refresh_numfound.py, which refreshes those first
+    numfound_updated = Column(UTCDateTime, nullable=True)
+    # NULL for rows stored before deferred validation existed, i.e. 'valid'
+    status = Column(query_status, nullable=True, default='valid')
+    category = Column(String(255), default='')
+    # the payload is shared by every qid with the same content; query and
+    # bigquery_id are only set on rows not yet folded into query_payloads
+    payload_id = Column(Integer, ForeignKey('query_payloads.id'), nullable=True)
+    query = Column(LargeBinary)
+    bigquery_id = Column(Integer, ForeignKey('query_bigqueries.id'), nullable=True)
+
+
+class QueryArchive(Base):
+    __tablename__ = 'queries_archive'
+
+    # queries rows nobody has read in a long while (and no myADS
+    # notification uses) are moved here by scripts/archive_queries.py, to
+    # keep queries and its indexes small; a read moves them back
+    id = Column(Integer, primary_key=True)
+    uid = Column(Integer, default=0)
+    qid = Column(QidKey, index=True, unique=True)
+    created = Column(UTCDateTime)
+    updated = Column(UTCDateTime)
+    numfound = Column(Integer, default=0)
+    numfound_updated = Column(UTCDateTime, nullable=True)
+    status = Column(query_status, nullable=True)
     category = Column(String(255), default='')
+    payload_id = Column(Integer, ForeignKey('query_payloads.id'), nullable=True)
+    query = Column(LargeBinary)
+    bigquery_id = Column(Integer, ForeignKey('query_bigqueries.id'), nullable=True)
+    archived = Column(UTCDateTime, default=get_date)
+
+
+class QueryPayload(Base):
+    __tablename__ = 'query_payloads'
+
+    id = Column(Integer, primary_key=True)
+    digest = Column(String(64), index=True, unique=True) # sha256 of the submitted payload JSON
+    # JSON of the payload; when there is a bigquery it is kept compressed
+    # in query_bigqueries and 'bigquery' is left empty here
     query = Column(LargeBinary)
+    # the query string of the payload as urlparse.parse_qs() returns it
+    # ({param: [values]}), so reads don't parse it again; NULL until
+    # backfilled by alembic revision 2d6f8a1c4e93
+    params = Column(JSONB, nullable=True)
+    bigquery_id = Column(Integer, ForeignKey('query_bigqueries.id'), nullable=True)
+    created = Column(UTCDateTime, default=get_date)
+
+
+class QueryAccess(Base):
+    __tablename__ = 'query_access'
+
+    # kept apart from queries, so that counting reads does not rewrite (and
+    # bloat) the big rows; written in batches by vault_service.access. No
+    # foreign key: the counts outlive archived queries
+    qid = Column(QidKey, primary_key=True)
+    hits = Column(sa.BigInteger, nullable=False, default=0)
+    first_access = Column(UTCDateTime)
+    last_access = Column(UTCDateTime, index=True)
+
+
+class QueryBigquery(Base):
+    __tablename__ = 'query_bigqueries'
+
+    id = Column(Integer, primary_key=True)
+    codec = Column(String(16), nullable=False, default='zlib')
+    size = Column(Integer) # uncompressed, in bytes
+    data = Column(LargeBinary)
 
 
 class Institute(Base):
@@ -76,7 +191,10 @@ class MyADS(Base):
     __tablename__ = 'myads'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
-    query_id = Column(Integer, ForeignKey('queries.id'), nullable=True)
+    # no foreign key once queries is partitioned; the setup is looked up by
+    # query_qid when it has one (set since alembic revision a9c4e7b2d158)
+    query_id = Column(Integer, nullable=True)
+    query_qid = Column(QidKey, nullable=True)
     type = Column(myads_type)
     name = Column(String)
     active = Column(Boolean)
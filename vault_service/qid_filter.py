@@ -0,0 +1,262 @@
+"""
+    vault_service.qid_filter
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A bloom filter over every stored qid (queries and queries_archive), so
+    that GET /query/<qid> and /query2svg can answer 404 for qids that were
+    never stored - crawlers, typos - without going to the database.
+
+    Each worker builds its own, in the background, with a streaming scan;
+    until it is ready every qid is let through. qids stored by the worker
+    are added right away; those stored by other workers are picked up by a
+    sync, every `sync_interval` seconds, of the rows with an id above the
+    highest one seen (less SYNC_OVERLAP). So the filter can be stale in two
+    ways, both answering 404 for a stored qid:
+
+    - a qid just stored by another worker, for up to `sync_interval`
+      seconds (plus the time the sync takes);
+    - one whose insert committed after SYNC_OVERLAP rows with higher ids
+      had (its transaction stayed open meanwhile), until the next rebuild.
+
+    The filter is rebuilt every `rebuild_interval` seconds, sized for the
+    number of qids at that point.
+"""
+import hashlib
+import math
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+from .models import qid_key
+
+# rows inserted by other workers may commit out of id order; the sync
+# looks this many ids back
+SYNC_OVERLAP = 100
+
+# the planner's estimate, without a scan. A partitioned table (alembic
+# revision a9c4e7b2d158) has none of its own, its partitions have; one that
+# was never analyzed has 0 (-1 since Postgres 14), and the filter is then
+# rebuilt as soon as it is full, with the number of qids it got
+ESTIMATE_SQL = text("""
+    WITH parts AS (
+        SELECT CAST('queries' AS regclass) AS oid
+        UNION ALL
+        SELECT CAST('queries_archive' AS regclass)
+        UNION ALL
+        SELECT inhrelid FROM pg_inherits
+        WHERE inhparent IN (CAST('queries' AS regclass), CAST('queries_archive' AS regclass))
+    )
+    SELECT COALESCE(sum(GREATEST(reltuples, 0)), 0) FROM pg_class
+    WHERE oid IN (SELECT oid FROM parts) AND relkind = 'r'
+    """)
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(int(capacity), 1000)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 64)
+        self.hashes = max(int(round(self.bits / float(capacity) * math.log(2))), 1)
+        self.items = 0
+        self._data = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        # md5 digests are uniformly distributed already; anything else is
+        # hashed first. Two halves, combined as in Kirsch & Mitzenmacher
+        if len(key) != 16:
+            key = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._data[p >> 3] |= 1 << (p & 7)
+        self.items += 1
+
+    def __contains__(self, key):
+        data = self._data
+        for p in self._positions(key):
+            if not data[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def nbytes(self):
+        return len(self._data)
+
+    def estimated_error_rate(self):
+        """From the share of bits set; goes above error_rate once more than
+        `capacity` qids have been added"""
+        ones = bin(int.from_bytes(self._data, 'little')).count('1')
+        return (ones / float(self.bits)) ** self.hashes
+
+
+class QidFilter(object):
+
+    def __init__(self, app, enabled=False, error_rate=0.001, rebuild_interval=86400.0, sync_interval=1.0,
+                 headroom=1.5, batch_size=10000):
+        self.app = app
+        self.enabled = enabled
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.sync_interval = sync_interval
+        self.headroom = headroom
+        self.batch_size = batch_size
+        self.lookups = 0
+        self.rejected = 0
+        self.false_positives = 0
+        self.lookup_seconds = 0.
+        self.builds = 0
+        self.build_seconds = 0.
+        self.syncs = 0
+        self.errors = 0
+        self.built = None
+        self._filter = None
+        self._building = None
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def might_contain(self, qid):
+        """False only if the qid was certainly never stored"""
+        if not self.enabled:
+            return True
+        self._start()
+        bloom = self._filter
+        if bloom is None or not qid:
+            return True
+        start = time.perf_counter()
+        key = qid_key(qid)
+        found = key in bloom
+        self.lookup_seconds += time.perf_counter() - start
+        self.lookups += 1
+        if not found:
+            self.rejected += 1
+        return found
+
+    def missed(self, qid):
+        """The database did not have a qid the filter let through"""
+        if self.enabled and self._filter is not None:
+            self.false_positives += 1
+
+    def add(self, qid):
+        if not self.enabled or not qid:
+            return
+        key = qid_key(qid)
+        with self._lock:
+            for bloom in (self._filter, self._building):
+                if bloom is not None:
+                    bloom.add(key)
+
+    def _start(self):
+        # built in the worker, after the fork (see access.AccessTracker);
+        # without a rebuild interval only build() fills it
+        if self.rebuild_interval and (self._thread is None or self._pid != os.getpid()):
+            with self._lock:
+                if self._thread is not None and self._pid == os.getpid():
+                    return
+                if self._pid is not None:
+                    self._filter = self._building = None
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name='vault-qid-filter')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    if self._rebuild_due():
+                        self.build()
+                    elif self.sync_interval:
+                        self.sync()
+            except Exception as e:
+                self.errors += 1
+                self.app.logger.error('Could not update the qid filter: {0}'.format(e))
+            time.sleep(self.sync_interval or self.rebuild_interval)
+
+    def _rebuild_due(self):
+        bloom = self._filter
+        return (bloom is None or bloom.items > bloom.capacity
+                or time.time() - self.built >= self.rebuild_interval)
+
+    def build(self):
+        """Fills a new filter with a streaming scan of all the qids, and
+        swaps it in; returns it"""
+        start = time.perf_counter()
+        with self.app.session_scope() as session:
+            count = session.execute(ESTIMATE_SQL).scalar() or 0
+            if self._filter is not None:
+                # as many as the last filter got, at least
+                count = max(count, self._filter.items)
+            bloom = BloomFilter(count * self.headroom, self.error_rate)
+            with self._lock:
+                self._building = bloom
+            last_id = 0
+            try:
+                for sql in ('SELECT id, qid FROM queries', 'SELECT 0 AS id, qid FROM queries_archive'):
+                    result = session.execute(text(sql).execution_options(stream_results=True))
+                    while True:
+                        rows = result.fetchmany(self.batch_size)
+                        if not rows:
+                            break
+                        with self._lock:
+                            for row in rows:
+                                if row.qid is not None:
+                                    bloom.add(bytes(row.qid))
+                        last_id = max(last_id, max(row.id for row in rows))
+            except Exception:
+                with self._lock:
+                    self._building = None
+                raise
+        # qids added meanwhile went into both filters
+        with self._lock:
+            self._filter = bloom
+            self._building = None
+            self._last_id = last_id
+        self.builds += 1
+        self.build_seconds = time.perf_counter() - start
+        self.built = time.time()
+        self.app.logger.info('Built the qid filter: {0} qids, {1} bytes, in {2:.1f}s'.format(
+            bloom.items, bloom.nbytes(), self.build_seconds))
+        return bloom
+
+    def sync(self):
+        """Adds the qids stored (by any worker) since the last sync"""
+        if self._filter is None:
+            return 0
+        with self.app.session_scope() as session:
+            rows = session.execute(text('SELECT id, qid FROM queries WHERE id > :last ORDER BY id'),
+                                   {'last': max(self._last_id - SYNC_OVERLAP, 0)}).fetchall()
+        with self._lock:
+            for row in rows:
+                if row.qid is not None:
+                    self._filter.add(bytes(row.qid))
+                self._last_id = max(self._last_id, row.id)
+        self.syncs += 1
+        return len(rows)
+
+    def stats(self):
+        bloom = self._filter
+        return {'enabled': self.enabled,
+                'ready': bloom is not None,
+                'items': bloom.items if bloom else 0,
+                'capacity': bloom.capacity if bloom else 0,
+                'bytes': bloom.nbytes() if bloom else 0,
+                'hashes': bloom.hashes if bloom else 0,
+                'error_rate': self.error_rate,
+                'estimated_error_rate': bloom.estimated_error_rate() if bloom else 0.,
+                'lookups': self.lookups,
+                'rejected': self.rejected,
+                'false_positives': self.false_positives,
+                'mean_lookup_us': self.lookup_seconds / self.lookups * 1e6 if self.lookups else 0.,
+                'syncs': self.syncs,
+                'builds': self.builds,
+                'build_seconds': self.build_seconds,
+                'built': self.built,
+                'errors': self.errors}
@@ -0,0 +1,205 @@
+"""
+    vault_service.refresher
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Keeps Query.numfound current. numfound is computed by solr when a query
+    is stored and would otherwise stay frozen; the refresher walks the
+    stored queries least-recently-refreshed first, in batches, re-runs them
+    through solr (a bounded number at a time, at a bounded rate) and writes
+    each batch back with a single UPDATE.
+
+    Queries still pending after `pending_age` seconds (their deferred
+    validation was lost to a restart, or ran out of retries) come first,
+    found with a query of their own (alembic revision 6c3e9a7d1f20 indexes
+    them); queries solr refuses are marked invalid.
+
+    It is meant to run periodically, see scripts/refresh_numfound.py
+"""
+import time
+from datetime import timedelta
+
+from adsmutils import get_date
+from sqlalchemy import text, or_
+
+
+class NumfoundRefresher(object):
+
+    def __init__(self, app, batch_size=500, workers=8, rate=50.0, max_age=604800, max_failures=0.5,
+                 pending_age=300):
+        self.app = app
+        self.batch_size = batch_size
+        self.workers = workers
+        self.rate = rate # solr requests per second, at most
+        self.max_age = max_age # seconds; queries refreshed more recently are skipped
+        self.max_failures = max_failures # share of a batch; more means solr is struggling
+        self.pending_age = pending_age # seconds; younger pending queries are left to the validator
+        self.batches = 0
+        self.refreshed = 0
+        self.changed = 0
+        self.invalid = 0
+        self.failed = 0
+        self.elapsed = 0.
+        # failures keep their numfound_updated; they are not tried again in the same run
+        self._failed_ids = set()
+
+    def run(self, max_batches=None):
+        """Refreshes every query that was not refreshed in the last max_age
+        seconds, and every query pending for longer than pending_age (or
+        until max_batches batches are done); returns the stats"""
+        now = get_date()
+        started = (now - timedelta(seconds=self.max_age), now - timedelta(seconds=self.pending_age))
+        with self.app.app_context():
+            remaining = self.remaining(started)
+            self.app.logger.info('Refreshing numfound of {0} queries'.format(remaining))
+            while max_batches is None or self.batches < max_batches:
+                t0 = time.time()
+                done, failed = self.refresh_batch(started)
+                if not done:
+                    break
+                remaining = max(remaining - done, 0)
+
+                # per batch rate limit: a batch takes at least len/rate seconds
+                if self.rate:
+                    time.sleep(max(0., done / float(self.rate) - (time.time() - t0)))
+                self.elapsed += time.time() - t0
+                self.app.logger.info('Progress: {0} refreshed ({1} changed, {2} invalid, {3} failed), '
+                                     '{4:.1f} queries/s, {5} remaining'.format(
+                                         self.refreshed, self.changed, self.invalid, self.failed,
+                                         self.throughput(), remaining))
+                if failed > done * self.max_failures:
+                    self.app.logger.warning('{0} of {1} validations failed, stopping'.format(failed, done))
+                    break
+        return self.stats()
+
+    def remaining(self, started):
+        from .models import Query
+        with self.app.session_scope() as session:
+            return self._pending(session.query(Query.id), started) \
+                .union(self._stale(session.query(Query.id), started)).count()
+
+    def refresh_batch(self, started):
+        """Refreshes the next batch; returns (number of queries, number of
+        failed validations)"""
+        from .models import Query, QueryPayload
+        from .views.utils import query_record, load_bigquery, validate_queries
+
+        with self.app.session_scope() as session:
+            # each in the order of its index, so that neither sorts the table
+            rows = []
+            for select in (self._pending, self._stale):
+                if len(rows) >= self.batch_size:
+                    break
+                q = select(session.query(Query, QueryPayload), started)
+                if rows:
+                    q = q.filter(~Query.id.in_([row.Query.id for row in rows]))
+                rows += q.outerjoin(QueryPayload, Query.payload_id == QueryPayload.id) \
+                    .order_by(Query.numfound_updated.asc().nullsfirst(), Query.id) \
+                    .limit(self.batch_size - len(rows)).all()
+            if not rows:
+                return 0, 0
+            records = [query_record(*row) for row in rows]
+            payloads = [{'query': r['payload'].get('query', ''), 'bigquery': load_bigquery(r, session)}
+                        for r in records]
+
+        # no transaction is held open while solr works
+        responses = validate_queries(payloads, headers=self._headers(), workers=self.workers)
+
+        values = []
+        failed = 0
+        for record, r in zip(records, responses):
+            numfound = None
+            status = 'valid'
+            if isinstance(r, Exception) or r.status_code >= 500 or r.status_code in (401, 403, 429):
+                # solr (or our token) is at fault, not the query
+                status = None
+            elif r.status_code != 200:
+                status = 'invalid'
+            else:
+                try:
+                    numfound = int(r.json()['response']['numFound'])
+                except:
+                    status = None
+            if status is None:
+                # left as is; the query is tried again by the next run
+                failed += 1
+                self._failed_ids.add(record['id'])
+                continue
+            if status == 'invalid':
+                self.invalid += 1
+            elif numfound != record['numfound']:
+                self.changed += 1
+            values.append((record, numfound, status))
+
+        if values:
+            with self.app.session_scope() as session:
+                self.bulk_update(session, values)
+                session.commit()
+
+        # this only reaches the shared cache tier (and this process); the web
+        # workers re-read numfound once VAULT_QUERY_CACHE_NUMFOUND_TTL is up
+        for record, numfound, status in values:
+            if numfound != record['numfound'] or status != record['status']:
+                self.app.query_cache.invalidate(qid=record['qid'], query_id=record['id'])
+                self.app.badge_cache.invalidate(record['qid'])
+        self.batches += 1
+        self.refreshed += len(values)
+        self.failed += failed
+        return len(records), failed
+
+    def bulk_update(self, session, values):
+        """Writes a batch of (record, numfound, status) back with one
+        statement; pending queries that solr accepted become valid, and the
+        ones it refused invalid (keeping their numfound)"""
+        from .models import qid_key
+        rows = []
+        params = {'now': get_date()}
+        for i, (record, numfound, status) in enumerate(values):
+            rows.append('(CAST(:id{0} AS integer), CAST(:q{0} AS bytea), CAST(:n{0} AS integer), '
+                        'CAST(:s{0} AS varchar))'.format(i))
+            params['id%d' % i] = record['id']
+            params['q%d' % i] = qid_key(record['qid'])
+            params['n%d' % i] = numfound
+            params['s%d' % i] = status
+        session.execute(text("""
+            UPDATE queries SET
+                numfound = COALESCE(v.numfound, queries.numfound),
+                status = CASE WHEN v.status = 'invalid' THEN 'invalid'
+                              WHEN queries.status = 'pending' THEN 'valid'
+                              ELSE queries.status END,
+                numfound_updated = :now
+            FROM (VALUES {0}) AS v (id, qid, numfound, status)
+            WHERE queries.qid = v.qid AND queries.id = v.id
+            """.format(', '.join(rows))), params)
+
+    def throughput(self):
+        return (self.refreshed + self.failed) / self.elapsed if self.elapsed else 0.
+
+    def stats(self):
+        return {'batches': self.batches,
+                'refreshed': self.refreshed,
+                'changed': self.changed,
+                'invalid': self.invalid,
+                'failed': self.failed,
+                'throughput': self.throughput()}
+
+    def _pending(self, q, started):
+        # started: (refreshed before, pending since before)
+        from .models import Query
+        return self._untried(q.filter(Query.status == 'pending', Query.numfound_updated < started[1]))
+
+    def _stale(self, q, started):
+        from .models import Query
+        return self._untried(q.filter(or_(Query.numfound_updated == None, Query.numfound_updated < started[0]),
+                                      or_(Query.status == None, Query.status != 'invalid')))
+
+    def _untried(self, q):
+        from .models import Query
+        if self._failed_ids:
+            q = q.filter(~Query.id.in_(self._failed_ids))
+        return q
+
+    def _headers(self):
+        headers = {}
+        if self.app.config.get('SERVICE_TOKEN', None):
+            headers['Authorization'] = self.app.config['SERVICE_TOKEN']
+        return headers
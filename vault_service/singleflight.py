@@ -0,0 +1,61 @@
+"""
+    vault_service.singleflight
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Collapses concurrent identical calls (within one worker process) into a
+    single one; whoever comes first does the work and everybody else waiting
+    on the same key gets its result (or its exception).
+"""
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.collapsed = 0
+        self.errors = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+                self.calls += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        return {'calls': self.calls,
+                'collapsed': self.collapsed,
+                'errors': self.errors,
+                'inflight': len(self._inflight)}
@@ -29,7 +29,9 @@ class TestCaseDatabase(TestCase):
             'SQLALCHEMY_ECHO': False,
             'TESTING': True,
             'PROPAGATE_EXCEPTIONS': True,
-            'TRAP_BAD_REQUEST_ERRORS': True
+            'TRAP_BAD_REQUEST_ERRORS': True,
+            # no background writes of access counts; tests flush by hand
+            'VAULT_ACCESS_FLUSH_INTERVAL': 0
         })
         return a
 
@@ -0,0 +1,116 @@
+import sys, os
+import unittest
+import json
+import datetime
+from flask import url_for
+
+project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_home not in sys.path:
+    sys.path.insert(0, project_home)
+
+from adsmutils import get_date
+from vault_service.models import Query, QueryAccess, QueryArchive, MyADS
+from vault_service.views import utils
+from vault_service.tests.base import TestCaseDatabase
+
+class TestAccess(TestCaseDatabase):
+    '''Tests the tracking of reads of stored queries'''
+
+    def test_access_tracking(self):
+        '''Tests that reads are counted in the worker and written in batches'''
+
+        tracker = self.app.access_tracker
+
+        with self.app.session_scope() as session:
+            session.add(Query(qid='ABCD', query=json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8'), numfound=1))
+            session.commit()
+
+        for _ in range(3):
+            r = self.client.get(url_for('user.query', queryid='ABCD'), headers={'Authorization': 'secret'})
+            self.assertStatus(r, 200)
+        r = self.client.get(url_for('queryalls.query2svg', queryid='ABCD'))
+        self.assertStatus(r, 200)
+        # unknown qids are not counted
+        r = self.client.get(url_for('user.query', queryid='nope'), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 404)
+
+        # nothing is written until the flush
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(QueryAccess).count(), 0)
+        self.assertEqual(tracker.stats()['pending'], 1)
+        self.assertEqual(tracker.flush(), 1)
+
+        with self.app.session_scope() as session:
+            a = session.query(QueryAccess).filter_by(qid='ABCD').one()
+            self.assertEqual(a.hits, 4)
+            first, last = a.first_access, a.last_access
+            self.assertTrue(first <= last)
+
+        # later flushes add up
+        tracker.record('ABCD')
+        tracker.record('EFGH')
+        self.assertEqual(tracker.flush(), 2)
+        self.assertEqual(tracker.flush(), 0)
+        with self.app.session_scope() as session:
+            a = session.query(QueryAccess).filter_by(qid='ABCD').one()
+            self.assertEqual(a.hits, 5)
+            self.assertEqual(a.first_access, first)
+            self.assertTrue(a.last_access >= last)
+
+        r = self.client.get('/metrics')
+        self.assertEqual(r.json['access_tracker']['flushed'], 3)
+        self.assertEqual(r.json['access_tracker']['recorded'], 6)
+
+    def test_archival(self):
+        '''Tests that cold queries are archived, and come back when read'''
+
+        old = get_date() - datetime.timedelta(days=400)
+        payload = json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8')
+        with self.app.session_scope() as session:
+            session.add(Query(qid='COLD', query=payload, numfound=1, created=old))
+            session.add(Query(qid='READ', query=payload, numfound=2, created=old))
+            session.add(Query(qid='PENDING', query=payload, numfound=0, created=old, status='pending'))
+            session.add(Query(qid='NEW', query=payload, numfound=3))
+            q = Query(qid='MYADS', query=payload, numfound=4, created=old)
+            session.add(q)
+            session.flush()
+            session.add(MyADS(type='query', query_id=q.id, name='Query 1', active=True, stateful=False, frequency='daily'))
+            session.commit()
+
+        self.app.access_tracker.record('READ')
+        self.app.access_tracker.flush()
+
+        cutoff = get_date() - datetime.timedelta(days=365)
+        with self.app.session_scope() as session:
+            rows = utils.archive_queries(session, cutoff, batch=10)
+            session.commit()
+        self.assertEqual([r.qid for r in rows], ['COLD'])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Query).filter_by(qid='COLD').count(), 0)
+            self.assertEqual(session.query(QueryArchive).filter_by(qid='COLD').one().numfound, 1)
+
+        # a read brings it back, with what it was stored with
+        r = self.client.get(url_for('user.query', queryid='COLD'), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['numfound'], 1)
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Query).filter_by(qid='COLD').count(), 1)
+            self.assertEqual(session.query(QueryArchive).count(), 0)
+
+        # so does a badge, and storing the same query again
+        with self.app.session_scope() as session:
+            utils.archive_queries(session, get_date() + datetime.timedelta(days=1), batch=10)
+            session.commit()
+            self.assertEqual(session.query(QueryArchive).count(), 3)
+        self.app.query_cache.clear()
+        r = self.client.get(url_for('queryalls.query2svg', queryid='NEW'))
+        self.assertStatus(r, 200)
+        with self.app.session_scope() as session:
+            row = utils.store_query(session, 'READ', {'query': 'q=foo', 'bigquery': ''}, 5)
+            session.commit()
+            self.assertFalse(row['inserted'])
+            self.assertEqual(row['numfound'], 2)
+            self.assertEqual(session.query(QueryArchive).count(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import sys, os
+import unittest
+import threading
+import time
+
+project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_home not in sys.path:
+    sys.path.insert(0, project_home)
+
+from vault_service.breaker import CircuitBreaker, CircuitOpenError, Hedger
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_and_recovers(self):
+        breaker = CircuitBreaker('solr', failures=3, reset_timeout=0.1, probes=1)
+        for _ in range(2):
+            breaker.before()
+            breaker.failure()
+        # a success in between resets the count
+        breaker.before()
+        breaker.success()
+        for _ in range(3):
+            breaker.before()
+            breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError) as e:
+            breaker.before()
+        self.assertTrue(0 < e.exception.retry_after <= 0.1)
+
+        # half open: a single probe goes through, and fails
+        time.sleep(0.15)
+        breaker.before()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+
+        # the next probe succeeds
+        time.sleep(0.15)
+        breaker.before()
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.before()
+
+        stats = breaker.stats()
+        self.assertEqual(stats['opened'], 2)
+        self.assertEqual(stats['rejected'], 2)
+        self.assertEqual(stats['total_failures'], 6)
+
+    def test_cancel(self):
+        breaker = CircuitBreaker('solr', failures=1, reset_timeout=0.1, probes=1)
+        breaker.before()
+        breaker.cancel()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.before()
+        breaker.failure()
+
+        # a cancelled probe leaves room for the next one
+        time.sleep(0.15)
+        breaker.before()
+        breaker.cancel()
+        self.assertEqual(breaker.state, 'half_open')
+        breaker.before()
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.stats()['total_failures'], 1)
+
+    def test_disabled(self):
+        breaker = CircuitBreaker('solr', failures=0)
+        for _ in range(10):
+            breaker.before()
+            breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+
+
+class TestHedger(unittest.TestCase):
+
+    def test_hedging(self):
+        hedger = Hedger(enabled=True, min_delay=0.01, max_delay=0.05, min_samples=5)
+        for _ in range(5):
+            self.assertEqual(hedger.do(lambda x: x, (1,)), 1)
+        self.assertEqual(hedger.stats()['hedged'], 0)
+
+        # the first call hangs, the second one (with its own arguments) answers
+        release = threading.Event()
+
+        def call(x):
+            if x == 'slow':
+                release.wait(5)
+            return x
+        self.assertEqual(hedger.do(call, ('slow',), ('fast',)), 'fast')
+        release.set()
+        stats = hedger.stats()
+        self.assertEqual(stats['hedged'], 1)
+        self.assertEqual(stats['hedge_wins'], 1)
+
+        # a failed hedge does not hide a good first answer
+        def failing(x):
+            if x == 'slow':
+                time.sleep(0.1)
+                return x
+            raise Exception('failed')
+        self.assertEqual(hedger.do(failing, ('slow',), ('fast',)), 'slow')
+
+    def test_disabled(self):
+        hedger = Hedger(enabled=False)
+        self.assertEqual(hedger.do(lambda x: x * 2, (2,)), 4)
+        self.assertEqual(hedger.stats()['calls'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
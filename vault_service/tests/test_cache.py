@@ -0,0 +1,121 @@
+import sys, os
+import unittest
+import json
+
+project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_home not in sys.path:
+    sys.path.insert(0, project_home)
+
+from vault_service.cache import LRUCache, QueryCache, ResultCache, CacheBackend
+
+
+class DictBackend(CacheBackend):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def record(qid, query_id, query='{"query": "q=foo", "bigquery": ""}'):
+    return {'id': query_id, 'qid': qid, 'numfound': 10, 'query': query, 'payload': json.loads(query)}
+
+
+class TestCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        c = LRUCache(100, max_item_bytes=60)
+        self.assertTrue(c.set('a', 1, 40))
+        self.assertTrue(c.set('b', 2, 40))
+        self.assertEqual(c.get('a'), 1) # 'b' is now the least recently used
+        c.set('c', 3, 40)
+
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(c.bytes, 80)
+
+        # too big to be cached at all
+        self.assertFalse(c.set('d', 4, 61))
+        self.assertIsNone(c.get('d'))
+
+        self.assertEqual(c.stats()['evictions'], 1)
+        self.assertEqual(c.stats()['hits'], 3)
+        self.assertEqual(c.stats()['misses'], 2)
+
+    def test_query_cache(self):
+        qc = QueryCache(LRUCache(10000))
+        qc.set(record('ABCD', 1))
+
+        self.assertEqual(qc.get(qid='ABCD')['id'], 1)
+        self.assertEqual(qc.get(query_id=1)['qid'], 'ABCD')
+        self.assertIsNone(qc.get(qid='foo'))
+        self.assertIsNone(qc.get(query_id=2))
+        self.assertEqual(qc.stats()['hits'], 2)
+        self.assertEqual(qc.stats()['misses'], 2)
+
+        qc.invalidate(qid='ABCD', query_id=1)
+        self.assertIsNone(qc.get(qid='ABCD'))
+        self.assertIsNone(qc.get(query_id=1))
+
+    def test_numfound_ttl(self):
+        qc = QueryCache(LRUCache(10000), numfound_ttl=60)
+        qc.set(record('ABCD', 1))
+        self.assertEqual(qc.get(qid='ABCD')['id'], 1)
+
+        # numfound may have been changed by another process since
+        entry = qc.local.get('qid:ABCD')
+        qc.local.set('qid:ABCD', (entry[0], entry[1] - 61), 100)
+        self.assertIsNone(qc.get(qid='ABCD'))
+        self.assertIsNone(qc.get(query_id=1))
+        self.assertEqual(qc.get(qid='ABCD', stale=True)['numfound'], 10)
+        self.assertEqual(qc.stats()['expired'], 2)
+
+    def test_shared_tier(self):
+        shared = DictBackend()
+        QueryCache(LRUCache(10000), shared=shared).set(record('ABCD', 1))
+
+        # another worker, with a cold local cache
+        qc = QueryCache(LRUCache(10000), shared=shared)
+        r = qc.get(query_id=1)
+        self.assertEqual(r['qid'], 'ABCD')
+        self.assertEqual(r['payload'], {'query': 'q=foo', 'bigquery': ''})
+        self.assertEqual(qc.stats()['shared_hits'], 1)
+
+        # now it is served locally
+        shared.data.clear()
+        self.assertEqual(qc.get(qid='ABCD')['id'], 1)
+
+    def test_result_cache(self):
+        rc = ResultCache(LRUCache(10000, max_item_bytes=1000), ttl=60)
+        self.assertTrue(rc.enabled)
+        self.assertFalse(ResultCache(LRUCache(10000)).enabled)
+
+        key = rc.key('ABCD', 'q=foo&wt=json', 'token')
+        self.assertNotEqual(key, rc.key('ABCD', 'q=foo&wt=json', 'other token'))
+        self.assertNotEqual(key, rc.key('ABCD', 'q=foo&rows=10&wt=json', 'token'))
+
+        self.assertIsNone(rc.get(key))
+        etag = rc.etag(key)
+        self.assertTrue(rc.set(key, etag, 'application/json', b'{}'))
+        self.assertEqual(rc.get(key), (etag, 'application/json', b'{}'))
+        self.assertEqual(rc.stats()['hit_ratio'], 0.5)
+
+        # too big to be kept
+        self.assertFalse(rc.set(key + '1', etag, 'application/json', b'x' * 1000))
+
+        rc.ttl = -1
+        rc.set(key, etag, 'application/json', b'{}')
+        self.assertIsNone(rc.get(key))
+        self.assertEqual(rc.stats()['expired'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import sys, os
+import unittest
+import urllib.parse as urlparse
+
+project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_home not in sys.path:
+    sys.path.insert(0, project_home)
+
+from vault_service.views.canonical import canonicalize, compatible_qids
+from vault_service.views.utils import query_qid, cleanup_payload
+
+
+class TestCanonical(unittest.TestCase):
+
+    def test_equivalent_queries(self):
+        a = canonicalize({'query': {'q': 'title:foo  author:bar', 'fq': ['database:astronomy', 'year:2000']}}, version=1, sort_bigquery=False)
+        b = canonicalize({'query': 'fq=year%3A2000&fq=database:astronomy&q=+title%3Afoo+author%3Abar+'}, version=1, sort_bigquery=False)
+        c = canonicalize({'query': {'q': ' title:foo\tauthor:bar', 'fq': ['year:2000', 'database:astronomy', 'year:2000']}}, version=1, sort_bigquery=False)
+        self.assertEqual(a, b)
+        self.assertEqual(a, c)
+        self.assertEqual(a['query'], 'fq=database%3Aastronomy&fq=year%3A2000&q=title%3Afoo+author%3Abar')
+
+        # the order of the other parameters matters to solr
+        self.assertNotEqual(canonicalize({'query': {'q': 'foo', 'sort': ['date desc', 'bibcode asc']}}, version=1, sort_bigquery=False),
+                            canonicalize({'query': {'q': 'foo', 'sort': ['bibcode asc', 'date desc']}}, version=1, sort_bigquery=False))
+        self.assertNotEqual(canonicalize({'query': {'q': 'foo', 'fq_database': ['b', 'a', 'a']}}, version=1, sort_bigquery=False),
+                            canonicalize({'query': {'q': 'foo', 'fq_database': ['a', 'b']}}, version=1, sort_bigquery=False))
+
+    def test_phrases(self):
+        '''Tests that whitespace inside quotes is left alone'''
+        a = canonicalize({'query': {'q': '  title:"dark  matter"   author:"Smith,  J"  '}}, version=1, sort_bigquery=False)
+        self.assertEqual(a['query'], 'q=title%3A%22dark++matter%22+author%3A%22Smith%2C++J%22')
+        self.assertNotEqual(a, canonicalize({'query': {'q': 'title:"dark matter" author:"Smith, J"'}}, version=1, sort_bigquery=False))
+        # an escaped quote does not end the phrase, an unclosed one runs to the end
+        b = canonicalize({'query': {'q': 'title:"a \\"  b"  c   abs:"x  y  '}}, version=1, sort_bigquery=False)
+        self.assertEqual(urlparse.parse_qs(b['query'])['q'], ['title:"a \\"  b" c abs:"x  y  '])
+
+    def test_version_zero(self):
+        payload = {'query': {'q': 'foo', 'fq': ['b', 'a'], 'foo': 'bar'}}
+        self.assertEqual(canonicalize(payload, version=0, sort_bigquery=False), cleanup_payload(payload))
+        self.assertRaises(Exception, canonicalize, payload, version=99, sort_bigquery=False)
+
+    def test_bigquery(self):
+        payload = {'query': {'q': '*:*', 'fq': '{!bitset}'}, 'bigquery': 'bibcode\r\nB\nA\n\nB\n'}
+        self.assertEqual(canonicalize(payload, version=1, sort_bigquery=False)['bigquery'], 'bibcode\r\nB\nA\n\nB\n')
+        self.assertEqual(canonicalize(payload, version=1, sort_bigquery=True)['bigquery'], 'bibcode\nA\nB')
+        self.assertRaises(Exception, canonicalize, {'query': {'q': '*:*'}, 'bigquery': 'bibcode\nA'}, version=1, sort_bigquery=False)
+
+    def test_compatible_qids(self):
+        headers = {'X-Api-Uid': '1'}
+        submitted = {'query': {'q': 'foo', 'fq': ['b', 'a']}}
+        canonical = canonicalize(submitted, version=1, sort_bigquery=False)
+        self.assertEqual(compatible_qids(submitted, headers, canonical, version=1, sort_bigquery=False),
+                         [query_qid(cleanup_payload(submitted), headers)])
+
+        # nothing to look up when the old rules give the same qid
+        submitted = {'query': {'q': 'foo', 'fq': ['a', 'b']}}
+        self.assertEqual(compatible_qids(submitted, headers, canonicalize(submitted, version=1, sort_bigquery=False), version=1, sort_bigquery=False), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
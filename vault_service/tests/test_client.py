@@ -0,0 +1,139 @@
+import sys, os
+import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_home not in sys.path:
+    sys.path.insert(0, project_home)
+
+from vault_service.client import make_client, PoolSaturated
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.failures = 0
+        self.release = threading.Event()
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self):
+                if self.path.endswith('/slow'):
+                    test.release.wait(5)
+                if self.path.startswith('/flaky') and test.failures:
+                    test.failures -= 1
+                    status = 503
+                else:
+                    status = 200
+                self.send_response(status)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            do_GET = respond
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.respond()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.client = make_client({
+            'SOLR': self.url + '/solr',
+            'VAULT_HTTP_DEFAULTS': {'backoff': 0.01},
+            'VAULT_HTTP_UPSTREAMS': {'solr': {'endpoints': ['SOLR'], 'pool_maxsize': 1, 'pool_timeout': 0.2}}})
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_upstreams(self):
+        self.client.get(self.url + '/solr/select')
+        self.client.get(self.url + '/other')
+        stats = self.client.stats()
+        self.assertEqual(stats['solr']['requests'], 1)
+        self.assertEqual(stats['solr']['pool_maxsize'], 1)
+        self.assertEqual(stats['default']['requests'], 1)
+
+    def test_retries(self):
+        # idempotent requests are retried on 503
+        self.failures = 2
+        r = self.client.get(self.url + '/flaky')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.client.stats()['default']['retries'], 2)
+
+        # but the retries are bounded, and the last response is returned
+        self.failures = 5
+        r = self.client.get(self.url + '/flaky')
+        self.assertEqual(r.status_code, 503)
+
+        # and posts are not retried once sent
+        self.failures = 1
+        r = self.client.post(self.url + '/flaky', data=b'x')
+        self.assertEqual(r.status_code, 503)
+
+    def test_saturation(self):
+        t = threading.Thread(target=self.client.get, args=(self.url + '/solr/slow',))
+        t.start()
+        for _ in range(100):
+            if self.client.stats()['solr']['in_flight']:
+                break
+            threading.Event().wait(0.01)
+
+        # the single connection is taken; the caller gives up after pool_timeout
+        with self.assertRaises(PoolSaturated):
+            self.client.get(self.url + '/solr/select')
+        stats = self.client.stats()['solr']
+        self.assertEqual(stats['saturated'], 1)
+        self.assertEqual(stats['waited'], 1)
+
+        self.release.set()
+        t.join()
+        self.assertEqual(self.client.get(self.url + '/solr/select').status_code, 200)
+        self.assertEqual(self.client.stats()['solr']['max_in_flight'], 1)
+
+    def test_streamed_responses(self):
+        # a streamed response holds the connection until it is read
+        r = self.client.get(self.url + '/solr/select', stream=True)
+        self.assertEqual(self.client.stats()['solr']['in_flight'], 1)
+        with self.assertRaises(PoolSaturated):
+            self.client.get(self.url + '/solr/select')
+        self.assertEqual(r.content, b'ok')
+        self.assertEqual(self.client.stats()['solr']['in_flight'], 0)
+
+        # or closed
+        r = self.client.get(self.url + '/solr/select', stream=True)
+        r.close()
+        r.close()
+        self.assertEqual(self.client.stats()['solr']['in_flight'], 0)
+        self.assertEqual(self.client.get(self.url + '/solr/select').status_code, 200)
+
+    def test_timeouts(self):
+        self.client.upstreams['solr'].timeout = (1, 0.1)
+        # read timeouts are retried too, then given up on
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.client.get(self.url + '/solr/slow')
+        self.assertEqual(self.client.stats()['solr']['retries'], 3)
+        self.assertEqual(self.client.stats()['solr']['errors'], 1)
+        # a timeout passed by the caller wins
+        self.release.set()
+        self.assertEqual(self.client.get(self.url + '/solr/slow', timeout=5).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import sys, os
+import unittest
+import json
+import hashlib
+import httpretty
+from flask import url_for
+
+project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_home not in sys.path:
+    sys.path.insert(0, project_home)
+
+from vault_service.models import Query, QueryArchive, qid_key
+from vault_service.qid_filter import BloomFilter, QidFilter
+from vault_service.tests.base import TestCaseDatabase
+
+
+def md5(i):
+    return hashlib.md5(str(i).encode('utf8')).hexdigest()
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_membership(self):
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add(qid_key(md5(i)))
+        bloom.add(qid_key('COLD'))
+        # no false negatives
+        for i in range(10000):
+            self.assertIn(qid_key(md5(i)), bloom)
+        self.assertIn(qid_key('COLD'), bloom)
+
+        false_positives = sum(1 for i in range(10000, 30000) if qid_key(md5(i)) in bloom)
+        self.assertLess(false_positives / 20000., 0.02)
+        self.assertLess(bloom.estimated_error_rate(), 0.02)
+        # about 1.2 bytes per qid at 1%
+        self.assertLess(bloom.nbytes(), 10000 * 1.3)
+
+
+class TestQidFilter(TestCaseDatabase):
+
+    @httpretty.activate
+    def test_unknown_qids(self):
+        '''Tests that unknown qids are turned away, and new ones are let through'''
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            status=200,
+            body='{"responseHeader": {"status": 0}, "response": {"numFound": 3, "start": 0, "docs": []}}')
+
+        payload = json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8')
+        with self.app.session_scope() as session:
+            session.add(Query(qid=md5(1), query=payload, numfound=1))
+            session.add(QueryArchive(id=1000, qid=md5(2), query=payload, numfound=2))
+            session.commit()
+
+        qf = self.app.qid_filter = QidFilter(self.app, enabled=True, rebuild_interval=0, sync_interval=3600)
+        # not built yet: everything goes through
+        r = self.client.get(url_for('user.query', queryid=md5(3)), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 404)
+        self.assertEqual(qf.stats()['lookups'], 0)
+
+        qf.build()
+        r = self.client.get(url_for('user.query', queryid=md5(3)), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 404)
+        r = self.client.get(url_for('queryalls.query2svg', queryid=md5(4)))
+        self.assertStatus(r, 404)
+        self.assertEqual(qf.stats()['rejected'], 2)
+
+        # stored and archived qids are found
+        r = self.client.get(url_for('user.query', queryid=md5(1)), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        r = self.client.get(url_for('user.query', queryid=md5(2)), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+
+        # and so are the ones stored by this worker
+        r = self.client.post(url_for('user.query'),
+                             headers={'Authorization': 'secret'},
+                             data=json.dumps({'q': 'foo:bar'}),
+                             content_type='application/json')
+        self.assertStatus(r, 200)
+        r = self.client.get(url_for('user.query', queryid=r.json['qid']), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+
+        # the ones stored by other workers only once synced
+        with self.app.session_scope() as session:
+            session.add(Query(qid=md5(5), query=payload, numfound=5))
+            session.commit()
+        r = self.client.get(url_for('user.query', queryid=md5(5)), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 404)
+        qf.sync()
+        r = self.client.get(url_for('user.query', queryid=md5(5)), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+
+        r = self.client.get('/metrics')
+        self.assertTrue(r.json['qid_filter']['ready'])
+        self.assertEqual(r.json['qid_filter']['syncs'], 1)
+        self.assertTrue(r.json['qid_filter']['bytes'] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
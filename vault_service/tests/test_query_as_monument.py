@@ -3,6 +3,7 @@ from urllib.parse import urlencode
 from flask import url_for, request
 import unittest
 import json
+import time
 import httpretty
 import cgi
 from io import StringIO
@@ -39,5 +40,48 @@ class TestServices(TestCaseDatabase):
         self.assertStatus(r, 404)
         self.assertTrue(r.headers.get('Content-Type') == 'image/svg+xml')
 
+    def test_badge_cache(self):
+        '''Tests that rendered badges are cached, revalidated and refreshed'''
+
+        q = Query(qid='ABCD', query=json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8'), numfound=1)
+        self.app.db.session.add(q)
+        self.app.db.session.commit()
+
+        r = self.client.get(url_for('queryalls.query2svg', queryid='ABCD'))
+        self.assertStatus(r, 200)
+        etag = r.headers['ETag']
+        self.assertTrue('stale-while-revalidate' in r.headers['Cache-Control'])
+
+        r = self.client.get(url_for('queryalls.query2svg', queryid='ABCD'), headers={'If-None-Match': etag})
+        self.assertStatus(r, 304)
+
+        # served from the cache, even with the numfound changed underneath
+        self.app.db.session.query(Query).filter_by(qid='ABCD').update({'numfound': 2})
+        self.app.db.session.commit()
+        r = self.client.get(url_for('queryalls.query2svg', queryid='ABCD'))
+        self.assertTrue(b'>1<' in r.data)
+        self.assertEqual(self.app.badge_cache.stats()['hits'], 2)
+
+        # once stale, the old badge is served one last time while it is re-rendered
+        self.app.badge_cache.local.get('ABCD')['fresh_until'] = 0
+        r = self.client.get(url_for('queryalls.query2svg', queryid='ABCD'))
+        self.assertTrue(b'>1<' in r.data)
+        for _ in range(50):
+            entry, fresh = self.app.badge_cache.get('ABCD')
+            if fresh:
+                break
+            time.sleep(0.1)
+        r = self.client.get(url_for('queryalls.query2svg', queryid='ABCD'))
+        self.assertTrue(b'>2<' in r.data)
+        self.assertNotEqual(r.headers['ETag'], etag)
+
+        # unknown qids are remembered too
+        r = self.client.get(url_for('queryalls.query2svg', queryid='foo'))
+        self.assertStatus(r, 404)
+        self.app.db.session.add(Query(qid='foo', query=q.query, numfound=3))
+        self.app.db.session.commit()
+        r = self.client.get(url_for('queryalls.query2svg', queryid='foo'))
+        self.assertStatus(r, 404)
+
 if __name__ == '__main__':
     unittest.main()
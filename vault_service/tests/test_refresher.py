@@ -0,0 +1,86 @@
+import sys, os
+import unittest
+import json
+import httpretty
+from datetime import timedelta
+from urllib.parse import urlparse, parse_qs
+from adsmutils import get_date
+
+project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_home not in sys.path:
+    sys.path.insert(0, project_home)
+
+from vault_service.models import Query
+from vault_service.refresher import NumfoundRefresher
+from vault_service.tests.base import TestCaseDatabase
+
+class TestRefresher(TestCaseDatabase):
+    '''Tests the numfound refresher'''
+
+    @httpretty.activate
+    def test_refresh(self):
+        '''Tests that stored queries get their numfound refreshed in batches'''
+
+        def callback(request, uri, headers):
+            q = parse_qs(urlparse(uri).query)['q'][0]
+            if q == 'broken':
+                return (500, headers, '{"error": "broken"}')
+            if q == 'bad':
+                return (400, headers, '{"error": "bad"}')
+            return (200, headers, json.dumps({'responseHeader': {'status': 0},
+                                              'response': {'numFound': len(q), 'start': 0, 'docs': []}}))
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            body=callback)
+
+        with self.app.session_scope() as session:
+            for i, q in enumerate(['a', 'bb', 'ccc', 'dddd', 'broken', 'bad']):
+                payload = json.dumps({'query': 'q=' + q, 'bigquery': ''}).encode('utf8')
+                session.add(Query(qid='QID%d' % i, query=payload, numfound=0,
+                                  status='pending' if q == 'a' else None))
+            payload = json.dumps({'query': 'q=nope', 'bigquery': ''}).encode('utf8')
+            session.add(Query(qid='INVALID', query=payload, numfound=0, status='invalid'))
+            session.commit()
+
+        refresher = NumfoundRefresher(self.app, batch_size=2, workers=2, rate=0, max_age=0, max_failures=1)
+        stats = refresher.run()
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(stats['refreshed'], 5)
+        self.assertEqual(stats['changed'], 4)
+        self.assertEqual(stats['invalid'], 1)
+        self.assertEqual(stats['failed'], 1)
+
+        with self.app.session_scope() as session:
+            rows = {q.qid: q for q in session.query(Query)}
+            self.assertEqual([rows['QID%d' % i].numfound for i in range(5)], [1, 2, 3, 4, 0])
+            self.assertEqual(rows['QID0'].status, 'valid')
+            # queries solr refuses are marked invalid
+            self.assertEqual(rows['QID5'].status, 'invalid')
+            self.assertTrue(rows['QID5'].numfound_updated is not None)
+            # failures are left as they were, for the next run
+            self.assertTrue(rows['QID4'].numfound_updated is None)
+            # invalid queries are never sent to solr
+            self.assertTrue(rows['INVALID'].numfound_updated is None)
+
+        # queries pending for a while come first, whatever their age
+        with self.app.session_scope() as session:
+            payload = json.dumps({'query': 'q=eeeee', 'bigquery': ''}).encode('utf8')
+            session.add(Query(qid='PENDING', query=payload, numfound=0, status='pending',
+                              numfound_updated=get_date() - timedelta(seconds=600)))
+            session.commit()
+        stats = NumfoundRefresher(self.app, batch_size=1, rate=0, max_age=3600, pending_age=300).run(max_batches=1)
+        self.assertEqual(stats['refreshed'], 1)
+        with self.app.session_scope() as session:
+            q = session.query(Query).filter_by(qid='PENDING').one()
+            self.assertEqual((q.status, q.numfound), ('valid', 5))
+
+        # only the failure is left to refresh in a second run
+        stats = NumfoundRefresher(self.app, rate=0, max_age=3600).run()
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['refreshed'], 0)
+        self.assertEqual(stats['failed'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
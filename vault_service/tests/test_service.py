@@ -26,6 +26,19 @@ class TestServices(TestCaseDatabase):
           [self.assertIn(expected_field,v) for v in list(r.json.values())] #Assert each resource is described has the expected_field
           [self.assertIsInstance(v[expected_field],_type) for v in list(r.json.values())] #Assert every expected_field has the proper type
 
+    def test_metrics(self):
+        '''Tests that the cache counters are exposed'''
+        r = self.client.get('/metrics')
+        self.assertEqual(r.status_code, 200)
+        for k in ('hits', 'misses', 'evictions', 'bytes', 'max_bytes'):
+            self.assertIn(k, r.json['query_cache'])
+        for k in ('calls', 'collapsed', 'errors', 'inflight'):
+            self.assertIn(k, r.json['solr_singleflight'])
+        for k in ('hits', 'misses', 'expired', 'hit_ratio'):
+            self.assertIn(k, r.json['result_cache'])
+        for k in ('requests', 'in_flight', 'saturated', 'retries'):
+            self.assertIn(k, r.json['http_pools']['solr'])
+
 
 
 
@@ -0,0 +1,58 @@
+import sys, os
+import unittest
+import threading
+import time
+
+project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+if project_home not in sys.path:
+    sys.path.insert(0, project_home)
+
+from vault_service.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_are_collapsed(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        executed = []
+
+        def slow(x):
+            executed.append(x)
+            release.wait(5)
+            return x * 2
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', slow, 21))) for _ in range(10)]
+        for t in threads:
+            t.start()
+        # wait for everybody to queue up behind the first call
+        for _ in range(100):
+            if flight.stats()['collapsed'] == 9:
+                break
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(executed, [21])
+        self.assertEqual(results, [42] * 10)
+        self.assertEqual(flight.stats(), {'calls': 1, 'collapsed': 9, 'errors': 0, 'inflight': 0})
+
+        # once done, the next call goes through again
+        self.assertEqual(flight.do('key', slow, 1), 2)
+        self.assertEqual(flight.stats()['calls'], 2)
+
+    def test_errors_are_shared(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('solr is down')
+
+        self.assertRaises(ValueError, flight.do, 'key', fail)
+        self.assertEqual(flight.stats()['errors'], 1)
+        self.assertEqual(flight.stats()['inflight'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
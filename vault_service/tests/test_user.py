@@ -4,14 +4,21 @@ import unittest
 import json
 import httpretty
 import datetime
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 from dateutil import parser
+from sqlalchemy import exc
 
 project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
 if project_home not in sys.path:
     sys.path.insert(0, project_home)
 
-from vault_service.models import Query, User, MyADS, Library
+from vault_service.models import Query, QueryBigquery, QueryPayload, User, MyADS, Library, qid_key, key_qid
 from vault_service.tests.base import TestCaseDatabase
+from vault_service.refresher import NumfoundRefresher
+from vault_service.client import PoolSaturated
+from vault_service.views import utils
 import adsmutils
 
 class TestServices(TestCaseDatabase):
@@ -41,15 +48,34 @@ class TestServices(TestCaseDatabase):
 
         self.assertStatus(r, 200)
 
+        # a duplicate is found in the db, and not validated again
+        calls = len(httpretty.HTTPretty.latest_requests)
+        r2 = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps({'q': 'foo:bar'}),
+                content_type='application/json')
+        self.assertStatus(r2, 200)
+        self.assertEqual(r2.json['qid'], r.json['qid'])
+        self.assertEqual(r2.json['numFound'], 10456930)
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), calls)
 
         self.assertTrue(r.json['qid'], 'qid is missing')
         with self.app.session_scope() as session:
             q = session.query(Query).filter_by(qid=r.json['qid']).first()
 
             self.assertTrue(q.qid == r.json['qid'], 'query was not saved')
-            self.assertTrue(q.query == json.dumps({"query": "q=foo%3Abar", "bigquery": ""}).encode('utf8'), 'query was not saved')
+            p = session.query(QueryPayload).filter_by(id=q.payload_id).first()
+            self.assertTrue(p.query == json.dumps({"query": "q=foo%3Abar", "bigquery": ""}).encode('utf8'), 'query was not saved')
+            # the query string is parsed once, when it is stored
+            self.assertEqual(p.params, {'q': ['foo:bar']})
             session.expunge_all()
 
+        record = utils.load_query(qid=r.json['qid'])
+        params = utils.query_params(record)
+        self.assertEqual(params, {'q': ['foo:bar']})
+        params['q'].append('changed')
+        self.assertEqual(utils.query_params(record), {'q': ['foo:bar']})
+
 
         # now test that the query gets executed
         #self.app.debug = True
@@ -60,12 +86,26 @@ class TestServices(TestCaseDatabase):
 
         self.assertStatus(r, 200)
 
+        # the stored query is now served from the cache, without the db
+        with self.app.session_scope() as session:
+            session.query(Query).filter_by(qid=q.qid).delete()
+
+        r = self.client.get(url_for('user.query', queryid=q.qid),
+                headers={'Authorization': 'secret'})
+
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['numfound'], 10456930)
+        self.assertEqual(r.json['query'], json.dumps({"query": "q=foo%3Abar", "bigquery": ""}))
+        self.assertTrue(self.app.query_cache.stats()['hits'] > 0)
+
     @httpretty.activate
     def test_bigquery_storage(self):
         '''Tests the ability to store bigqueries'''
 
         def callback(request, uri, headers):
             headers['Content-Type'] = 'application/json'
+            if request.body != b'one\ntwo':
+                return (400, headers, 'bigquery was not sent')
             out = """{
             "responseHeader":{
             "status":0, "QTime":0,
@@ -97,9 +137,21 @@ class TestServices(TestCaseDatabase):
             #q = self.app.db.session.query(Query).filter_by(qid=r.json['qid']).first()
 
             self.assertTrue(q.qid == r.json['qid'], 'query was not saved')
-            self.assertTrue(q.query == json.dumps({"query": "fq=%7B%21bitset%7D&q=foo%3Abar", "bigquery": "one\ntwo"}).encode('utf8'), 'query was not saved')
+            # the bigquery itself is stored compressed, out of line
+            p = session.query(QueryPayload).filter_by(id=q.payload_id).first()
+            self.assertTrue(p.query == json.dumps({"query": "fq=%7B%21bitset%7D&q=foo%3Abar", "bigquery": ""}).encode('utf8'), 'query was not saved')
+            bq = session.query(QueryBigquery).filter_by(id=p.bigquery_id).first()
+            self.assertEqual(bq.codec, 'zlib')
+            self.assertEqual(bq.size, len(b'one\ntwo'))
+            self.assertEqual(zlib.decompress(bq.data), b'one\ntwo')
             session.expunge_all()
 
+        # but it is returned as it was submitted
+        r = self.client.get(url_for('user.query', queryid=q.qid),
+                headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['query'], json.dumps({"query": "fq=%7B%21bitset%7D&q=foo%3Abar", "bigquery": "one\ntwo"}))
+
 
         # now test that the query gets executed
         r = self.client.get(url_for('user.execute_query', queryid=q.qid),
@@ -120,6 +172,687 @@ class TestServices(TestCaseDatabase):
         self.assertStatus(r, 200)
         self.assertListEqual(r.json['responseHeader']['params']['q'], ['author:foo'])
 
+    @httpretty.activate
+    def test_streamed_bigquery_storage(self):
+        '''Tests posting the bigquery as the raw request body'''
+
+        def callback(request, uri, headers):
+            headers['Content-Type'] = 'application/json'
+            if request.body != b'one\ntwo':
+                return (400, headers, 'bigquery was not sent')
+            return (200, headers, '{"responseHeader": {"status": 0}, "response": {"numFound": 2, "start": 0, "docs": []}}')
+
+        httpretty.register_uri(
+            httpretty.POST, self.app.config.get('VAULT_SOLR_BIGQUERY_ENDPOINT'),
+            body=callback)
+
+        r = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                query_string={'q': 'foo:bar', 'fq': '{!bitset}'},
+                data=b'one\ntwo',
+                content_type='big-query/csv')
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['numFound'], 2)
+        qid = r.json['qid']
+
+        with self.app.session_scope() as session:
+            q = session.query(Query).filter_by(qid=qid).one()
+            p = session.query(QueryPayload).filter_by(id=q.payload_id).one()
+            bq = session.query(QueryBigquery).filter_by(id=p.bigquery_id).one()
+            self.assertEqual(zlib.decompress(bq.data), b'one\ntwo')
+
+        # the same query posted as json gets the same qid
+        r = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps({'q': 'foo:bar', 'fq': '{!bitset}', 'bigquery': 'one\ntwo'}),
+                content_type='application/json')
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['qid'], qid)
+
+        r = self.client.get(url_for('user.query', queryid=qid),
+                headers={'Authorization': 'secret'})
+        self.assertEqual(r.json['query'], json.dumps({"query": "fq=%7B%21bitset%7D&q=foo%3Abar", "bigquery": "one\ntwo"}))
+
+        # the bitset filter is still required
+        r = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                query_string={'q': 'foo:bar'},
+                data=b'one\ntwo',
+                content_type='big-query/csv')
+        self.assertStatus(r, 400)
+
+        # and so is the size limit
+        max_bytes = self.app.config['VAULT_MAX_QUERY_BYTES']
+        self.app.config['VAULT_MAX_QUERY_BYTES'] = 4
+        try:
+            r = self.client.post(url_for('user.query'),
+                    headers={'Authorization': 'secret'},
+                    query_string={'q': 'foo:bar', 'fq': '{!bitset}'},
+                    data=b'one\ntwo\nthree',
+                    content_type='big-query/csv')
+            self.assertStatus(r, 413)
+        finally:
+            self.app.config['VAULT_MAX_QUERY_BYTES'] = max_bytes
+
+    @httpretty.activate
+    def test_execute_query_streaming(self):
+        '''Tests that solr responses are passed through, within the size limit'''
+
+        body = json.dumps({'responseHeader': {'status': 0},
+                           'response': {'numFound': 1000, 'start': 0,
+                                        'docs': [{'bibcode': '2005JGRC..110.%04dG' % i} for i in range(1000)]}})
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            status=200,
+            body=body)
+
+        payload = json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8')
+        with self.app.session_scope() as session:
+            session.add(Query(qid='STREAM', query=payload, numfound=1000))
+            session.commit()
+
+        r = self.client.get(url_for('user.execute_query', queryid='STREAM'),
+                headers={'Authorization': 'secret'},
+                query_string={'rows': 1000})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['response']['numFound'], 1000)
+        self.assertEqual(len(r.json['response']['docs']), 1000)
+        self.assertEqual(r.headers['X-Vault-Query-Status'], 'valid')
+
+        max_bytes = self.app.config['VAULT_MAX_SOLR_RESPONSE_BYTES']
+        self.app.config['VAULT_MAX_SOLR_RESPONSE_BYTES'] = 1024
+        try:
+            r = self.client.get(url_for('user.execute_query', queryid='STREAM'),
+                    headers={'Authorization': 'secret'},
+                    query_string={'rows': 1000})
+            self.assertStatus(r, 400)
+        finally:
+            self.app.config['VAULT_MAX_SOLR_RESPONSE_BYTES'] = max_bytes
+
+    @httpretty.activate
+    def test_execute_query_cursor(self):
+        '''Tests deep paging with solr cursors, and streaming all the pages'''
+
+        docs = [{'id': str(i), 'bibcode': '2005JGRC..110.%04dG' % i} for i in range(25)]
+
+        def callback(request, uri, headers):
+            headers['Content-Type'] = 'application/json'
+            params = request.querystring
+            if 'start' in params or not params['sort'][0].endswith('id asc'):
+                return (400, headers, 'start is not allowed with cursorMark')
+            cursor = params['cursorMark'][0]
+            offset = 0 if cursor == '*' else int(cursor)
+            rows = int(params.get('rows', ['10'])[0])
+            page = docs[offset:offset + rows]
+            return (200, headers, json.dumps({'responseHeader': {'status': 0},
+                                              'response': {'numFound': len(docs), 'start': 0, 'docs': page},
+                                              'nextCursorMark': str(offset + len(page)) if page else cursor}))
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            body=callback)
+
+        payload = json.dumps({'query': 'q=foo&sort=date+desc', 'bigquery': ''}).encode('utf8')
+        with self.app.session_scope() as session:
+            session.add(Query(qid='CURSOR', query=payload, numfound=25))
+            session.commit()
+
+        r = self.client.get(url_for('user.execute_query', queryid='CURSOR'),
+                headers={'Authorization': 'secret'},
+                query_string={'cursorMark': '*', 'start': 10, 'rows': 10})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['nextCursorMark'], '10')
+        self.assertEqual(httpretty.last_request().querystring['sort'], ['date desc, id asc'])
+
+        r = self.client.get(url_for('user.execute_query', queryid='CURSOR'),
+                headers={'Authorization': 'secret'},
+                query_string={'cursorMark': r.json['nextCursorMark'], 'rows': 10})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['response']['docs'][0]['id'], '10')
+
+        # all the pages, as ndjson
+        rows = self.app.config['VAULT_SOLR_CURSOR_ROWS']
+        self.app.config['VAULT_SOLR_CURSOR_ROWS'] = 10
+        try:
+            calls = len(httpretty.HTTPretty.latest_requests)
+            r = self.client.get(url_for('user.execute_query', queryid='CURSOR'),
+                    headers={'Authorization': 'secret', 'Accept': 'application/x-ndjson'},
+                    query_string={'rows': 100})
+            self.assertStatus(r, 200)
+            self.assertEqual(r.headers['Content-Type'], 'application/x-ndjson')
+            self.assertEqual(r.headers['X-Vault-NumFound'], '25')
+            lines = [json.loads(line) for line in r.data.decode('utf8').splitlines()]
+            self.assertListEqual(lines, docs)
+            # three pages, and the one that finds nothing left
+            self.assertEqual(len(httpretty.HTTPretty.latest_requests), calls + 4)
+        finally:
+            self.app.config['VAULT_SOLR_CURSOR_ROWS'] = rows
+
+    @httpretty.activate
+    def test_execute_query_result_cache(self):
+        '''Tests that repeated executions are answered from the result cache'''
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            status=200,
+            body='{"responseHeader": {"status": 0}, "response": {"numFound": 3, "start": 0, "docs": []}}')
+
+        payload = json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8')
+        with self.app.session_scope() as session:
+            session.add(Query(qid='CACHED', query=payload, numfound=3))
+            session.commit()
+
+        self.app.result_cache.ttl = 60
+        try:
+            for stream in (True, False):
+                self.app.config['VAULT_STREAM_SOLR_RESPONSES'] = stream
+                self.app.result_cache.clear()
+                calls = len(httpretty.HTTPretty.latest_requests)
+
+                r = self.client.get(url_for('user.execute_query', queryid='CACHED'),
+                        headers={'Authorization': 'secret'}, query_string={'fl': 'title'})
+                self.assertStatus(r, 200)
+                etag = r.headers['ETag']
+                self.assertEqual(r.headers['Cache-Control'], 'private, max-age=60')
+
+                r = self.client.get(url_for('user.execute_query', queryid='CACHED'),
+                        headers={'Authorization': 'secret'}, query_string={'fl': 'title'})
+                self.assertStatus(r, 200)
+                self.assertEqual(r.json['response']['numFound'], 3)
+                self.assertEqual(r.headers['ETag'], etag)
+                self.assertEqual(len(httpretty.HTTPretty.latest_requests), calls + 1)
+
+                r = self.client.get(url_for('user.execute_query', queryid='CACHED'),
+                        headers={'Authorization': 'secret', 'If-None-Match': etag}, query_string={'fl': 'title'})
+                self.assertStatus(r, 304)
+
+                # other parameters, or other credentials, are not served from the cache
+                self.client.get(url_for('user.execute_query', queryid='CACHED'),
+                        headers={'Authorization': 'secret'}, query_string={'fl': 'abstract'})
+                self.client.get(url_for('user.execute_query', queryid='CACHED'),
+                        headers={'Authorization': 'other'}, query_string={'fl': 'title'})
+                self.assertEqual(len(httpretty.HTTPretty.latest_requests), calls + 3)
+        finally:
+            self.app.result_cache.ttl = 0
+            self.app.config['VAULT_STREAM_SOLR_RESPONSES'] = True
+
+        self.assertTrue(self.app.result_cache.stats()['hit_ratio'] > 0)
+
+    @httpretty.activate
+    def test_payload_deduplication(self):
+        '''Tests that the same payload saved by different users is stored once'''
+
+        httpretty.register_uri(
+            httpretty.POST, self.app.config.get('VAULT_SOLR_BIGQUERY_ENDPOINT'),
+            content_type='application/json',
+            status=200,
+            body='{"responseHeader": {"status": 0}, "response": {"numFound": 2, "start": 0, "docs": []}}')
+
+        qids = []
+        for uid in ('1', '2', '3'):
+            r = self.client.post(url_for('user.query'),
+                    headers={'Authorization': 'secret', 'X-api-uid': uid},
+                    data=json.dumps({'q': '*:*', 'fq': '{!bitset}', 'bigquery': 'bibcode\n2015ApJ...800...1A'}),
+                    content_type='application/json')
+            self.assertStatus(r, 200)
+            qids.append(r.json['qid'])
+
+        self.assertEqual(len(set(qids)), 3)
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Query).count(), 3)
+            self.assertEqual(session.query(QueryPayload).count(), 1)
+            self.assertEqual(session.query(QueryBigquery).count(), 1)
+
+        # every qid still resolves to the full payload
+        for qid in qids:
+            r = self.client.get(url_for('user.query', queryid=qid),
+                    headers={'Authorization': 'secret'})
+            self.assertStatus(r, 200)
+            self.assertEqual(json.loads(r.json['query'])['bigquery'], 'bibcode\n2015ApJ...800...1A')
+
+        # rows written before payloads were shared are still readable
+        q = Query(qid='ABCD', query=json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8'), numfound=5)
+        self.app.db.session.add(q)
+        self.app.db.session.commit()
+
+        r = self.client.get(url_for('user.query', queryid='ABCD'),
+                headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['query'], json.dumps({'query': 'q=foo', 'bigquery': ''}))
+
+    @httpretty.activate
+    def test_concurrent_query_storage(self):
+        '''Tests that identical submissions racing each other store one query'''
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            status=200,
+            body='{"responseHeader": {"status": 0}, "response": {"numFound": 42, "start": 0, "docs": []}}')
+
+        url = url_for('user.query')
+
+        def post(i):
+            with self.app.test_client() as client:
+                return client.post(url,
+                        headers={'Authorization': 'secret', 'X-api-uid': '7'},
+                        data=json.dumps({'q': 'title:race'}),
+                        content_type='application/json')
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            responses = list(executor.map(post, range(200)))
+
+        self.assertEqual(set(r.status_code for r in responses), {200})
+        self.assertEqual(len(set(r.json['qid'] for r in responses)), 1)
+        self.assertEqual(set(r.json['numFound'] for r in responses), {42})
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Query).count(), 1)
+            self.assertEqual(session.query(QueryPayload).count(), 1)
+
+    @httpretty.activate
+    def test_deferred_validation(self):
+        '''Tests that in deferred mode the qid is handed out before solr
+        has seen the query'''
+
+        def callback(request, uri, headers):
+            headers['Content-Type'] = 'application/json'
+            if 'invalid' in uri:
+                return (400, headers, '{"error": {"msg": "undefined field invalid"}}')
+            if 'limited' in uri:
+                return (429, headers, '{"error": {"msg": "too many requests"}}')
+            return (200, headers, '{"responseHeader": {"status": 0}, "response": {"numFound": 42, "start": 0, "docs": []}}')
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            body=callback)
+
+        self.app.config['VAULT_DEFERRED_VALIDATION'] = True
+        self.app.query_validator.backoff = 0
+        try:
+            r = self.client.post(url_for('user.query'),
+                    headers={'Authorization': 'secret'},
+                    data=json.dumps({'q': 'title:deferred'}),
+                    content_type='application/json')
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['status'], 'pending')
+            self.assertEqual(r.json['numFound'], 0)
+            qid = r.json['qid']
+
+            r = self.client.post(url_for('user.query'),
+                    headers={'Authorization': 'secret'},
+                    data=json.dumps({'q': 'invalid:field'}),
+                    content_type='application/json')
+            self.assertStatus(r, 200)
+            invalid_qid = r.json['qid']
+
+            r = self.client.post(url_for('user.query'),
+                    headers={'Authorization': 'secret'},
+                    data=json.dumps({'q': 'title:limited'}),
+                    content_type='application/json')
+            self.assertStatus(r, 200)
+            limited_qid = r.json['qid']
+
+            self.app.query_validator.join(timeout=10)
+        finally:
+            self.app.config['VAULT_DEFERRED_VALIDATION'] = False
+
+        r = self.client.get(url_for('user.query', queryid=qid),
+                headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['status'], 'valid')
+        self.assertEqual(r.json['numfound'], 42)
+
+        r = self.client.get(url_for('user.query', queryid=invalid_qid),
+                headers={'Authorization': 'secret'})
+        self.assertEqual(r.json['status'], 'invalid')
+
+        # solr is not asked to run a query it refused
+        r = self.client.get(url_for('user.execute_query', queryid=invalid_qid),
+                headers={'Authorization': 'secret'})
+        self.assertStatus(r, 400)
+        self.assertEqual(r.headers['X-Vault-Query-Status'], 'invalid')
+
+        # a rate limited query is not the query's fault: it stays pending
+        r = self.client.get(url_for('user.query', queryid=limited_qid),
+                headers={'Authorization': 'secret'})
+        self.assertEqual(r.json['status'], 'pending')
+
+        stats = self.app.query_validator.stats()
+        self.assertEqual(stats['validated'], 1)
+        self.assertEqual(stats['invalid'], 1)
+
+        # with the queue full, the query waits for the refresher
+        self.app.config['VAULT_DEFERRED_VALIDATION'] = True
+        self.app.query_validator.queue_size = 0
+        try:
+            r = self.client.post(url_for('user.query'),
+                    headers={'Authorization': 'secret'},
+                    data=json.dumps({'q': 'title:dropped'}),
+                    content_type='application/json')
+            self.assertEqual(r.json['status'], 'pending')
+            qid = r.json['qid']
+        finally:
+            self.app.config['VAULT_DEFERRED_VALIDATION'] = False
+            self.app.query_validator.queue_size = 1000
+        self.assertEqual(self.app.query_validator.stats()['dropped'], 1)
+
+        stats = NumfoundRefresher(self.app, rate=0, pending_age=0).run()
+        self.assertEqual(stats['refreshed'], 1)
+        # still rate limited
+        self.assertEqual(stats['failed'], 1)
+        with self.app.session_scope() as session:
+            q = session.query(Query).filter_by(qid=qid).one()
+            self.assertEqual((q.status, q.numfound), ('valid', 42))
+
+    @httpretty.activate
+    def test_solr_circuit_breaker(self):
+        '''Tests that vault stops waiting on solr once it keeps failing'''
+
+        self.solr_down = True
+
+        def callback(request, uri, headers):
+            headers['Content-Type'] = 'application/json'
+            if self.solr_down:
+                return (500, headers, '{"error": {"msg": "solr is down"}}')
+            return (200, headers, '{"responseHeader": {"status": 0}, "response": {"numFound": 5, "start": 0, "docs": []}}')
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            body=callback)
+
+        self.app.solr_breaker.threshold = 2
+        self.app.query_validator.backoff = 0
+        for q in ('title:a', 'title:b'):
+            r = self.client.post(url_for('user.query'),
+                    headers={'Authorization': 'secret'},
+                    data=json.dumps({'q': q}),
+                    content_type='application/json')
+            self.assertStatus(r, 404)
+        self.assertEqual(self.app.solr_breaker.state, 'open')
+        calls = len(httpretty.HTTPretty.latest_requests)
+
+        # new queries are stored for the background validator to check later
+        r = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps({'q': 'title:c'}),
+                content_type='application/json')
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['status'], 'pending')
+
+        # what cannot wait fails right away
+        r = self.client.post(url_for('user.myads_notifications'),
+                headers={'Authorization': 'secret', 'X-api-uid': '3'},
+                data=json.dumps({'type': 'template', 'template': 'arxiv', 'classes': ['astro-ph'], 'data': 'star'}),
+                content_type='application/json')
+        self.assertStatus(r, 503)
+        self.assertIn('Retry-After', r.headers)
+        self.app.query_validator.join(timeout=10)
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), calls)
+
+        r = self.client.get('/metrics')
+        self.assertEqual(r.json['solr_breaker']['state'], 'open')
+        self.assertTrue(r.json['solr_breaker']['rejected'] >= 2)
+
+        # once the reset timeout is over, a probe closes the circuit again
+        self.solr_down = False
+        self.app.solr_breaker._opened_at = 0
+        r = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps({'q': 'title:d'}),
+                content_type='application/json')
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['status'], 'valid')
+        self.assertEqual(self.app.solr_breaker.state, 'closed')
+
+    def test_pool_saturated(self):
+        '''Tests that a busy solr connection pool is reported as such'''
+
+        payload = json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8')
+        with self.app.session_scope() as session:
+            session.add(Query(qid='BUSY', query=payload, numfound=1))
+            session.commit()
+
+        with mock.patch.object(self.app.client, 'get', side_effect=PoolSaturated('All connections are busy',
+                                                                                   retry_after=4.5)):
+            r = self.client.get(url_for('user.execute_query', queryid='BUSY'),
+                    headers={'Authorization': 'secret'})
+        self.assertStatus(r, 503)
+        self.assertEqual(r.headers['Retry-After'], '5')
+        # refused on our side, not a solr failure
+        self.assertEqual(self.app.solr_breaker.state, 'closed')
+
+    @httpretty.activate
+    def test_batch_query_storage(self):
+        '''Tests storing many queries with one request'''
+
+        def callback(request, uri, headers):
+            headers['Content-Type'] = 'application/json'
+            if 'invalid' in uri:
+                return (400, headers, '{"error": {"msg": "undefined field invalid"}}')
+            return (200, headers, '{"responseHeader": {"status": 0}, "response": {"numFound": 7, "start": 0, "docs": []}}')
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            body=callback)
+
+        r = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps({'q': 'title:stored'}),
+                content_type='application/json')
+        self.assertStatus(r, 200)
+        stored_qid = r.json['qid']
+
+        r = self.client.post(url_for('user.queries'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps([{'q': 'title:one'},
+                                 {'q': 'title:stored'},
+                                 {'q': 'title:one'},
+                                 {'q': 'invalid:field'},
+                                 {'q': 'title:two', 'bigquery': 'one\ntwo'}]),
+                content_type='application/json')
+        self.assertStatus(r, 200)
+        results = r.json['queries']
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0]['numFound'], 7)
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1]['qid'], stored_qid)
+        self.assertEqual(results[3]['msg'], 'Could not verify the query.')
+        self.assertTrue('bitset' in results[4]['msg'])
+
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Query).count(), 2)
+            self.assertEqual(session.query(Query).filter_by(qid=results[0]['qid']).one().numfound, 7)
+
+        r = self.client.post(url_for('user.queries'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps([{'q': 'title:%s' % i} for i in range(self.app.config['VAULT_BATCH_MAX_QUERIES'] + 1)]),
+                content_type='application/json')
+        self.assertStatus(r, 400)
+
+    def test_batch_query_resolution(self):
+        '''Tests retrieving many stored queries with one request'''
+
+        with self.app.session_scope() as session:
+            for i in range(3):
+                payload = json.dumps({'query': 'q=foo%d' % i, 'bigquery': ''}).encode('utf8')
+                session.add(Query(qid='QID%d' % i, query=payload, numfound=i))
+            session.commit()
+
+        r = self.client.get(url_for('user.resolve_queries'),
+                headers={'Authorization': 'secret'},
+                query_string={'qid': 'QID2,MISSING,QID0'})
+        self.assertStatus(r, 200)
+        results = r.json['queries']
+        self.assertEqual([x['qid'] for x in results], ['QID2', 'MISSING', 'QID0'])
+        self.assertEqual(results[0]['numfound'], 2)
+        self.assertEqual(results[0]['query'], json.dumps({'query': 'q=foo2', 'bigquery': ''}))
+        self.assertEqual(results[1]['msg'], 'Query not found: MISSING')
+
+        # same shape as the single item endpoint
+        r = self.client.get(url_for('user.query', queryid='QID0'),
+                headers={'Authorization': 'secret'})
+        self.assertEqual(r.json, results[2])
+
+        r = self.client.post('/queries/resolve',
+                headers={'Authorization': 'secret'},
+                data=json.dumps({'qids': ['QID1', 'QID1']}),
+                content_type='application/json')
+        self.assertStatus(r, 200)
+        self.assertEqual([x['numfound'] for x in r.json['queries']], [1, 1])
+
+        r = self.client.get(url_for('user.resolve_queries'),
+                headers={'Authorization': 'secret'},
+                query_string={'qid': ','.join('Q%d' % i for i in range(self.app.config['VAULT_BATCH_MAX_QIDS'] + 1))})
+        self.assertStatus(r, 400)
+
+    @httpretty.activate
+    def test_canonical_qids(self):
+        '''Tests that equivalent queries share a qid, and that qids given out
+        before canonicalization keep being used'''
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            status=200,
+            body='{"responseHeader": {"status": 0}, "response": {"numFound": 99, "start": 0, "docs": []}}')
+
+        r1 = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps({'q': 'title:foo  author:bar', 'fq': ['year:2000', 'database:astronomy']}),
+                content_type='application/json')
+        r2 = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps({'q': 'title:foo author:bar', 'fq': ['database:astronomy', 'year:2000', 'year:2000']}),
+                content_type='application/json')
+        self.assertStatus(r2, 200)
+        self.assertEqual(r1.json['qid'], r2.json['qid'])
+
+        # a qid stored under the original rules
+        submitted = {'q': 'title:baz', 'fq': ['year:2000', 'database:astronomy']}
+        legacy = utils.cleanup_payload(submitted)
+        legacy_qid = utils.query_qid(legacy, {'X-Api-Uid': str(self.app.config['BOOTSTRAP_USER_ID'])})
+        with self.app.session_scope() as session:
+            session.add(Query(qid=legacy_qid, query=json.dumps(legacy).encode('utf8'), numfound=5))
+            session.commit()
+
+        r = self.client.post(url_for('user.query'),
+                headers={'Authorization': 'secret'},
+                data=json.dumps(submitted),
+                content_type='application/json')
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['qid'], legacy_qid)
+        self.assertEqual(r.json['numFound'], 5)
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Query).count(), 2)
+
+    def test_query_http_caching(self):
+        '''Tests the validators sent with stored queries'''
+
+        payload = json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8')
+        with self.app.session_scope() as session:
+            session.add(Query(qid='ETAG', query=payload, numfound=1))
+            session.commit()
+
+        r = self.client.get(url_for('user.query', queryid='ETAG'), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        etag = r.headers['ETag']
+        self.assertTrue(etag.startswith('"ETAG-'))
+        self.assertEqual(r.headers['Cache-Control'], 'public, max-age=300')
+
+        r = self.client.get(url_for('user.query', queryid='ETAG'),
+                headers={'Authorization': 'secret', 'If-None-Match': etag})
+        self.assertStatus(r, 304)
+
+        # a new numfound means a new etag
+        with self.app.session_scope() as session:
+            session.query(Query).filter_by(qid='ETAG').update({'numfound': 2})
+            session.commit()
+        self.app.query_cache.clear()
+        r = self.client.get(url_for('user.query', queryid='ETAG'),
+                headers={'Authorization': 'secret', 'If-None-Match': etag})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['numfound'], 2)
+        self.assertNotEqual(r.headers['ETag'], etag)
+
+        # the payload alone never changes
+        r = self.client.get(url_for('user.query_payload', queryid='ETAG'), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json, {'qid': 'ETAG', 'query': json.dumps({'query': 'q=foo', 'bigquery': ''})})
+        self.assertEqual(r.headers['ETag'], '"ETAG"')
+        self.assertTrue(r.headers['Cache-Control'].endswith('immutable'))
+
+        # and is revalidated without a lookup
+        recorded = self.app.access_tracker.stats()['recorded']
+        r = self.client.get(url_for('user.query_payload', queryid='ETAG'),
+                headers={'Authorization': 'secret', 'If-None-Match': '"ETAG"'})
+        self.assertStatus(r, 304)
+        self.assertEqual(self.app.access_tracker.stats()['recorded'], recorded + 1)
+        with self.app.session_scope() as session:
+            session.query(Query).filter_by(qid='ETAG').delete()
+            session.commit()
+        self.app.query_cache.clear()
+        r = self.client.get(url_for('user.query_payload', queryid='ETAG'),
+                headers={'Authorization': 'secret', 'If-None-Match': '"ETAG"'})
+        self.assertStatus(r, 304)
+        # a read is only counted for a qid known to exist
+        self.assertEqual(self.app.access_tracker.stats()['recorded'], recorded + 1)
+
+    def test_qid_is_unique(self):
+        '''Tests that the same qid cannot be stored twice'''
+
+        payload = json.dumps({'query': 'q=foo', 'bigquery': ''}).encode('utf8')
+        self.app.db.session.add(Query(qid='ABCD', query=payload, numfound=1))
+        self.app.db.session.commit()
+
+        self.app.db.session.add(Query(qid='ABCD', query=payload, numfound=2))
+        self.assertRaises(exc.IntegrityError, self.app.db.session.commit)
+        self.app.db.session.rollback()
+
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Query).filter_by(qid='ABCD').count(), 1)
+
+    @httpretty.activate
+    def test_binary_qids(self):
+        '''Tests that qids are stored as the 16 digest bytes, and stay hex strings in the API'''
+
+        httpretty.register_uri(
+            httpretty.GET, self.app.config.get('VAULT_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            status=200,
+            body='{"responseHeader": {"status": 0}, "response": {"numFound": 7, "start": 0, "docs": []}}')
+
+        r = self.client.post(url_for('user.query'),
+                             headers={'Authorization': 'secret'},
+                             data=json.dumps({'q': 'foo:bar'}),
+                             content_type='application/json')
+        self.assertStatus(r, 200)
+        qid = r.json['qid']
+        self.assertEqual(len(qid), 32)
+
+        with self.app.session_scope() as session:
+            key = session.execute('SELECT qid FROM queries').scalar()
+            self.assertEqual(bytes(key), bytes.fromhex(qid))
+            self.assertEqual(session.query(Query).filter_by(qid=qid).one().qid, qid)
+
+        # hex is hex, whatever the case
+        r = self.client.get(url_for('user.query', queryid=qid.upper()), headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['qid'], qid)
+        r = self.client.get(url_for('queryalls.query2svg', queryid=qid.upper()))
+        self.assertStatus(r, 200)
+        r = self.client.get(url_for('user.resolve_queries'), query_string={'qid': qid.upper()},
+                            headers={'Authorization': 'secret'})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['queries'][0]['qid'], qid)
+        self.assertEqual(r.json['queries'][0]['numfound'], 7)
+
+        # qids that are not digests are kept as they are
+        for legacy in ('COLD', 'x' * 16):
+            self.assertEqual(key_qid(qid_key(legacy)), legacy)
+        self.assertNotEqual(qid_key('x' * 16), bytes.fromhex('78' * 16))
+
     def test_store_data(self):
         '''Tests the ability to store data'''
 
@@ -236,6 +969,19 @@ class TestServices(TestCaseDatabase):
         self.assertTrue(r.json['active'])
         myads_id = r.json['id']
 
+        # the setup keeps the qid, so that reading it only touches one partition of queries
+        with self.app.session_scope() as session:
+            setup = session.query(MyADS).filter_by(id=myads_id).one()
+            self.assertEqual(setup.query_qid, qid)
+            # setups from before query_qid are still found by id
+            setup.query_qid = None
+            session.commit()
+        self.app.query_cache.clear()
+        r = self.client.get(url_for('user.myads_notifications', myads_id=myads_id),
+                            headers={'Authorization': 'secret', 'X-api-uid': '3'})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json[0]['qid'], qid)
+
         # edit the query with bad data
         r = self.client.put(url_for('user.myads_notifications', myads_id=myads_id),
                             headers={'Authorization': 'secret', 'X-api-uid': '3'},
@@ -0,0 +1,128 @@
+"""
+    vault_service.validation
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Background validation of queries stored in 'pending' state (deferred
+    validation mode of POST /query): the solr round trip happens after the
+    qid has been handed out, and fills in numfound - or marks the query
+    invalid if solr rejects it. Errors that are not the query's fault (5xx,
+    and 401/403/429: our token, or a rate limit) are retried, as the
+    refresher does, and leave the query pending if they persist.
+
+    At most `queue_size` validations wait in a worker; beyond that, and for
+    whatever a restart loses or solr leaves pending, the query stays
+    pending until the refresher (scripts/refresh_numfound.py) gets to it -
+    it sweeps pending queries first.
+"""
+import threading
+import time
+from concurrent import futures
+
+from sqlalchemy import exc
+
+from .breaker import CircuitOpenError
+
+
+class QueryValidator(object):
+
+    def __init__(self, app, workers=4, retries=3, backoff=1.0, queue_size=1000):
+        self.app = app
+        self.retries = retries
+        self.backoff = backoff
+        self.queue_size = queue_size
+        self.submitted = 0
+        self.dropped = 0
+        self.validated = 0
+        self.invalid = 0
+        self.failed = 0
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, qid, payload, headers):
+        """Queues the validation; returns its future, or None if the queue
+        is full (the query is left to the refresher)"""
+        with self._lock:
+            if self.queue_size is not None and len(self._futures) >= self.queue_size:
+                self.dropped += 1
+                self.app.logger.warning('Validation queue full, query {0} stays pending'.format(qid))
+                return None
+            self.submitted += 1
+            future = self._executor.submit(self._run, qid, payload, headers)
+            self._futures.add(future)
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def join(self, timeout=None):
+        """Waits for the validations submitted so far to finish"""
+        with self._lock:
+            pending = list(self._futures)
+        futures.wait(pending, timeout=timeout)
+
+    def _run(self, qid, payload, headers):
+        with self.app.app_context():
+            try:
+                return self.validate(qid, payload, headers)
+            except Exception as e:
+                self.failed += 1
+                self.app.logger.error('Deferred validation of {0} failed: {1}'.format(qid, e))
+                raise
+
+    def validate(self, qid, payload, headers):
+        """Validates the query and records the outcome; solr errors (5xx,
+        401, 403, 429) are retried, anything else solr refuses makes the
+        query invalid. Returns the new status, or 'pending' when solr stayed
+        unavailable"""
+        from .views.utils import validate_query, record_validation, load_query, load_bigquery
+
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            bigquery = payload['bigquery']
+            if bigquery is None:
+                # streamed uploads are not kept around, read back what was stored
+                bigquery = load_bigquery(load_query(qid=qid))
+            try:
+                r = validate_query(query=payload['query'] + '&wt=json', bigquery=bigquery, headers=headers)
+            except CircuitOpenError:
+                # solr is known to be down, wait like for a 5xx
+                continue
+            if r.status_code < 500 and r.status_code not in (401, 403, 429):
+                break
+        else:
+            self.app.logger.warning('Solr unavailable, query {0} stays pending'.format(qid))
+            return 'pending'
+
+        if r.status_code == 200:
+            numfound = 0
+            try:
+                numfound = int(r.json()['response']['numFound'])
+            except:
+                pass
+            status = 'valid'
+            self.validated += 1
+        else:
+            numfound = 0
+            status = 'invalid'
+            self.invalid += 1
+
+        with self.app.session_scope() as session:
+            try:
+                record_validation(session, qid, status, numfound)
+                session.commit()
+            except exc.SQLAlchemyError:
+                session.rollback()
+                raise
+        return status
+
+    def stats(self):
+        return {'submitted': self.submitted,
+                'dropped': self.dropped,
+                'validated': self.validated,
+                'invalid': self.invalid,
+                'failed': self.failed,
+                'queued': len(self._futures)}
@@ -1,6 +1,6 @@
-
 from . import user
 from . import query_as_monument
 from . import bumblebee
+from . import metrics
 
-__all__ = ['user', 'query_as_monument', 'bumblebee']
\ No newline at end of file
+__all__ = ['user', 'query_as_monument', 'bumblebee', 'metrics']
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+    vault_service.views.canonical
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Canonical form of a query payload - the form that is hashed into the qid
+    and stored. Equivalent queries (filters in another order, extra
+    whitespace outside of quoted phrases, other url-encodings of the same
+    characters) end up with the same canonical form, and so with the same
+    qid.
+
+    The rules are versioned: version 0 is the plain cleanup_payload() every
+    qid was computed with originally; qids computed under an older version
+    keep resolving through compatible_qids().
+"""
+import re
+import unicodedata
+import urllib.parse as urlparse
+
+from flask import current_app
+
+from .utils import cleanup_payload, serialize_dict, query_qid
+
+CANONICAL_VERSION = 1
+
+# a quoted phrase, up to the end of the value if it is not closed
+QUOTED = re.compile(r'("(?:[^"\\]|\\.)*(?:"|$))')
+
+
+def _normalize_value(value):
+    # whitespace between terms does not matter to solr; inside a phrase
+    # (or a string field value) everything is left as it is
+    parts = QUOTED.split(value)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', unicodedata.normalize('NFC', parts[i]))
+    parts[0] = parts[0].lstrip()
+    parts[-1] = parts[-1].rstrip()
+    return ''.join(parts)
+
+
+def _canonical_bigquery(bigquery):
+    """Sorted, deduplicated bigquery lines; the first line (the field name)
+    stays where it is"""
+    lines = [x.strip() for x in bigquery.splitlines()]
+    lines = [x for x in lines if x]
+    if len(lines) < 2:
+        return '\n'.join(lines)
+    return '\n'.join([lines[0]] + sorted(set(lines[1:])))
+
+
+def _canonical_v1(payload, sort_bigquery=False):
+    cleaned = cleanup_payload(payload)
+    query = {}
+    for k, v in urlparse.parse_qs(cleaned['query'], keep_blank_values=True).items():
+        v = [_normalize_value(x) for x in v]
+        # filters are ANDed together, their order (and repetition) is
+        # irrelevant; not so for fq_* parameters, referenced with $ by name
+        if k == 'fq':
+            v = sorted(set(v))
+        query[k] = v
+    bigquery = cleaned['bigquery']
+    if bigquery and sort_bigquery:
+        bigquery = _canonical_bigquery(bigquery)
+    return {'query': serialize_dict(query), 'bigquery': bigquery}
+
+
+VERSIONS = {
+    0: lambda payload, sort_bigquery=False: cleanup_payload(payload),
+    1: _canonical_v1,
+}
+
+
+def canonicalize(payload, version=None, sort_bigquery=None):
+    """Cleans up a submitted payload (the same way cleanup_payload does) and
+    brings it into canonical form. Defaults to VAULT_CANONICAL_VERSION and
+    VAULT_CANONICAL_SORT_BIGQUERY; sorting the bigquery lines is opt-in, as
+    it changes the order the bibcodes are stored (and returned) in."""
+    if version is None:
+        version = current_app.config.get('VAULT_CANONICAL_VERSION', CANONICAL_VERSION)
+    if sort_bigquery is None:
+        sort_bigquery = current_app.config.get('VAULT_CANONICAL_SORT_BIGQUERY', False)
+    if version not in VERSIONS:
+        raise Exception('Unknown canonicalization version: {0}'.format(version))
+    return VERSIONS[version](payload, sort_bigquery=sort_bigquery)
+
+
+def compatible_qids(payload, headers, canonical, version=None, sort_bigquery=None):
+    """The qids the submitted payload got under the older versions, newest
+    first, leaving out those equal to the qid of `canonical` (the payload
+    in current canonical form)"""
+    if version is None:
+        version = current_app.config.get('VAULT_CANONICAL_VERSION', CANONICAL_VERSION)
+    if sort_bigquery is None:
+        sort_bigquery = current_app.config.get('VAULT_CANONICAL_SORT_BIGQUERY', False)
+    qids = []
+    seen = {query_qid(canonical, headers)}
+    for v in range(version - 1, -1, -1):
+        try:
+            qid = query_qid(canonicalize(payload, version=v, sort_bigquery=sort_bigquery), headers)
+        except Exception:
+            continue
+        if qid not in seen:
+            seen.add(qid)
+            qids.append(qid)
+    return qids
@@ -0,0 +1,28 @@
+from flask import Blueprint
+from flask import current_app
+from flask_discoverer import advertise
+import json
+
+bp = Blueprint('metrics', __name__)
+
+
+@advertise(scopes=[], rate_limit = [1000, 3600*24])
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    '''Returns the counters of the in-process caches, of the solr
+    request coalescing, circuit breaker and hedging, of the background
+    validation, of the access tracking, of the unknown qid filter and of
+    the upstream connection pools; the numbers are per worker process
+    '''
+    return json.dumps({
+        'query_cache': current_app.query_cache.stats(),
+        'result_cache': current_app.result_cache.stats(),
+        'badge_cache': current_app.badge_cache.stats(),
+        'solr_singleflight': current_app.solr_flight.stats(),
+        'solr_breaker': current_app.solr_breaker.stats(),
+        'solr_hedging': current_app.solr_hedger.stats(),
+        'query_validator': current_app.query_validator.stats(),
+        'access_tracker': current_app.access_tracker.stats(),
+        'qid_filter': current_app.qid_filter.stats(),
+        'http_pools': current_app.client.stats()
+        }), 200
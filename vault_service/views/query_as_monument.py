@@ -1,7 +1,10 @@
+import threading
+
 from flask import Blueprint
-from flask import current_app
+from flask import current_app, request
 from flask_discoverer import advertise
 from ..models import Query
+from .utils import restore_queries, qid_param
 
 '''
 Blueprint full of exportable queries, constructed
@@ -21,16 +24,63 @@ SVG_TMPL = '''
 <text x="80" y="15" fill="#010101" fill-opacity=".3">%(value)s</text><text x="80" y="14">%(value)s</text></g></svg>
 '''
 
+NOT_FOUND_SVG = '<svg xmlns="http://www.w3.org/2000/svg"></svg>'
+
+
+def render_badge(queryid, use_query_cache=True):
+    '''Renders the badge of a qid (an empty svg with 404 for unknown qids)
+    and puts it into the badge cache; returns the cache entry'''
+    q = current_app.query_cache.get(qid=queryid) if use_query_cache else None
+    if q:
+        numfound = q['numfound']
+    elif not current_app.qid_filter.might_contain(queryid):
+        return current_app.badge_cache.set(queryid, 404, NOT_FOUND_SVG.encode('utf8'))
+    else:
+        with current_app.session_scope() as session:
+            # only numfound is needed; don't drag the payload blob along
+            q = session.query(Query.numfound).filter_by(qid=queryid).first()
+            if not q and restore_queries([queryid], session=session):
+                q = session.query(Query.numfound).filter_by(qid=queryid).first()
+                session.commit()
+            if not q:
+                current_app.qid_filter.missed(queryid)
+                return current_app.badge_cache.set(queryid, 404, NOT_FOUND_SVG.encode('utf8'))
+            numfound = q.numfound
+    svg = SVG_TMPL % {'key': 'ADS query', 'value': numfound or 0}
+    return current_app.badge_cache.set(queryid, 200, svg.encode('utf8'))
+
+
+def _refresh_badge(app, queryid):
+    with app.app_context():
+        try:
+            render_badge(queryid, use_query_cache=False)
+        except Exception as e:
+            app.logger.error('Could not refresh the badge of {0}: {1}'.format(queryid, e))
+        finally:
+            app.badge_cache.end_refresh(queryid)
+
+
 @advertise(scopes=[], rate_limit = [1000000, 3600*24])
 @bp.route('/query2svg/<queryid>', methods=['GET'])
 def query2svg(queryid):
-    '''Returns the SVG form of the query - for better performance, will need
-    to be cached/exported
+    '''Returns the SVG form of the query; rendered badges are cached, and
+    served a while longer (stale) while they are re-rendered in the background
     '''
+    queryid = qid_param(queryid)
+    cache = current_app.badge_cache
+    entry, fresh = cache.get(queryid)
+    if entry is None:
+        entry = render_badge(queryid)
+    elif not fresh and cache.begin_refresh(queryid):
+        threading.Thread(target=_refresh_badge, args=(current_app._get_current_object(), queryid)).start()
 
-    with current_app.session_scope() as session:
-        q = session.query(Query).filter_by(qid=queryid).first()
-        if not q:
-            return '<svg xmlns="http://www.w3.org/2000/svg"></svg>', 404, {'Content-Type': "image/svg+xml"}
+    if entry['status'] == 200:
+        current_app.access_tracker.record(queryid)
 
-        return SVG_TMPL % {'key': 'ADS query', 'value': q.numfound}, 200, {'Content-Type': "image/svg+xml"}
+    headers = {'Content-Type': "image/svg+xml", 'ETag': '"{0}"'.format(entry['etag'])}
+    if cache.enabled:
+        headers['Cache-Control'] = 'public, max-age={0}, stale-while-revalidate={1}'.format(
+            cache.ttl if entry['status'] == 200 else cache.negative_ttl, cache.stale_ttl)
+    if entry['status'] == 200 and request.if_none_match.contains(entry['etag']):
+        return '', 304, headers
+    return entry['body'], entry['status'], headers
@@ -3,14 +3,20 @@ from flask import current_app
 from flask import request, url_for
 
 import json
-from hashlib import md5
 import urllib.parse as urlparse
 import datetime
 
 from sqlalchemy import exc
 from sqlalchemy.orm import exc as ormexc
 from ..models import Query, User, MyADS, Library
-from .utils import check_request, cleanup_payload, make_solr_request, upsert_myads, get_keyword_query_name
+from ..breaker import CircuitOpenError
+from .canonical import canonicalize, compatible_qids
+from .utils import check_request, make_solr_request, validate_query, upsert_myads, get_keyword_query_name, \
+    load_query, load_bigquery, stored_query_json, store_query, store_queries, validate_queries, query_qid, \
+    load_queries, require_bitset, BigqueryIngest, BigqueryReader, proxy_response, \
+    result_cache_key, result_cache_headers, query_etag, restore_queries, qid_param, query_params, \
+    cursor_query, iterate_results
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_discoverer import advertise
 from dateutil import parser
 from adsmutils import get_date
@@ -31,14 +37,34 @@ def query(queryid=None):
     }
     '''
     if request.method == 'GET' and queryid:
-        with current_app.session_scope() as session:
-            q = session.query(Query).filter_by(qid=queryid).first()
-            if not q:
-                return json.dumps({'msg': 'Query not found: ' + queryid}), 404
-            return json.dumps({
-                'qid': q.qid,
-                'query': q.query.decode('utf8'), # bytes to string
-                'numfound': q.numfound }), 200
+        queryid = qid_param(queryid)
+        # qids that were never stored are turned away without a db lookup
+        if not current_app.qid_filter.might_contain(queryid):
+            return json.dumps({'msg': 'Query not found: ' + queryid}), 404
+        q = load_query(qid=queryid)
+        if not q:
+            current_app.qid_filter.missed(queryid)
+            return json.dumps({'msg': 'Query not found: ' + queryid}), 404
+        current_app.access_tracker.record(q['qid'])
+        # numfound/status may still change, so the response is only
+        # cacheable for a while; the etag changes along with them
+        headers = {'ETag': '"{0}"'.format(query_etag(q)),
+                   'Cache-Control': 'public, max-age={0}'.format(current_app.config.get('VAULT_QUERY_MAX_AGE', 300))}
+        if request.if_none_match.contains(query_etag(q)):
+            return '', 304, headers
+        return json.dumps({
+            'qid': q['qid'],
+            'query': stored_query_json(q),
+            'numfound': q['numfound'],
+            'status': q.get('status', 'valid') }), 200, headers
+
+    # refuse oversized uploads before reading them
+    max_bytes = current_app.config.get('VAULT_MAX_QUERY_BYTES')
+    if max_bytes and request.content_length and request.content_length > max_bytes:
+        return json.dumps({'msg': 'The query is bigger than {0} bytes'.format(max_bytes)}), 413
+
+    if request.mimetype == 'big-query/csv':
+        return _store_streamed_query()
 
     # get the query data
     try:
@@ -49,23 +75,84 @@ def query(queryid=None):
     if len(list(payload.keys())) == 0:
         raise Exception('Query cannot be empty')
 
-    payload = cleanup_payload(payload)
+    submitted = payload
+    payload = canonicalize(submitted)
 
 
     # check we don't have this query already. If the query exist do not reissue query but return 
     # values previously stored in the database (infinite cache like behavior)
-    query = json.dumps(payload).encode('utf8')
-    # digest is made of a bytestream
-    qid = md5((headers['X-Api-Uid'].encode('utf8') + query)).hexdigest()
-    with current_app.session_scope() as session:
-        q = session.query(Query).filter_by(qid=qid).first()
+    qid = query_qid(payload, headers)
+    return _save_query(qid, payload, headers, aliases=compatible_qids(submitted, headers, payload))
+
+
+def _store_streamed_query():
+    '''POST /query with the bigquery as the raw request body (content type
+    big-query/csv, like the solr bigquery endpoint) and the rest of the
+    query in the url; the body is compressed and hashed as it is read, so
+    it is never held in memory in full. The qid is the same as if the
+    bigquery had been posted inside a json payload.
+    '''
+    try:
+        _, headers = check_request(request)
+        payload = canonicalize(request.args.to_dict(flat=False))
+        require_bitset(urlparse.parse_qs(payload['query']))
+    except Exception as e:
+        return json.dumps({'msg': str(e)}), 400
+
+    ingest = BigqueryIngest(payload, headers['X-Api-Uid'],
+                            codec=current_app.config.get('VAULT_BIGQUERY_CODEC', 'zlib'),
+                            max_bytes=current_app.config.get('VAULT_MAX_QUERY_BYTES'))
+    try:
+        ingest.read_from(request.stream)
+    except RequestEntityTooLarge as e:
+        return json.dumps({'msg': e.description}), 413
+    except UnicodeDecodeError as e:
+        return json.dumps({'msg': 'The bigquery is not valid utf-8: {0}'.format(e)}), 400
+    if ingest.size == 0:
+        return json.dumps({'msg': 'The bigquery cannot be empty'}), 400
+
+    return _save_query(ingest.qid, payload, headers, ingest=ingest)
+
+
+def _save_query(qid, payload, headers, ingest=None, aliases=()):
+    '''Validates and stores a canonical payload under its qid, unless it
+    is known already - also under one of the `aliases`, the qids it got
+    under older canonicalization rules; `ingest` carries a streamed bigquery
+    '''
+    q = current_app.query_cache.get(qid=qid)
+    if not q:
+        # known qids are not validated again; just what the answer needs
+        with current_app.session_scope() as session:
+            row = session.query(Query.numfound, Query.status).filter_by(qid=qid).first()
+        if row:
+            q = {'qid': qid, 'numfound': row.numfound, 'status': row.status or 'valid'}
+    for alias in aliases:
         if q:
-            return json.dumps({'qid': qid, 'numFound': q.numfound}), 200
+            break
+        q = load_query(qid=alias)
+    if q:
+        current_app.access_tracker.record(q['qid'])
+        return json.dumps({'qid': q['qid'], 'numFound': q['numfound'], 'status': q.get('status', 'valid')}), 200
+
+    # in deferred mode the qid is handed out right away, solr validates the
+    # query in the background and fills in numFound (or marks it invalid)
+    if current_app.config.get('VAULT_DEFERRED_VALIDATION', False):
+        return _defer_query(qid, payload, headers, ingest=ingest)
 
     # else, reissue new qid
     # first, check the query is valid
     solrq = payload['query'] + '&wt=json'
-    r = make_solr_request(query=solrq, bigquery=payload['bigquery'], headers=headers)
+    try:
+        if ingest is None:
+            r = validate_query(query=solrq, bigquery=payload['bigquery'], headers=headers)
+        else:
+            r = validate_query(query=solrq, bigquery=BigqueryReader(**ingest.blob), headers=headers,
+                               bigquery_digest=ingest.bigquery_digest)
+    except CircuitOpenError:
+        # solr is down; the query is validated once it is back
+        if current_app.config.get('VAULT_SOLR_BREAKER_FALLBACK', 'defer') != 'defer':
+            raise
+        return _defer_query(qid, payload, headers, ingest=ingest)
     if r.status_code != 200:
         return json.dumps({'msg': 'Could not verify the query.', 'query': payload, 'reason': r.text}), 404
 
@@ -76,18 +163,198 @@ def query(queryid=None):
     except:
         pass
 
-    # save the query
-    q = Query(qid=qid, query=query, numfound=num_found)
+    # save the query; the insert checks again, so that identical concurrent
+    # submissions cannot race - the loser gets the stored numFound
+    with current_app.session_scope() as session:
+        try:
+            row = store_query(session, qid, payload, num_found, ingest=ingest)
+            session.commit()
+        except exc.IntegrityError as e:
+            session.rollback()
+            return json.dumps({'msg': str(e)}), 400
+
+        return json.dumps({'qid': qid, 'numFound': row['numfound'], 'status': row['status']}), 200
+
+
+def _defer_query(qid, payload, headers, ingest=None):
+    '''Stores the query as pending and leaves its validation to the
+    background validator'''
     with current_app.session_scope() as session:
-        session.begin_nested()
         try:
-            session.add(q)
+            row = store_query(session, qid, payload, 0, status='pending', ingest=ingest)
             session.commit()
         except exc.IntegrityError as e:
             session.rollback()
-            return json.dumps({'msg': e.message or e.description}), 400
+            return json.dumps({'msg': str(e)}), 400
+
+    if row['inserted']:
+        # a streamed bigquery is read back from the db by the validator
+        current_app.query_validator.submit(qid, payload if ingest is None else dict(payload, bigquery=None), headers)
+    return json.dumps({'qid': qid, 'numFound': row['numfound'], 'status': row['status']}), 200
+
+
+@advertise(scopes=['store-query'], rate_limit = [300, 3600*24])
+@bp.route('/query/<queryid>/payload', methods=['GET'])
+def query_payload(queryid):
+    '''Retrieves just the stored query (without numfound); it never changes,
+    so the response can be cached forever - the etag is the qid itself and a
+    matching If-None-Match is answered without looking the query up.
+    '''
+    queryid = qid_param(queryid)
+    headers = {'ETag': '"{0}"'.format(queryid),
+               'Cache-Control': 'public, max-age={0}, immutable'.format(current_app.config.get('VAULT_QUERY_PAYLOAD_MAX_AGE', 31536000))}
+    if request.if_none_match.contains(queryid):
+        # only counted when known to exist, made up qids would otherwise
+        # end up in query_access
+        if current_app.query_cache.get(qid=queryid, stale=True):
+            current_app.access_tracker.record(queryid)
+        return '', 304, headers
+
+    q = load_query(qid=queryid)
+    if not q:
+        return json.dumps({'msg': 'Query not found: ' + queryid}), 404
+    current_app.access_tracker.record(q['qid'])
+    return json.dumps({
+        'qid': q['qid'],
+        'query': stored_query_json(q) }), 200, headers
+
 
-        return json.dumps({'qid': qid, 'numFound': num_found}), 200
+@advertise(scopes=['store-query'], rate_limit = [300, 3600*24])
+@bp.route('/queries', methods=['POST'])
+def queries():
+    '''Stores many queries in one go; it receives a json list of payloads
+    (each one like the body of POST /query), or {queries: [...]}, and
+    returns - in the same order - the qid and numFound of each query or
+    the reason why it could not be stored.
+    '''
+    try:
+        payload, headers = check_request(request)
+    except Exception as e:
+        return json.dumps({'msg': str(e)}), 400
+
+    if isinstance(payload, dict):
+        payload = payload.get('queries')
+    if not isinstance(payload, list) or len(payload) == 0:
+        return json.dumps({'msg': 'Expected a list of queries'}), 400
+    max_queries = current_app.config.get('VAULT_BATCH_MAX_QUERIES', 100)
+    if len(payload) > max_queries:
+        return json.dumps({'msg': 'Too many queries, at most {0} can be stored at once'.format(max_queries)}), 400
+
+    results = [None] * len(payload)
+    # identical (once canonical) payloads in the batch are handled once
+    payloads = {}
+    positions = {}
+    aliases = {}
+    for i, item in enumerate(payload):
+        try:
+            if not isinstance(item, dict) or len(item) == 0:
+                raise Exception('Query cannot be empty')
+            p = canonicalize(item)
+        except Exception as e:
+            results[i] = {'msg': str(e)}
+            continue
+        qid = query_qid(p, headers)
+        payloads[qid] = p
+        positions.setdefault(qid, []).append(i)
+        for alias in compatible_qids(item, headers, p):
+            aliases.setdefault(alias, qid)
+
+    # the ones we know already keep what they were stored with (also
+    # under the qid older canonicalization rules gave them)
+    found = {}
+    for qid in payloads:
+        q = current_app.query_cache.get(qid=qid)
+        if q:
+            found[qid] = {'qid': qid, 'numFound': q['numfound'], 'status': q.get('status', 'valid')}
+    missing = [qid for qid in payloads if qid not in found]
+    missing += [alias for alias, qid in aliases.items() if qid in missing]
+    if missing:
+        with current_app.session_scope() as session:
+            for q in session.query(Query.qid, Query.numfound, Query.status).filter(Query.qid.in_(missing)):
+                qid = q.qid if q.qid in payloads else aliases[q.qid]
+                if qid in found and found[qid]['qid'] == qid:
+                    continue
+                found[qid] = {'qid': q.qid, 'numFound': q.numfound, 'status': q.status or 'valid'}
+
+    new = [qid for qid in payloads if qid not in found]
+    deferred = current_app.config.get('VAULT_DEFERRED_VALIDATION', False)
+    items = []
+    if deferred:
+        items = [(qid, payloads[qid], 0, 'pending') for qid in new]
+    elif new:
+        fallback = current_app.config.get('VAULT_SOLR_BREAKER_FALLBACK', 'defer') == 'defer'
+        for qid, r in zip(new, validate_queries([payloads[qid] for qid in new], headers=headers)):
+            if isinstance(r, CircuitOpenError) and fallback:
+                items.append((qid, payloads[qid], 0, 'pending'))
+            elif isinstance(r, Exception):
+                found[qid] = {'msg': 'Could not verify the query.', 'query': payloads[qid], 'reason': str(r)}
+            elif r.status_code != 200:
+                found[qid] = {'msg': 'Could not verify the query.', 'query': payloads[qid], 'reason': r.text}
+            else:
+                num_found = 0
+                try:
+                    num_found = int(r.json()['response']['numFound'])
+                except:
+                    pass
+                items.append((qid, payloads[qid], num_found, 'valid'))
+
+    if items:
+        with current_app.session_scope() as session:
+            try:
+                stored = store_queries(session, items)
+                session.commit()
+            except exc.IntegrityError as e:
+                session.rollback()
+                return json.dumps({'msg': str(e)}), 400
+
+        for qid, row in stored.items():
+            found[qid] = {'qid': qid, 'numFound': row['numfound'], 'status': row['status']}
+            if row['status'] == 'pending' and row['inserted']:
+                current_app.query_validator.submit(qid, payloads[qid], headers)
+
+    for qid, indexes in positions.items():
+        for i in indexes:
+            results[i] = found[qid]
+    return json.dumps({'queries': results}), 200
+
+
+@advertise(scopes=['store-query'], rate_limit = [300, 3600*24])
+@bp.route('/queries', methods=['GET'])
+@bp.route('/queries/resolve', methods=['POST'])
+def resolve_queries():
+    '''Retrieves many stored queries at once; the qids are passed as
+    ?qid=a,b,c (or repeated qid parameters) - or, for long lists, POSTed
+    to /queries/resolve as {qids: [a, b, c]}. Returns, in the same order,
+    what GET /query/<qid> returns for each one (or that it was not found).
+    '''
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        qids = data.get('qids', [])
+    else:
+        qids = [x for v in request.args.getlist('qid') for x in v.split(',')]
+    if not isinstance(qids, list) or not all(isinstance(x, str) for x in qids):
+        return json.dumps({'msg': 'Expected a list of qids'}), 400
+    qids = [qid_param(x.strip()) for x in qids if x.strip()]
+    if len(qids) == 0:
+        return json.dumps({'msg': 'No qids given'}), 400
+    max_qids = current_app.config.get('VAULT_BATCH_MAX_QIDS', 500)
+    if len(qids) > max_qids:
+        return json.dumps({'msg': 'Too many qids, at most {0} can be resolved at once'.format(max_qids)}), 400
+
+    records = load_queries(list(set(qids)))
+    results = []
+    for qid in qids:
+        q = records.get(qid)
+        if not q:
+            results.append({'qid': qid, 'msg': 'Query not found: ' + qid})
+            continue
+        current_app.access_tracker.record(q['qid'])
+        results.append({
+            'qid': q['qid'],
+            'query': stored_query_json(q),
+            'numfound': q['numfound'],
+            'status': q.get('status', 'valid') })
+    return json.dumps({'queries': results}), 200
 
 
 @advertise(scopes=['execute-query'], rate_limit = [1000, 3600*24])
@@ -96,28 +363,36 @@ def execute_query(queryid):
     '''Allows you to execute stored query. With this endpoint you can return parameters for the 
     previously asigned and stored query in the database (such as current number of documents in
     the database.
+
+    For deep paging, pass cursorMark=* (and then the nextCursorMark of each
+    response) instead of start. With Accept: application/x-ndjson, all the
+    documents are returned, one per line.
     '''
 
-    with current_app.session_scope() as session:
-        q = session.query(Query).filter_by(qid=queryid).first()
-        if not q:
-            return json.dumps({'msg': 'Query not found: ' + queryid}), 404
-        q_query = q.query.decode('utf8')
+    queryid = qid_param(queryid)
+    q = load_query(qid=queryid)
+    if not q:
+        return json.dumps({'msg': 'Query not found: ' + queryid}), 404
+    current_app.access_tracker.record(q['qid'])
+
+    # solr refused it during (deferred) validation, no point asking again
+    if q.get('status') == 'invalid':
+        return json.dumps({'msg': 'Query is invalid: ' + queryid}), 400, {'X-Vault-Query-Status': q.get('status', 'valid')}
 
     try:
         payload, headers = check_request(request)
     except Exception as e:
         return json.dumps({'msg': e.message or e.description}), 400
 
-    dataq = json.loads(q_query)
-    query = urlparse.parse_qs(dataq['query'])
+    dataq = q['payload']
+    query = query_params(q)
 
     # override parameters using supplied params
     if len(payload) > 0:
         query.update(payload)
 
     # make sure the {!bitset} is there (when bigquery is used)
-    if dataq['bigquery']:
+    if q['bigquery_id'] or dataq['bigquery']:
         fq = query.get('fq')
         if not fq:
             fq = ['{!bitset}']
@@ -133,8 +408,39 @@ def execute_query(queryid):
     # always request json
     query['wt'] = 'json'
 
-    r = make_solr_request(query=query, bigquery=dataq['bigquery'], headers=headers)
-    return r.text, r.status_code
+    # all the results, fetched page by page with a solr cursor
+    if request.accept_mimetypes.best == 'application/x-ndjson':
+        return iterate_results(query, q, headers)
+
+    # deep paging: solr's nextCursorMark is passed on with the response
+    if query.get('cursorMark'):
+        cursor_query(query)
+
+    # recent identical requests are answered from the result cache (opt-in)
+    cache_key = None
+    if current_app.result_cache.enabled:
+        cache_key = result_cache_key(queryid, query, headers)
+        entry = current_app.result_cache.get(cache_key)
+        if entry:
+            etag, content_type, body = entry
+            out = result_cache_headers(etag)
+            out['X-Vault-Query-Status'] = q.get('status', 'valid')
+            if request.if_none_match.contains(etag):
+                return '', 304, out
+            out['Content-Type'] = content_type or 'application/json'
+            return body, 200, out
+
+    if current_app.config.get('VAULT_STREAM_SOLR_RESPONSES', True):
+        r = make_solr_request(query=query, bigquery=load_bigquery(q), headers=headers, stream=True)
+        return proxy_response(r, {'X-Vault-Query-Status': q.get('status', 'valid')}, cache_key=cache_key)
+
+    r = make_solr_request(query=query, bigquery=load_bigquery(q), headers=headers)
+    out = {'X-Vault-Query-Status': q.get('status', 'valid')}
+    if cache_key and r.status_code == 200:
+        etag = current_app.result_cache.etag(cache_key)
+        current_app.result_cache.set(cache_key, etag, r.headers.get('Content-Type'), r.content)
+        out.update(result_cache_headers(etag))
+    return r.text, r.status_code, out
 
 
 @advertise(scopes=['store-preferences'], rate_limit = [1200, 3600*24])
@@ -242,8 +548,7 @@ def myads_notifications(myads_id=None):
                 if setup is None:
                     return '{}', 404
                 if setup.query_id is not None:
-                    q = session.query(Query).filter_by(id=setup.query_id).first()
-                    qid = q.qid
+                    qid = _setup_query(session, setup)['qid']
                 else:
                     qid = None
 
@@ -324,14 +629,17 @@ def _create_myads_notification(payload=None, headers=None, user_id=None):
         if not all(k in payload for k in ('qid', 'name', 'stateful', 'frequency')):
             return json.dumps({'msg': 'Bad data passed; at least one required keyword is missing'}), 400
         with current_app.session_scope() as session:
-            qid = payload.get('qid')
-            q = session.query(Query).filter_by(qid=qid).first()
+            qid = qid_param(payload.get('qid'))
+            q = load_query(qid=qid, session=session)
             if not q:
                 return json.dumps({'msg': 'Query does not exist'}), 404
-            query_id = q.id
+            # the record may come from the cache while the row is archived
+            restore_queries([q['qid']], session=session)
+            query_id = q['id']
             setup = MyADS(user_id=user_id,
                           type='query',
                           query_id=query_id,
+                          query_qid=q['qid'],
                           name=payload.get('name'),
                           active=True,
                           stateful=payload.get('stateful'),
@@ -359,7 +667,7 @@ def _create_myads_notification(payload=None, headers=None, user_id=None):
         if payload.get('data', None):
             # verify data/query
             solrq = 'q=' + payload.get('data') + '&wt=json'
-            r = make_solr_request(query=solrq, headers=headers)
+            r = validate_query(query=solrq, headers=headers)
             if r.status_code != 200:
                 return json.dumps({'msg': 'Could not verify the query: {0}; reason: {1}'.format(payload, r.text)}), 400
         # add metadata
@@ -487,7 +795,7 @@ def _edit_myads_notification(payload=None, headers=None, user_id=None, myads_id=
     # verify data/query
     if payload.get('data', None):
         solrq = 'q=' + payload['data'] + '&wt=json'
-        r = make_solr_request(query=solrq, headers=headers)
+        r = validate_query(query=solrq, headers=headers)
         if r.status_code != 200:
             return json.dumps({'msg': 'Could not verify the query: {0}; reason: {1}'.format(payload, r.text)}), 400
 
@@ -548,14 +856,15 @@ def _edit_myads_notification(payload=None, headers=None, user_id=None, myads_id=
                 setup.classes = payload.get('classes', setup.classes)
             qid = None
         if payload.get('type', setup.type) == 'query':
-            qid = payload.get('qid', None)
+            qid = qid_param(payload.get('qid', None))
             if qid:
-                q = session.query(Query).filter_by(qid=qid).first()
-                if q.id != setup.query_id:
+                q = load_query(qid=qid, session=session)
+                if not q:
+                    return json.dumps({'msg': 'Query does not exist'}), 404
+                if q['id'] != setup.query_id:
                     return json.dumps({'msg': 'Cannot edit the qid'}), 400
             else:
-                q = session.query(Query).filter_by(id=setup.query_id).first()
-                qid = q.qid
+                qid = _setup_query(session, setup)['qid']
             # name can be edited in query-type setups
             setup.name = payload.get('name', setup.name)
         # edit setup as necessary from the payload
@@ -630,25 +939,32 @@ def execute_myads_query(myads_id):
 
         data = setup.data
         if data is None and setup.query_id:
-            data = _get_general_query_data(session, setup.query_id)
+            data = _get_general_query_data(session, setup)
         query = _create_myads_query(setup.template, setup.frequency, data, classes=setup.classes, get_other_papers=setup.get_other_papers)
 
     return json.dumps(query)
 
-def _get_general_query_data(session, query_id):
+def _setup_query(session, setup):
+    """
+    Returns the stored query of a query-type myADS setup; by qid when the setup has it, which (unlike the id)
+    only touches one partition of queries
+    """
+    if setup.query_qid:
+        return load_query(qid=setup.query_qid, session=session)
+    return load_query(query_id=setup.query_id, session=session)
+
+
+def _get_general_query_data(session, setup):
     """
     Retrieve general myADS query stored in a qid and parse it to return a dict
     """
     data = {}
-    q = session.query(Query).filter_by(id=query_id).one()
-    if q and q.query:
-        # query is bytes object, we turn it into string (unicode)
-        query = json.loads(q.query.decode('utf8')).get('query')
-        if query:
-            # Parse url encoded query string such as:
-            # u'fq=%7B%21type%3Daqp+v%3D%24fq_database%7D&fq_database=%28database%3Aastronomy%29&q=star&sort=citation_count+desc%2C+bibcode+desc'
-            # if bytestring is passed (python3) bytes are returned, not strings
-            data = urlparse.parse_qs(query)
+    q = _setup_query(session, setup)
+    if q and q['query']:
+        # the url encoded query string, such as:
+        # u'fq=%7B%21type%3Daqp+v%3D%24fq_database%7D&fq_database=%28database%3Aastronomy%29&q=star&sort=citation_count+desc%2C+bibcode+desc'
+        # was parsed when it was stored
+        data = query_params(q)
     return data
 
 def _create_myads_query(template_type, frequency, data, classes=None, start_isodate=None, get_other_papers=True):
@@ -804,14 +1120,13 @@ def get_myads(user_id, start_isodate=None):
                  'updated': s.updated.isoformat()}
 
             if s.type == 'query':
-                try:
-                    q = session.query(Query).filter_by(id=s.query_id).one()
-                    qid = q.qid
-                except ormexc.NoResultFound:
+                q = _setup_query(session, s)
+                if not q:
                     qid = None
                     query = None
                 else:
-                    data = _get_general_query_data(session, s.query_id)
+                    qid = q['qid']
+                    data = _get_general_query_data(session, s)
                     query = _create_myads_query(s.template, s.frequency, data, classes=s.classes, start_isodate=start_isodate, get_other_papers=s.get_other_papers)
             else:
                 qid = None
@@ -2,29 +2,717 @@ import urllib.parse as urlparse
 import urllib.request, urllib.parse, urllib.error
 import json
 import re
+import zlib
+import codecs
+from concurrent import futures
+from hashlib import md5, sha256
 
 import adsparser
-from flask import current_app
-from ..models import User, MyADS
-
-from sqlalchemy import exc
+from adsmutils import get_date
+from flask import current_app, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from ..models import User, MyADS, Query, QueryBigquery, QueryPayload, QidKey, QID_RE
+from ..breaker import CircuitOpenError
+from ..client import PoolSaturated
+
+from sqlalchemy import exc, text, bindparam, Integer
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 from sqlalchemy.orm import exc as ormexc
 from sqlalchemy.sql.expression import all_
 
 
-def make_solr_request(query, bigquery=None, headers=None):
+def make_solr_request(query, bigquery=None, headers=None, stream=False):
     # I'm making a simplification here; sending just one content stream
     # it would be possible to save/send multiple content streams but
     # I decided that would only create confusion; so only one is allowed
+    # (bigquery is either a string or a BigqueryReader which requests
+    # streams to solr while it is being decompressed)
+    # with stream=True the response body is not read yet, see proxy_response()
     if isinstance(query, str):
         query = urlparse.parse_qs(query)
 
+    # while solr is failing, requests are refused right away (CircuitOpenError)
+    breaker = current_app.solr_breaker
+    breaker.before()
+    try:
+        if bigquery:
+            headers = dict(headers)
+            headers['content-type'] = 'big-query/csv'
+            r = current_app.client.post(current_app.config['VAULT_SOLR_BIGQUERY_ENDPOINT'], params=query, headers=headers, data=bigquery, stream=stream)
+        else:
+            r = current_app.client.get(current_app.config['VAULT_SOLR_QUERY_ENDPOINT'], params=query, headers=headers, stream=stream)
+    except (PoolSaturated, CircuitOpenError):
+        # refused on our side, solr was never asked
+        breaker.cancel()
+        raise
+    except Exception:
+        breaker.failure()
+        raise
+    if r.status_code >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+    return r
+
+
+def hedged_solr_request(query, bigquery=None, headers=None):
+    """make_solr_request() for validations, which are idempotent: if solr
+    is slow to answer (VAULT_SOLR_HEDGE), the request is sent once more and
+    the first response is used"""
+    app = current_app._get_current_object()
+
+    def send(bigquery):
+        with app.app_context():
+            return make_solr_request(query=query, bigquery=bigquery, headers=headers)
+
+    # a BigqueryReader can only be sent once
+    again = bigquery.reopen() if isinstance(bigquery, BigqueryReader) else bigquery
+    return app.solr_hedger.do(send, (bigquery,), (again,))
+
+
+def proxy_response(r, headers=None, cache_key=None):
+    """Passes a streamed solr response on chunk by chunk, so it is never
+    held by the worker in full. Responses bigger than
+    VAULT_MAX_SOLR_RESPONSE_BYTES are refused when solr announces the
+    size, and cut off (the connection is dropped) when it does not.
+
+    With a cache_key, a successful response is also kept in the result
+    cache - as long as it fits in it - once it has been passed on"""
+    max_bytes = current_app.config.get('VAULT_MAX_SOLR_RESPONSE_BYTES')
+    length = r.headers.get('Content-Length')
+    if max_bytes and length and int(length) > max_bytes:
+        r.close()
+        return current_app.response_class(json.dumps({'msg': 'The response is bigger than {0} bytes, ask for fewer rows'.format(max_bytes)}),
+                                          status=400, headers=headers)
+
+    cache = current_app.result_cache
+    if r.status_code != 200 or not cache.enabled:
+        cache_key = None
+    headers = dict(headers or {})
+    # the body is passed on decoded, so Content-Encoding/Length do not apply
+    if 'Content-Type' in r.headers:
+        headers['Content-Type'] = r.headers['Content-Type']
+    if cache_key:
+        etag = cache.etag(cache_key)
+        headers.update(result_cache_headers(etag))
+
+    def generate():
+        size = 0
+        kept = [] if cache_key else None
+        try:
+            for chunk in r.iter_content(chunk_size=current_app.config.get('VAULT_SOLR_RESPONSE_CHUNK_BYTES', 64 * 1024)):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    current_app.logger.error('Solr response cut off after {0} bytes'.format(size))
+                    raise Exception('The response is bigger than {0} bytes'.format(max_bytes))
+                if kept is not None:
+                    kept.append(chunk)
+                    if size > cache.local.max_item_bytes:
+                        kept = None
+                yield chunk
+        finally:
+            r.close()
+        if kept is not None:
+            cache.set(cache_key, etag, headers.get('Content-Type'), b''.join(kept))
+
+    return current_app.response_class(stream_with_context(generate()), status=r.status_code, headers=headers)
+
+
+def cursor_query(query):
+    """Prepares solr parameters for cursor paging (cursorMark): the sort must
+    end on the unique key (VAULT_SOLR_CURSOR_TIEBREAKER), and start is not
+    allowed - the cursor says where the page starts"""
+    tiebreaker = current_app.config.get('VAULT_SOLR_CURSOR_TIEBREAKER', 'id asc')
+    sort = query.get('sort') or []
+    if isinstance(sort, str):
+        sort = [sort]
+    clauses = [c.strip() for s in sort for c in s.split(',') if c.strip()]
+    if tiebreaker.split()[0] not in [c.split()[0] for c in clauses]:
+        clauses.append(tiebreaker)
+    query['sort'] = [', '.join(clauses)]
+    query.pop('start', None)
+    return query
+
+
+def iterate_results(query, record, headers):
+    """Runs a stored query page by page with a solr cursor, and returns the
+    documents of every page as NDJSON (one document per line). Only one page
+    (VAULT_SOLR_CURSOR_ROWS documents at most) is held at a time.
+
+    The first page is requested right away, so that a failure can still be
+    answered with solr's status; a later one ends the stream with an
+    {"error": ...} line"""
+    query = cursor_query(dict(query))
+    max_rows = current_app.config.get('VAULT_SOLR_CURSOR_ROWS', 1000)
+    rows = query.get('rows')
+    if isinstance(rows, list):
+        rows = rows[0]
+    try:
+        rows = min(int(rows), max_rows) if rows else max_rows
+    except ValueError:
+        return current_app.response_class(json.dumps({'msg': 'rows must be a number'}), status=400)
+    query['rows'] = [str(rows)]
+    cursor = query.get('cursorMark') or '*'
+    query['cursorMark'] = cursor[0] if isinstance(cursor, list) else cursor
+
+    def fetch():
+        # a BigqueryReader can only be sent once, so each page reloads it
+        r = make_solr_request(query=query, bigquery=load_bigquery(record), headers=headers)
+        return r, (r.json() if r.status_code == 200 else None)
+
+    r, data = fetch()
+    if data is None:
+        return current_app.response_class(r.text, status=r.status_code,
+                                          headers={'Content-Type': r.headers.get('Content-Type', 'application/json')})
+    out = {'Content-Type': 'application/x-ndjson',
+           'X-Vault-Query-Status': record.get('status', 'valid'),
+           'X-Vault-NumFound': str(data['response']['numFound'])}
+
+    def generate(data):
+        pages = 0
+        while True:
+            pages += 1
+            for doc in data['response']['docs']:
+                yield json.dumps(doc) + '\n'
+            next_cursor = data.get('nextCursorMark')
+            # solr hands back the same cursor once there is nothing left
+            if not next_cursor or next_cursor == query['cursorMark'] or not data['response']['docs']:
+                break
+            query['cursorMark'] = next_cursor
+            data = None
+            try:
+                r, data = fetch()
+            except Exception as e:
+                current_app.logger.error('Could not fetch page {0} of {1}: {2}'.format(pages + 1, record['qid'], e))
+            if data is None:
+                yield json.dumps({'error': 'Could not fetch page {0}'.format(pages + 1)}) + '\n'
+                break
+
+    return current_app.response_class(stream_with_context(generate(data)), status=200, headers=out)
+
+
+def result_cache_key(qid, query, headers):
+    """Result cache key of a stored query run with the given (final) solr
+    parameters, for the credentials in the headers"""
+    scope = sha256(headers.get('Authorization', '-').encode('utf8')).hexdigest()
+    return current_app.result_cache.key(qid, serialize_dict(query), scope)
+
+
+def result_cache_headers(etag):
+    # responses depend on the credentials, so shared caches must not keep them
+    return {'ETag': '"{0}"'.format(etag),
+            'Cache-Control': 'private, max-age={0}'.format(current_app.result_cache.ttl)}
+
+
+def validate_query(query, bigquery='', headers=None, bigquery_digest=None):
+    """Runs the query against solr to check it is valid (and count what it
+    finds); concurrent validations of the same query in this worker share
+    a single solr request and its response - as long as they come with the
+    same credentials. A bigquery streamed from a BigqueryReader is only
+    coalesced when its digest is given"""
+    if isinstance(query, str):
+        query = urlparse.parse_qs(query)
+    scope = sha256((headers or {}).get('Authorization', '-').encode('utf8')).hexdigest()
+    key = scope + '|' + serialize_dict(query)
     if bigquery:
-        headers = dict(headers)
-        headers['content-type'] = 'big-query/csv'
-        return current_app.client.post(current_app.config['VAULT_SOLR_BIGQUERY_ENDPOINT'], params=query, headers=headers, data=bigquery)
+        if bigquery_digest is None:
+            if not isinstance(bigquery, str):
+                return hedged_solr_request(query=query, bigquery=bigquery, headers=headers)
+            bigquery_digest = payload_digest(bigquery.encode('utf8'))
+        key += '|' + bigquery_digest
+    return current_app.solr_flight.do(key, hedged_solr_request, query=query, bigquery=bigquery, headers=headers)
+
+
+def validate_queries(payloads, headers=None, workers=None):
+    """Validates many (cleaned up) payloads concurrently, with at most
+    `workers` (VAULT_BATCH_VALIDATION_WORKERS) solr requests in flight;
+    returns the responses in the same order - or the exception, if the
+    request failed"""
+    app = current_app._get_current_object()
+
+    def run(payload):
+        with app.app_context():
+            try:
+                return validate_query(query=payload['query'] + '&wt=json', bigquery=payload['bigquery'], headers=headers)
+            except Exception as e:
+                return e
+
+    workers = min(len(payloads), workers or app.config.get('VAULT_BATCH_VALIDATION_WORKERS', 8))
+    with futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return list(executor.map(run, payloads))
+
+
+def compress_bigquery(bigquery, codec='zlib'):
+    """Returns the columns of a QueryBigquery row holding the bigquery"""
+    data = bigquery.encode('utf8')
+    size = len(data)
+    if codec == 'zlib':
+        data = zlib.compress(data, 6)
+    elif codec != 'identity':
+        raise Exception('Unknown bigquery codec: {0}'.format(codec))
+    return {'codec': codec, 'size': size, 'data': data}
+
+
+class BigqueryReader(object):
+    """File-like view of a stored bigquery; the body is decompressed as it
+    is read, so it never has to be materialized in full"""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, codec, size, data):
+        self.codec = codec
+        self.size = size
+        self._data = memoryview(data)
+        self._offset = 0
+        self._buffer = b''
+        self._decompressor = zlib.decompressobj() if codec == 'zlib' else None
+
+    def __len__(self):
+        return self.size
+
+    def reopen(self):
+        """A new reader over the same blob, from the start"""
+        return BigqueryReader(self.codec, self.size, self._data)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, n=-1):
+        while (n is None or n < 0 or len(self._buffer) < n) and self._offset <= len(self._data):
+            chunk = self._data[self._offset:self._offset + self.chunk_size]
+            self._offset += self.chunk_size
+            if self._decompressor is None:
+                self._buffer += chunk.tobytes()
+            elif len(chunk):
+                self._buffer += self._decompressor.decompress(chunk)
+            else:
+                self._buffer += self._decompressor.flush()
+        if n is None or n < 0:
+            n = len(self._buffer)
+        out, self._buffer = self._buffer[:n], self._buffer[n:]
+        return out
+
+
+class BigqueryIngest(object):
+    """Consumes a raw bigquery upload chunk by chunk: the body is compressed
+    for storage as it arrives, and the qid and payload digest - which are
+    taken over the JSON of the payload, as if the bigquery had been posted
+    inside it - are computed along the way. The upload is never held in
+    memory in full (uncompressed).
+
+    `payload` is the cleaned up payload, without the bigquery"""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, payload, uid, codec='zlib', max_bytes=None):
+        if codec not in ('zlib', 'identity'):
+            raise Exception('Unknown bigquery codec: {0}'.format(codec))
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.qid = self.digest = self.bigquery_digest = self.blob = None
+        self._decoder = codecs.getincrementaldecoder('utf8')()
+        self._compressor = zlib.compressobj(6) if codec == 'zlib' else None
+        self._chunks = []
+        self._qid = md5(uid.encode('utf8'))
+        self._digest = sha256()
+        self._bigquery_digest = sha256()
+        # the JSON of the payload, split around the (escaped) bigquery
+        self._head, self._tail = json.dumps(dict(payload, bigquery='')).rsplit('""', 1)
+        self._json(self._head + '"')
+
+    def _json(self, text):
+        data = text.encode('utf8')
+        self._qid.update(data)
+        self._digest.update(data)
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise RequestEntityTooLarge('The bigquery is bigger than {0} bytes'.format(self.max_bytes))
+        self._bigquery_digest.update(chunk)
+        # escaped the way json.dumps() does it, one chunk at a time
+        self._json(json.dumps(self._decoder.decode(chunk))[1:-1])
+        self._chunks.append(self._compressor.compress(chunk) if self._compressor else chunk)
+
+    def read_from(self, stream):
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            self.feed(chunk)
+        return self.finish()
+
+    def finish(self):
+        self._json(json.dumps(self._decoder.decode(b'', final=True))[1:-1] + '"' + self._tail)
+        if self._compressor:
+            self._chunks.append(self._compressor.flush())
+        self.qid = self._qid.hexdigest()
+        self.digest = self._digest.hexdigest()
+        self.bigquery_digest = self._bigquery_digest.hexdigest()
+        self.blob = {'codec': self.codec, 'size': self.size, 'data': b''.join(self._chunks)}
+        self._chunks = []
+        return self
+
+
+def query_record(q, p=None):
+    """Turns a Query row (and its shared QueryPayload, if it has been
+    folded into one) into the record kept by the query cache"""
+    source = p if p is not None else q
+    query = source.query.decode('utf8') if source.query else '' # bytes to string
+    payload = json.loads(query) if query else {}
+    params = p.params if p is not None else None
+    if params is None and payload.get('query'):
+        # not backfilled yet, or a row never folded into query_payloads
+        params = urlparse.parse_qs(payload['query'])
+    return {'id': q.id,
+            'qid': q.qid,
+            'numfound': q.numfound,
+            'status': q.status or 'valid',
+            'query': query,
+            'payload': payload,
+            'params': params or {},
+            'bigquery_id': source.bigquery_id}
+
+
+def query_params(record):
+    """The parsed query string of a stored query record, {param: [values]}
+    as urlparse.parse_qs() returns it; a copy, so callers can modify it"""
+    params = record.get('params')
+    if params is None:
+        query = record['payload'].get('query')
+        return urlparse.parse_qs(query) if query else {}
+    return {k: list(v) for k, v in params.items()}
+
+
+def load_query(qid=None, query_id=None, session=None):
+    """Returns the stored query record for the given qid (or integer id),
+    going to the database only when it is not cached; None if there is no
+    such query. Records are shared, callers must not modify them.
+
+    The record never carries the bigquery body, see load_bigquery()"""
+    record = current_app.query_cache.get(qid=qid, query_id=query_id)
+    if record is not None:
+        return record
+
+    if session is None:
+        with current_app.session_scope() as session:
+            record = _fetch_query(session, qid, query_id)
+            # keeps an archived query that was moved back
+            session.commit()
+            return record
+    return _fetch_query(session, qid, query_id)
+
+
+def _fetch_query(session, qid=None, query_id=None):
+    # a record cached a while ago only needs its numfound and status again
+    stale = current_app.query_cache.get(qid=qid, query_id=query_id, stale=True)
+    if stale is not None:
+        # by qid, which prunes to one partition (see Query)
+        row = session.query(Query.numfound, Query.status).filter_by(qid=stale['qid']).first()
+        if row:
+            record = dict(stale, numfound=row.numfound, status=row.status or 'valid')
+            if record['status'] != 'pending':
+                current_app.query_cache.set(record)
+            return record
+
+    rows = session.query(Query, QueryPayload).outerjoin(QueryPayload, Query.payload_id == QueryPayload.id)
+    if qid is not None:
+        row = rows.filter(Query.qid == qid).first()
+        if not row and restore_queries([qid], session=session):
+            row = rows.filter(Query.qid == qid).first()
     else:
-        return current_app.client.get(current_app.config['VAULT_SOLR_QUERY_ENDPOINT'], params=query, headers=headers)
+        row = rows.filter(Query.id == query_id).first()
+    if not row:
+        return None
+    record = query_record(*row)
+    # pending rows are about to change, so they are not cached
+    if record['status'] != 'pending':
+        current_app.query_cache.set(record)
+    return record
+
+
+def load_queries(qids, session=None):
+    """Returns {qid: record} for those of the qids that exist; whatever is
+    not cached is fetched with a single IN query"""
+    records = {}
+    for qid in qids:
+        record = current_app.query_cache.get(qid=qid)
+        if record is not None:
+            records[qid] = record
+    missing = [qid for qid in qids if qid not in records]
+    if not missing:
+        return records
+
+    if session is None:
+        with current_app.session_scope() as session:
+            records.update(_fetch_queries(session, missing))
+            session.commit()
+    else:
+        records.update(_fetch_queries(session, missing))
+    return records
+
+
+def _fetch_queries(session, qids):
+    rows = session.query(Query, QueryPayload) \
+        .outerjoin(QueryPayload, Query.payload_id == QueryPayload.id)
+    records = {}
+    for row in rows.filter(Query.qid.in_(qids)):
+        record = query_record(*row)
+        if record['status'] != 'pending':
+            current_app.query_cache.set(record)
+        records[record['qid']] = record
+    restored = restore_queries([qid for qid in qids if qid not in records], session=session)
+    if restored:
+        records.update(_fetch_queries(session, restored))
+    return records
+
+
+def load_bigquery(record, session=None):
+    """Returns the bigquery of a stored query: a BigqueryReader over the
+    compressed blob, or the plain string for rows written before bigqueries
+    were moved out of line (empty if there is no bigquery)"""
+    if not record['bigquery_id']:
+        return record['payload'].get('bigquery', '')
+
+    blob = current_app.query_cache.get_bigquery(record['bigquery_id'])
+    if blob is None:
+        if session is None:
+            with current_app.session_scope() as session:
+                return load_bigquery(record, session)
+        bq = session.query(QueryBigquery).filter_by(id=record['bigquery_id']).one()
+        blob = (bq.codec, bq.size, bq.data)
+        current_app.query_cache.set_bigquery(record['bigquery_id'], blob)
+    return BigqueryReader(*blob)
+
+
+def stored_query_json(record):
+    """The JSON of the payload exactly as it was submitted, i.e. with the
+    bigquery put back in"""
+    if not record['bigquery_id']:
+        return record['query']
+    bigquery = load_bigquery(record).read().decode('utf8')
+    return json.dumps(dict(record['payload'], bigquery=bigquery))
+
+
+def query_etag(record):
+    """Strong etag of GET /query/<qid>: the qid (its payload never changes)
+    versioned by the fields that can, i.e. numfound and status"""
+    version = zlib.crc32('{0}:{1}'.format(record['numfound'], record.get('status', 'valid')).encode('utf8'))
+    return '{0}-{1:08x}'.format(record['qid'], version)
+
+
+def payload_digest(query):
+    """Content address of a payload, given the JSON bytes as submitted"""
+    return sha256(query).hexdigest()
+
+
+# both upserts return the id of the row whether they inserted it or it was
+# already there; the fallback SELECT is evaluated against the statement's
+# snapshot, so a row committed concurrently may still be missed (see callers)
+UPSERT_PAYLOAD = text("""
+    WITH ins AS (
+        INSERT INTO query_payloads (digest, query, params, created)
+        VALUES (:digest, :query, CAST(:params AS jsonb), :created)
+        ON CONFLICT (digest) DO NOTHING
+        RETURNING id, true AS inserted
+    )
+    SELECT id, inserted FROM ins
+    UNION ALL
+    SELECT id, false FROM query_payloads WHERE digest = :digest
+    LIMIT 1
+    """)
+
+UPSERT_QUERY = text("""
+    WITH ins AS (
+        INSERT INTO queries (uid, qid, numfound, status, category, payload_id, created, updated, numfound_updated)
+        VALUES (0, :qid, :numfound, :status, '', :payload_id, :created, :created, :created)
+        ON CONFLICT (qid) DO NOTHING
+        RETURNING id, numfound, status, true AS inserted
+    )
+    SELECT id, numfound, status, inserted FROM ins
+    UNION ALL
+    SELECT id, numfound, status, false FROM queries WHERE qid = :qid
+    LIMIT 1
+    """).bindparams(bindparam('qid', type_=QidKey))
+
+
+def store_payload(session, payload, digest, blob=None):
+    """Returns the id of the QueryPayload with the given digest, adding it
+    (and its bigquery, compressed and out of line) when it is new; `blob`
+    is the already compressed bigquery of a streamed upload"""
+    stored = dict(payload, bigquery='')
+    row = session.execute(UPSERT_PAYLOAD, {'digest': digest,
+                                           'query': json.dumps(stored).encode('utf8'),
+                                           'params': json.dumps(urlparse.parse_qs(payload.get('query') or '')),
+                                           'created': get_date()}).first()
+    if row is None:
+        return session.query(QueryPayload.id).filter_by(digest=digest).scalar()
+
+    payload_id, inserted = row
+    if inserted and (blob or payload['bigquery']):
+        if blob is None:
+            blob = compress_bigquery(payload['bigquery'], current_app.config.get('VAULT_BIGQUERY_CODEC', 'zlib'))
+        bq = QueryBigquery(**blob)
+        session.add(bq)
+        session.flush()
+        session.query(QueryPayload).filter_by(id=payload_id).update({'bigquery_id': bq.id}, synchronize_session=False)
+    return payload_id
+
+
+def store_query(session, qid, payload, numfound, status='valid', ingest=None):
+    """Stores the query unless its qid exists already; the payload itself
+    is stored once, no matter how many users saved it. Returns a dict with
+    the id, numfound and status of the stored row (for a duplicate, the
+    values it was originally saved with) and whether it was inserted.
+
+    For a streamed bigquery, `ingest` is the BigqueryIngest that read it"""
+    if ingest is not None:
+        payload_id = store_payload(session, payload, ingest.digest, blob=ingest.blob)
+    else:
+        digest = payload_digest(json.dumps(payload).encode('utf8'))
+        payload_id = store_payload(session, payload, digest)
+    # an archived qid is moved back, rather than stored a second time
+    restore_queries([qid], session=session)
+    row = session.execute(UPSERT_QUERY, {'qid': qid,
+                                         'numfound': numfound,
+                                         'status': status,
+                                         'payload_id': payload_id,
+                                         'created': get_date()}).first()
+    if row is None:
+        q = session.query(Query.id, Query.numfound, Query.status).filter_by(qid=qid).one()
+        row = (q.id, q.numfound, q.status, False)
+    current_app.qid_filter.add(qid)
+    return {'id': row[0], 'numfound': row[1], 'status': row[2] or 'valid', 'inserted': row[3]}
+
+
+def store_queries(session, items):
+    """Stores many queries at once; items are (qid, payload, numfound,
+    status) tuples. Distinct payloads are stored as in store_query, the
+    queries rows go in with a single insert and qids that exist already are
+    left alone. Returns {qid: <the dict store_query returns>}"""
+    if not items:
+        return {}
+    payload_ids = {}
+    values = []
+    now = get_date()
+    for qid, payload, numfound, status in items:
+        digest = payload_digest(json.dumps(payload).encode('utf8'))
+        if digest not in payload_ids:
+            payload_ids[digest] = store_payload(session, payload, digest)
+        values.append({'uid': 0, 'qid': qid, 'numfound': numfound, 'status': status, 'category': '',
+                       'payload_id': payload_ids[digest], 'created': now, 'updated': now,
+                       'numfound_updated': now})
+
+    # rows are locked in qid order, so that concurrent batches that overlap
+    # cannot deadlock on the qid index
+    values.sort(key=lambda v: v['qid'])
+    restore_queries([v['qid'] for v in values], session=session)
+    table = Query.__table__
+    stmt = pg_insert(table).values(values) \
+        .on_conflict_do_nothing(index_elements=['qid']) \
+        .returning(table.c.id, table.c.qid, table.c.numfound, table.c.status)
+    out = {}
+    for row in session.execute(stmt):
+        out[row.qid] = {'id': row.id, 'numfound': row.numfound, 'status': row.status or 'valid', 'inserted': True}
+        current_app.qid_filter.add(row.qid)
+
+    existing = [v['qid'] for v in values if v['qid'] not in out]
+    if existing:
+        for row in session.query(Query.id, Query.qid, Query.numfound, Query.status).filter(Query.qid.in_(existing)):
+            out[row.qid] = {'id': row.id, 'numfound': row.numfound, 'status': row.status or 'valid', 'inserted': False}
+    return out
+
+
+def record_validation(session, qid, status, numfound):
+    """Records the outcome of a deferred validation; rows that are not
+    pending (anymore) are left alone. Returns the query id, if updated"""
+    row = session.execute(text("""
+        UPDATE queries SET status = :status, numfound = :numfound, updated = :updated,
+                           numfound_updated = :updated
+        WHERE qid = :qid AND status = 'pending'
+        RETURNING id
+        """).bindparams(bindparam('qid', type_=QidKey)), {'qid': qid, 'status': status, 'numfound': numfound, 'updated': get_date()}).first()
+    if row is None:
+        return None
+    current_app.query_cache.invalidate(qid=qid, query_id=row[0])
+    return row[0]
+
+
+QUERY_COLUMNS = 'id, uid, qid, created, updated, numfound, numfound_updated, status, category, payload_id, query, bigquery_id'
+
+ARCHIVE_QUERIES = text("""
+    WITH cold AS (
+        SELECT q.id, q.qid FROM queries q
+        LEFT JOIN query_access a ON a.qid = q.qid
+        WHERE q.id > :after
+          AND COALESCE(a.last_access, q.created) < :cutoff
+          AND (q.status IS NULL OR q.status <> 'pending')
+          AND NOT EXISTS (SELECT 1 FROM myads m WHERE m.query_id = q.id)
+        ORDER BY q.id
+        LIMIT :batch
+        FOR UPDATE OF q SKIP LOCKED
+    ), moved AS (
+        DELETE FROM queries USING cold WHERE queries.id = cold.id AND queries.qid = cold.qid
+        RETURNING {0}
+    )
+    INSERT INTO queries_archive ({0}, archived)
+    SELECT {0}, :now FROM moved
+    RETURNING id, qid
+    """.format(QUERY_COLUMNS)).columns(id=Integer, qid=QidKey)
+
+ARCHIVED_QIDS = text("""
+    SELECT qid FROM queries_archive WHERE qid = ANY(:qids)
+    """).bindparams(bindparam('qids', type_=ARRAY(QidKey))).columns(qid=QidKey)
+
+RESTORE_QUERIES = text("""
+    WITH moved AS (
+        DELETE FROM queries_archive WHERE qid = ANY(:qids)
+        RETURNING {0}
+    )
+    INSERT INTO queries ({0})
+    SELECT {0} FROM moved
+    ON CONFLICT (qid) DO NOTHING
+    RETURNING qid
+    """.format(QUERY_COLUMNS)).bindparams(bindparam('qids', type_=ARRAY(QidKey))).columns(qid=QidKey)
+
+
+def archive_queries(session, cutoff, batch=1000, after=0):
+    """Moves the next batch (by id, after `after`) of cold queries to
+    queries_archive: not read since `cutoff` (or created before it, if
+    never read), not pending and not used by any myADS notification.
+    Returns the (id, qid) of the archived rows"""
+    rows = session.execute(ARCHIVE_QUERIES, {'cutoff': cutoff, 'batch': batch, 'after': after,
+                                             'now': get_date()}).fetchall()
+    for row in rows:
+        current_app.query_cache.invalidate(qid=row.qid, query_id=row.id)
+    return rows
+
+
+def restore_queries(qids, session=None):
+    """Moves the archived ones among the qids back into queries; returns
+    their qids. The archive is only written to when it has one of them.
+    Without a session it is done (and committed) on its own, else the
+    caller commits"""
+    if not qids:
+        return []
+    if session is None:
+        with current_app.session_scope() as session:
+            restored = restore_queries(qids, session)
+            if restored:
+                session.commit()
+            return restored
+    archived = [row.qid for row in session.execute(ARCHIVED_QIDS, {'qids': list(qids)})]
+    if not archived:
+        return []
+    restored = [row.qid for row in session.execute(RESTORE_QUERIES, {'qids': archived})]
+    if restored:
+        current_app.logger.info('Restored {0} archived queries'.format(len(restored)))
+    return restored
 
 
 def cleanup_payload(payload):
@@ -56,18 +744,7 @@ def cleanup_payload(payload):
         raise Exception('The bigquery has to be a string, instead it was {0}'.format(type(bigquery)))
 
     if len(bigquery) > 0:
-        found = False
-        for k,v in list(query.items()):
-            if 'fq' in k:
-                if isinstance(v, list):
-                    for x in v:
-                        if '!bitset' in x:
-                            found = True
-                elif '!bitset' in v:
-                    found = True
-                break
-        if not found:
-            raise Exception('When you pass bigquery data, you also need to tell us how to use it (in fq={!bitset} etc)')
+        require_bitset(query)
 
     return {
         'query': serialize_dict(query),
@@ -75,6 +752,35 @@ def cleanup_payload(payload):
     }
 
 
+def require_bitset(query):
+    found = False
+    for k,v in list(query.items()):
+        if 'fq' in k:
+            if isinstance(v, list):
+                for x in v:
+                    if '!bitset' in x:
+                        found = True
+            elif '!bitset' in v:
+                found = True
+            break
+    if not found:
+        raise Exception('When you pass bigquery data, you also need to tell us how to use it (in fq={!bitset} etc)')
+
+
+def query_qid(payload, headers):
+    """The qid of a (cleaned up) payload saved by the user in the headers"""
+    return md5(headers['X-Api-Uid'].encode('utf8') + json.dumps(payload).encode('utf8')).hexdigest()
+
+
+def qid_param(qid):
+    """A qid as received in a url or a payload, the way it comes back from
+    the database: qids are stored as the digest bytes (see models.QidKey),
+    so an upper case hex qid is the same query as the lower case one"""
+    if qid and QID_RE.match(qid):
+        return qid.lower()
+    return qid
+
+
 def serialize_dict(data):
     v = list(data.items())
     v = sorted(v, key=lambda x: x[0])